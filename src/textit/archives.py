@@ -0,0 +1,170 @@
+"""Zip and tar archives as input directories.
+
+Every regular file of an archive is a task of its own, named by its member
+URL, ``<archive path>!/<member name>``, which is also the ``url`` of its
+record. The workers read the members into memory, without unpacking the
+archive: zip and uncompressed tar members directly, members of compressed
+tars by reading the archive as a stream. The tasks of an archive are queued
+in its order, so every worker only goes through a compressed tar once, taking
+the members that it gets and skipping the others.
+
+"""
+import functools
+import os
+import tarfile
+import zipfile
+from typing import Iterator, Optional
+
+from textit.helpers import getLogger
+
+SEPARATOR = "!/"
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar",)
+COMPRESSED_TAR_SUFFIXES = (".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+def is_archive(path: str) -> bool:
+    return path.lower().endswith(ZIP_SUFFIXES + TAR_SUFFIXES + COMPRESSED_TAR_SUFFIXES)
+
+
+def member_url(archive_path: str, name: str) -> str:
+    return archive_path + SEPARATOR + name
+
+
+def split_member(path: str) -> Optional[tuple[str, str]]:
+    """(archive path, member name) of a member URL, None for other paths."""
+    start = 0
+    while (i := path.find(SEPARATOR, start)) != -1:
+        if is_archive(path[:i]):
+            return path[:i], path[i + len(SEPARATOR):]
+        start = i + 1
+    return None
+
+
+@functools.lru_cache(maxsize=64)
+def _archive_size(archive_path: str) -> int:
+    return os.path.getsize(archive_path)
+
+
+def sort_size(path: str, size: int) -> int:
+    """Size to order a task by: that of its archive for a member, so that
+    (with a stable sort) the members of an archive stay together and in
+    order."""
+    member = split_member(path)
+    return size if member is None else _archive_size(member[0])
+
+
+def _zip_name(info: zipfile.ZipInfo) -> str:
+    if info.flag_bits & 0x800:
+        return info.filename
+    # Without the UTF-8 flag, zipfile decodes names as cp437, but most
+    # archivers write UTF-8 anyway.
+    try:
+        return info.filename.encode("cp437").decode("utf-8")
+    except UnicodeError:
+        return info.filename
+
+
+def _tar_name(info: tarfile.TarInfo) -> str:
+    # Archives of "." have "./" in front of every name.
+    name = info.name
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def _next_member(tf: tarfile.TarFile) -> Optional[tarfile.TarInfo]:
+    info = tf.next()
+    # A stream can't go back to the earlier members anyway, don't keep them.
+    tf.members.clear()
+    return info
+
+
+def iter_members(archive_path: str) -> Iterator[tuple[str, int]]:
+    """Yields (member URL, size) for the regular files of the archive, in
+    its order."""
+    if archive_path.lower().endswith(ZIP_SUFFIXES):
+        with zipfile.ZipFile(archive_path) as zf:
+            for info in zf.infolist():
+                if not info.is_dir():
+                    yield member_url(archive_path, _zip_name(info)), info.file_size
+    else:
+        # Streaming, so that compressed tars are only decompressed once.
+        with tarfile.open(archive_path, "r|*") as tf:
+            while (info := _next_member(tf)) is not None:
+                if info.isfile():
+                    yield member_url(archive_path, _tar_name(info)), info.size
+
+
+def iter_inputs(path: str, iter_files) -> Iterator[tuple[str, int]]:
+    """Yields (path, size) for the files of ``iter_files(path)``, with the
+    archives replaced by their members."""
+    for file_path, size in iter_files(path):
+        if not is_archive(file_path):
+            yield file_path, size
+            continue
+
+        try:
+            yield from iter_members(file_path)
+        except (OSError, zipfile.BadZipFile, tarfile.TarError) as e:
+            getLogger().warning(f"Skipping the rest of archive '{file_path}': {e}")
+
+
+class ArchiveReader(object):
+    """Reads members of archives, keeping the last archive open.
+
+    Compressed tars are read as a stream: members after the current position
+    are found by skipping the ones in between, going back means opening the
+    archive again.
+
+    """
+    def __init__(self):
+        self._path = None
+        self._archive = None
+        self._compressed = False
+        # Member name -> info, for random access.
+        self._index = None
+
+    def _open(self, archive_path: str) -> None:
+        self.close()
+        lower = archive_path.lower()
+        self._compressed = lower.endswith(COMPRESSED_TAR_SUFFIXES)
+        if lower.endswith(ZIP_SUFFIXES):
+            self._archive = zipfile.ZipFile(archive_path)
+            self._index = {_zip_name(info): info for info in self._archive.infolist()}
+        elif self._compressed:
+            self._archive = tarfile.open(archive_path, "r|*")
+        else:
+            self._archive = tarfile.open(archive_path, "r:")
+            self._index = {_tar_name(info): info for info in self._archive.getmembers()}
+        self._path = archive_path
+
+    def read(self, archive_path: str, name: str) -> bytes:
+        if archive_path != self._path:
+            self._open(archive_path)
+
+        if self._index is not None:
+            info = self._index.get(name)
+            if info is None:
+                raise FileNotFoundError(f"No member '{name}' in '{archive_path}'")
+            if isinstance(self._archive, zipfile.ZipFile):
+                return self._archive.read(info)
+            return self._archive.extractfile(info).read()
+
+        for restarted in (False, True):
+            if restarted:
+                self._open(archive_path)
+            while (info := _next_member(self._archive)) is not None:
+                if info.isfile() and _tar_name(info) == name:
+                    return self._archive.extractfile(info).read()
+        # At the end of the stream, which can't be read any further.
+        self.close()
+        raise FileNotFoundError(f"No member '{name}' in '{archive_path}'")
+
+    def close(self) -> None:
+        if self._archive is not None:
+            self._archive.close()
+        self._path = None
+        self._archive = None
+        self._index = None
@@ -0,0 +1,70 @@
+import os
+import sqlite3
+from typing import Optional
+
+
+
+class DigestIndex(object):
+    """Content digest -> output record, shared by the workers of a run.
+
+    The index is a SQLite file, so it also persists across runs. Output
+    paths are stored relative to ``root`` (the output directory). A worker
+    claims a digest before extracting it; whoever gets the claim first does
+    the extraction, and the others only reference its output.
+
+    """
+    PENDING = "pending"
+    DONE = "done"
+
+    def __init__(self, path: str, root: str):
+        self.path = path
+        self.root = root
+        # Claims are completed from the writer thread of the worker.
+        self._db = sqlite3.connect(path, timeout=600, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS digests ("
+                         "digest TEXT, version TEXT, output TEXT, status TEXT, "
+                         "PRIMARY KEY (digest, version))")
+
+    def claim(self, digest: str, version: str,
+              output_path: str) -> Optional[tuple[str, str]]:
+        """Returns None if the caller should extract the file.
+
+        Otherwise returns the (output path, status) of the file that already
+        has this digest.
+
+        """
+        output = os.path.relpath(output_path, self.root)
+        cur = self._db.execute("INSERT OR IGNORE INTO digests VALUES (?, ?, ?, ?)",
+                               (digest, version, output, self.PENDING))
+        if cur.rowcount == 1:
+            return None
+
+        row = self._db.execute("SELECT output, status FROM digests "
+                               "WHERE digest = ? AND version = ?", (digest, version)).fetchone()
+        if row is None:
+            # Released in the meantime, try again.
+            return self.claim(digest, version, output_path)
+
+        if row[0] == output:
+            # Our own claim, from a run that didn't get to finish the file.
+            return None
+
+        return os.path.join(self.root, row[0]), row[1]
+
+    def complete(self, digest: str, version: str) -> None:
+        self._db.execute("UPDATE digests SET status = ? WHERE digest = ? AND version = ?",
+                         (self.DONE, digest, version))
+
+    def release(self, digest: str, version: str, output_path: str) -> None:
+        output = os.path.relpath(output_path, self.root)
+        self._db.execute("DELETE FROM digests WHERE digest = ? AND version = ? AND output = ?",
+                         (digest, version, output))
+
+    def release_pending(self) -> int:
+        """Drops the claims left behind by workers that died mid-extraction."""
+        return self._db.execute("DELETE FROM digests WHERE status = ?", (self.PENDING,)).rowcount
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,31 @@
+"""Progress of the current task, reported to the supervisor of the worker.
+
+Kept apart from textit.supervisor, so that the code that runs in the workers
+(e.g. the extractors) can report what it's doing without depending on it.
+The supervisor connects its worker processes; elsewhere ``report`` is a
+no-op.
+
+"""
+import threading
+from typing import Any
+
+# Connection to the parent, in the worker processes.
+_conn = None
+_conn_lock = threading.Lock()
+
+
+def connect(conn) -> None:
+    global _conn
+    _conn = conn
+
+
+def send(message) -> None:
+    with _conn_lock:
+        _conn.send(message)
+
+
+def report(event: str, value: Any = None) -> None:
+    """Tells the supervisor about the progress of the current task (no-op
+    outside of supervised workers)."""
+    if _conn is not None:
+        send(("event", event, value))
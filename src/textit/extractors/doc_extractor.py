@@ -9,6 +9,8 @@ import tempfile
 import shutil
 #doc_lock = Lock()
 
+HANDLER_VERSION = "1"
+
 def doc_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]], Metadata]:
     try:
         # Sadly we can only process one doc at a time
@@ -7,17 +7,33 @@ from ebooklib import epub
 
 from trafilatura import extract
 
-def epub_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]], Metadata]:
+HANDLER_VERSION = "1"
+
+def epub_handler(file_path: str, metadata: Metadata,
+                 max_chapters=None) -> tuple[Result[List[str]], Metadata]:
+    """With ``max_chapters``, only the first documents of the book that have
+    some text are extracted (a preview)."""
     try:
         book = epub.read_epub(file_path)
         content = ""
 
-        for item in book.get_items():
-            if item is not None and item.get_type() == ebooklib.ITEM_DOCUMENT:
-                body_content = item.get_body_content().decode()
-                text = extract(body_content)
-                if text is not None:
-                    content += text
+        documents = [item for item in book.get_items()
+                     if item is not None and item.get_type() == ebooklib.ITEM_DOCUMENT]
+        chapters = 0
+        read = 0
+        for item in documents:
+            if max_chapters is not None and chapters >= max_chapters:
+                break
+            read += len(item.get_content())
+            text = extract(item.get_body_content().decode())
+            if text is not None:
+                content += text
+                chapters += 1
+
+        if max_chapters is not None:
+            # Sizes of the archive entries, the others aren't parsed.
+            total = sum(len(item.get_content()) for item in documents)
+            metadata.preview_fraction = read / total if total else 1.0
         return Result.ok([content]), metadata
     except Exception as e:
         estr = format_exception(e)
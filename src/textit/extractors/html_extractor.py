@@ -1,13 +1,29 @@
+import codecs
+import os
 from typing import List
 from textit.metadata import Metadata
 from textit.helpers import Result, format_exception
 
 from trafilatura import extract
 
-def html_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]], Metadata]:
+HANDLER_VERSION = "1"
+
+def html_handler(file_path: str, metadata: Metadata,
+                 max_bytes=None) -> tuple[Result[List[str]], Metadata]:
+    """With ``max_bytes``, only the beginning of the page is extracted (a
+    preview)."""
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            extracted_text = extract(f.read())
+        if max_bytes is None:
+            with open(file_path, 'r', encoding='utf-8') as f:
+                extracted_text = extract(f.read())
+        else:
+            with open(file_path, 'rb') as f:
+                metadata.preview_fraction = min(1.0, max_bytes / max(os.fstat(f.fileno()).st_size, 1))
+                head = f.read(max_bytes)
+            # Leaves out a character cut in the middle.
+            html = codecs.getincrementaldecoder("utf-8")().decode(head)
+            # Same newline translation as reading the file in text mode.
+            extracted_text = extract(html.replace("\r\n", "\n").replace("\r", "\n"))
 
         #print(extracted_text)
         return (Result.ok([extracted_text]), metadata)
@@ -15,3 +31,21 @@ def html_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]],
         estr = format_exception(e)
         return (Result.err(f"Error extracting text from HTML at '{file_path}':{estr}"), metadata)
 
+
+def html_buffer_handler(buffer, file_path: str, metadata: Metadata,
+                        max_bytes=None) -> tuple[Result[List[str]], Metadata]:
+    """Same as html_handler(), for contents that are already in memory."""
+    try:
+        if max_bytes is None:
+            html = str(buffer, "utf-8")
+        else:
+            metadata.preview_fraction = min(1.0, max_bytes / max(len(buffer), 1))
+            # Leaves out a character cut in the middle.
+            html = codecs.getincrementaldecoder("utf-8")().decode(buffer[:max_bytes])
+        # Same newline translation as reading the file in text mode.
+        html = html.replace("\r\n", "\n").replace("\r", "\n")
+        extracted_text = extract(html)
+        return (Result.ok([extracted_text]), metadata)
+    except Exception as e:
+        estr = format_exception(e)
+        return (Result.err(f"Error extracting text from HTML at '{file_path}':{estr}"), metadata)
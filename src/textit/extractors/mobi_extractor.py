@@ -2,12 +2,12 @@ from typing import List
 from textit.metadata import Metadata
 from textit.helpers import Result, format_exception
 
+import re
 import tempfile
 import shutil
 import mobi
 from trafilatura import extract
 
-import re
 
 def split_text_into_chunks(text, target_word_count=500):
     # Split the text into sentences
@@ -36,7 +36,33 @@ def split_text_into_chunks(text, target_word_count=500):
 
     return chunks
 
-def mobi_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]], Metadata]:
+HANDLER_VERSION = "1"
+
+PAGEBREAK = re.compile(r"<mbp:pagebreak\s*/?>", re.IGNORECASE)
+
+
+def extract_chapters(html: str, max_chapters: int, metadata: Metadata):
+    """Text of the first ``max_chapters`` parts of the book (between page
+    breaks) that have some."""
+    texts = []
+    read = 0
+    for part in PAGEBREAK.split(html):
+        if len(texts) >= max_chapters:
+            break
+        read += len(part)
+        text = extract(part)
+        if text:
+            texts.append(text)
+
+    metadata.preview_fraction = read / len(html) if html else 1.0
+    return "\n".join(texts) if texts else None
+
+
+def mobi_handler(file_path: str, metadata: Metadata, max_chapters=None,
+                 chunk_words=500) -> tuple[Result[List[str]], Metadata]:
+    """The text in chunks of about ``chunk_words`` words, or whole with None
+    (when the pipeline segments it). With ``max_chapters``, only the first
+    chapters are extracted (a preview)."""
     try:
         # Create a temporary folder for unpacking
         temp_folder = tempfile.mkdtemp()
@@ -47,10 +73,17 @@ def mobi_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]],
 
         if html_file:
             with open(html_file, 'r', encoding='utf-8') as f:
-                text_content = extract(f.read())
+                html = f.read()
+            if max_chapters is None:
+                text_content = extract(html)
+            else:
+                text_content = extract_chapters(html, max_chapters, metadata)
 
             if text_content is not None:
-                extracted_text = split_text_into_chunks(text_content)
+                if chunk_words is None:
+                    extracted_text = [text_content]
+                else:
+                    extracted_text = split_text_into_chunks(text_content, chunk_words)
                 # Clean up the temporary folder
                 shutil.rmtree(temp_folder)
                 return Result.ok(extracted_text), metadata
@@ -13,14 +13,18 @@ import os
 import re
 import string
 import ocrmypdf
+import pikepdf
 import itertools
 import tempfile
 import logging
 import traceback
 import subprocess
+import ctypes
 
 from textit.metadata import Metadata
 from textit.helpers import Result, format_exception, getLogger
+from textit.instrumentation import timed, timer
+from textit.events import report
 
 
 
@@ -30,6 +34,9 @@ logger = getLogger()
 # try.
 CLUSTERING_THRESHOLD = 4000
 
+# Pages extracted between two page checkpoints.
+CHECKPOINT_PAGES = 16
+
 # Characters that are "OK" to be extracted from a Romanian text.
 # XXX Besides the obvious ones, the rest are added based on observations on
 # arbitrary (manually selected) samples.
@@ -270,6 +277,7 @@ class Page(object):
 
             raise e
 
+    @timed("pdf.layout")
     def _perform_dbscan(self):
         distances = pairwise_distances(self.bboxes, metric=rectangle_distance)
         db = DBSCAN(eps=self.eps, min_samples=1, metric='precomputed').fit(distances)
@@ -316,10 +324,27 @@ class Page(object):
 
 
 class PdfProcessor(object):
-    def __init__(self, pdf_path, page_range=None):
+    def __init__(self, pdf_path, page_range=None, pdf_data=None, checkpoint=None, ocr=False,
+                 max_pages=None):
+        """If given, ``pdf_data`` (bytes or a ctypes array) is read instead of the file.
+
+        With ``max_pages``, at most that many pages of the range are read,
+        spread over it.
+
+        Pages found in ``checkpoint`` (a page_checkpoints.DocumentCheckpoint,
+        with results of the same kind: OCR-ed or not) aren't extracted again,
+        and the others are saved to it every CHECKPOINT_PAGES pages (and
+        the rest at the end).
+
+        """
         self.pdf_path = pdf_path
+        self._pdf_data = pdf_data
+        self._checkpoint = checkpoint
+        self._ocr = ocr
+        self._max_pages = max_pages
         self._pdf = None
         self._page_range = page_range
+        self._page_count = None
         self._pages = None
         self._broken = None
         self._contents = None
@@ -329,6 +354,10 @@ class PdfProcessor(object):
         """Idempotent function."""
         def fix_page_range():
             step = 1
+            if isinstance(self._page_range, list):
+                # Pages picked one by one, e.g. those missing from a checkpoint.
+                self._page_range = [i for i in self._page_range if 0 <= i < self._page_count]
+                return
             if self._page_range is None:
                 start, stop = 0, self._page_count
             else:
@@ -343,11 +372,18 @@ class PdfProcessor(object):
                 stop = clamp(stop, 0, self._page_count - 1)
 
             self._page_range = range(start, stop, step)
+            if self._max_pages is not None and len(self._page_range) > self._max_pages:
+                n = len(self._page_range)
+                self._page_range = [self._page_range[i * n // self._max_pages]
+                                    for i in range(self._max_pages)]
 
         if self._pdf is None:
-            self._pdf = pypdfium2.PdfDocument(self.pdf_path)
-            self._page_count = len(self._pdf)
-            fix_page_range()
+            pdf_input = self.pdf_path if self._pdf_data is None else self._pdf_data
+            self._pdf = pypdfium2.PdfDocument(pdf_input)
+            if self._page_count is None:
+                # Not again when reopened after close(), the range is fixed.
+                self._page_count = len(self._pdf)
+                fix_page_range()
 
             self._pages = []
             for i in self._page_range:
@@ -360,11 +396,44 @@ class PdfProcessor(object):
 
         return self._pages
 
+    def page_count(self):
+        self.get_pages()
+        return self._page_count
+
+    def is_encrypted(self):
+        """Whether the document has a security handler; pdfium opens those
+        without a user password, but ocrmypdf refuses them."""
+        self.get_pages()
+        return pypdfium2.raw.FPDF_GetSecurityHandlerRevision(self._pdf.raw) != -1
+
+    def close(self):
+        """Releases the document (and the buffer it was read from, if any)."""
+        if self._pdf is not None:
+            self._pdf.close()
+            self._pdf = None
+        self._pages = None
+        self._pdf_data = None
+
     def get_contents(self):
         if self._contents is None:
+            done = {} if self._checkpoint is None else self._checkpoint.load(self._ocr)
+            pending = {}
             self._contents = []
             for page in self.get_pages():
-                self._contents.append((page.pnumber, page.get_size(), page.get_line_boxes()))
+                if page.pnumber in done:
+                    self._contents.append(done[page.pnumber])
+                    continue
+
+                contents = (page.pnumber, page.get_size(), page.get_line_boxes())
+                self._contents.append(contents)
+                if self._checkpoint is not None:
+                    pending[page.pnumber] = contents
+                    if len(pending) >= CHECKPOINT_PAGES:
+                        self._checkpoint.save(pending, self._ocr)
+                        pending = {}
+            if self._checkpoint is not None:
+                # The rest too, the processing of the text may still time out.
+                self._checkpoint.save(pending, self._ocr)
 
         return self._contents
 
@@ -389,58 +458,128 @@ class PdfProcessor(object):
         return self._broken
 
 
-def apply_ocr(pdf_path, page_range=None):
-    with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_output:
-        temp_output_path = temp_output.name
-        try:
-            ocrmypdf.ocr(pdf_path, temp_output_path, l='ron',
+def run_ocrmypdf(pdf_path, output_path, pages=None):
+    """``pages`` (0-based) limits the OCR to them, the others are copied as they are."""
+    if pages is not None:
+        pages = ",".join(str(i + 1) for i in pages)
+    try:
+        ocrmypdf.ocr(pdf_path, output_path, l='ron',
+                     invalidate_digital_signatures=True,
+                     force_ocr=True,
+                     progress_bar=False,
+                     deskew=True,
+                     max_image_mpixels=900,
+                     pages=pages,
+                     )
+    except ocrmypdf.exceptions.SubprocessOutputError as e:
+        _, _, fname, _ = traceback.extract_tb(e.__traceback__)[-1]
+        logger.warning(f"FUNCTION {fname} FAILED!")
+        if fname == "get_deskew":
+            ocrmypdf.ocr(pdf_path, output_path, l='ron',
                          invalidate_digital_signatures=True,
                          force_ocr=True,
                          progress_bar=False,
-                         deskew=True,
+                         deskew=False,
                          max_image_mpixels=900,
+                         pages=pages,
                          )
-        except ocrmypdf.exceptions.SubprocessOutputError as e:
-            _, _, fname, _ = traceback.extract_tb(e.__traceback__)[-1]
-            logger.warning(f"FUNCTION {fname} FAILED!")
-            if fname == "get_deskew":
-                ocrmypdf.ocr(pdf_path, temp_output_path, l='ron',
-                             invalidate_digital_signatures=True,
-                             force_ocr=True,
-                             progress_bar=False,
-                             deskew=False,
-                             max_image_mpixels=900,
-                             )
-            else:
-                raise e
+        else:
+            raise e
 
-        proc = PdfProcessor(temp_output_path, page_range)
 
+@timed("pdf.ocr")
+def apply_ocr(pdf_path, temp_dir, page_range=None, checkpoint=None):
+    """The OCR-ed PDF is written to ``temp_dir``, which the caller removes."""
+    if checkpoint is None:
+        temp_output_path = os.path.join(temp_dir, "ocr.pdf")
+        # Pages picked one by one (a preview) are the only ones OCR-ed.
+        run_ocrmypdf(pdf_path, temp_output_path,
+                     page_range if isinstance(page_range, list) else None)
+        return PdfProcessor(temp_output_path, page_range)
+
+    # Only the pages missing from the checkpoint are OCR-ed, in one call
+    # (ocrmypdf runs them in parallel), and saved as they are read.
+    proc = PdfProcessor(pdf_path, page_range, checkpoint=checkpoint, ocr=True)
+    done = checkpoint.load(ocr=True)
+    missing = [page.pnumber for page in proc.get_pages() if page.pnumber not in done]
+    proc.close()
+    if done:
+        logger.info(f"Resuming the OCR of '{pdf_path}' with {len(done)} pages done, "
+                    f"{len(missing)} left")
+    if missing:
+        temp_output_path = os.path.join(temp_dir, "ocr-missing.pdf")
+        run_ocrmypdf(pdf_path, temp_output_path, missing)
+        missing_proc = PdfProcessor(temp_output_path, missing, checkpoint=checkpoint, ocr=True)
+        try:
+            missing_proc.get_contents()
+        finally:
+            missing_proc.close()
+            os.remove(temp_output_path)
+
+    # Only reads the checkpoint now.
     return proc
 
 
 def decrypt_pdf(inpath, outpath):
-    subprocess.run(["qpdf", "--decrypt", inpath, outpath])
-
-
-def process_pdf(pdf_path, page_range=None):
-    proc = PdfProcessor(pdf_path, page_range)
+    """Removes the encryption of a PDF that opens without a user password:
+    in-process with pikepdf, or with qpdf if pikepdf can't do it."""
+    try:
+        with pikepdf.open(inpath) as pdf:
+            # Saved without encryption unless asked for.
+            pdf.save(outpath)
+    except pikepdf.PdfError as e:
+        logger.warning(f"pikepdf couldn't decrypt '{inpath}' ({e}), trying qpdf")
+        # 3 means that it succeeded with warnings.
+        result = subprocess.run(["qpdf", "--decrypt", inpath, outpath],
+                                stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode not in (0, 3):
+            raise RuntimeError(f"qpdf --decrypt failed with exit code {result.returncode}: "
+                               f"{result.stderr.decode('utf-8', 'replace').strip()}")
+
+
+@timed("pdf.process")
+def process_pdf(pdf_path, temp_dir, page_range=None, pdf_data=None, checkpoint=None,
+                max_pages=None):
+    """Temporary files (decrypted copy, OCR output) go to ``temp_dir``,
+    which has to outlive the returned processor."""
+    proc = PdfProcessor(pdf_path, page_range, pdf_data, checkpoint, max_pages=max_pages)
     procmeta = {}
+    if max_pages is not None:
+        # The decrypted or OCR-ed document gets the same pages.
+        page_range = [page.pnumber for page in proc.get_pages()]
+        procmeta["preview_fraction"] = len(page_range) / max(proc.page_count(), 1)
+    if pdf_data is not None and not os.path.exists(pdf_path) and \
+            (proc.is_encrypted() or proc.broken_pdf()):
+        # Only in memory (an archive member), the tools need a file.
+        pdf_path = os.path.join(temp_dir, "input.pdf")
+        with open(pdf_path, "wb") as f:
+            f.write(pdf_data)
+    if proc.is_encrypted():
+        # Decrypt first, then judge the text layer of the decrypted document:
+        # it's often fine, and ocrmypdf only takes decrypted documents anyway.
+        logger.info("Encrypted pdf detected, decrypting it.")
+        procmeta["decrypted"] = True
+        proc.close()
+        encrypted_path, pdf_path = pdf_path, os.path.join(temp_dir, "decrypted.pdf")
+        with timer("pdf.decrypt"):
+            decrypt_pdf(encrypted_path, pdf_path)
+        proc = PdfProcessor(pdf_path, page_range, checkpoint=checkpoint)
+
     if proc.broken_pdf():
         logger.info("Broken pdf detected, trying to OCR it.")
         procmeta["ocr"] = True
+        report("ocr")
+        proc.close()
         try:
-            proc = apply_ocr(pdf_path, page_range)
-            logger.info(f"Processed non-broken PDF '{pdf_path}'")
+            proc = apply_ocr(pdf_path, temp_dir, page_range, checkpoint)
         except ocrmypdf.exceptions.EncryptedPdfError:
+            # Encrypted in a way that pdfium doesn't report.
+            logger.info("Encrypted pdf detected by ocrmypdf, decrypting it.")
             procmeta["decrypted"] = True
-            logger.info("Encrypted pdf detected, trying to decrypt it.")
-            with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_output:
-                temp_output_path = temp_output.name
-                decrypt_pdf(pdf_path, temp_output_path)
-                proc = apply_ocr(temp_output_path, page_range)
-
-            logger.info(f"Processed broken PDF '{pdf_path}'")
+            decrypted_path = os.path.join(temp_dir, "decrypted.pdf")
+            decrypt_pdf(pdf_path, decrypted_path)
+            proc = apply_ocr(decrypted_path, temp_dir, page_range, checkpoint)
+        logger.info(f"Processed broken PDF '{pdf_path}'")
 
     return proc, procmeta
 
@@ -560,10 +699,49 @@ def line_cleaner(doc_info):
     return text.splitlines()
 
 
-def pdf_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]], Metadata]:
+# Bump whenever the handler output changes; cached raw extractions of
+# older versions are then ignored.
+HANDLER_VERSION = "2"
+
+def pdf_handler(file_path: str, metadata: Metadata, checkpoints=None,
+                max_pages=None) -> tuple[Result[List[str]], Metadata]:
+    """Options (see TextExtractor.set_handler_options):
+
+    - ``checkpoints``: a page_checkpoints.PageCheckpoints, where the pages
+      of the document are checkpointed under ``metadata.digest``;
+    - ``max_pages``: only extract that many pages, spread over the
+      document (a preview).
+
+    """
+    return _pdf_handler(file_path, metadata, checkpoints=checkpoints, max_pages=max_pages)
+
+
+def pdf_buffer_handler(buffer, file_path: str, metadata: Metadata, checkpoints=None,
+                       max_pages=None) -> tuple[Result[List[str]], Metadata]:
+    """Reads the PDF from memory; the path is only needed if it has to be OCR-ed."""
+    if isinstance(buffer, bytes):
+        pdf_data = buffer
+    else:
+        try:
+            # No copy for writable buffers (e.g. a copy-on-write mmap).
+            pdf_data = (ctypes.c_char * len(buffer)).from_buffer(buffer)
+        except TypeError:
+            pdf_data = bytes(buffer)
+
+    return _pdf_handler(file_path, metadata, pdf_data, checkpoints, max_pages)
+
+
+def _pdf_handler(file_path: str, metadata: Metadata, pdf_data=None, checkpoints=None,
+                 max_pages=None) -> tuple[Result[List[str]], Metadata]:
     # ocrmypdf.configure_logging(ocrmypdf.Verbosity.quiet)
+    proc = None
+    checkpoint = None
+    if checkpoints is not None and metadata.digest is not None:
+        checkpoint = checkpoints.document(metadata.digest, HANDLER_VERSION)
+    temp_dir = tempfile.TemporaryDirectory(prefix="pdf-")
     try:
-        proc, procmeta = process_pdf(file_path)
+        proc, procmeta = process_pdf(file_path, temp_dir.name, pdf_data=pdf_data,
+                                     checkpoint=checkpoint, max_pages=max_pages)
         for k, v in procmeta.items():
             setattr(metadata, k, v)
 
@@ -582,6 +760,10 @@ def pdf_handler(file_path: str, metadata: Metadata) -> tuple[Result[List[str]],
 
         estr = format_exception(e)
         return (Result.err(f"Error extracting text from PDF at '{file_path}':{estr}"), metadata)
+    finally:
+        if proc is not None:
+            proc.close()
+        temp_dir.cleanup()
 
 
 if __name__ == "__main__":
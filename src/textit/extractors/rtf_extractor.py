@@ -0,0 +1,331 @@
+"""RTF text extraction, without LibreOffice.
+
+A streaming tokenizer: the document is read in chunks, binary data (``\\bin``)
+and the groups without text (pictures, font, color and style tables,
+document info, headers and footers, ``\\*`` destinations) are skipped as they
+are read, and the text is decoded (the code page of the document or of the
+current font for ``\\'hh`` bytes, ``\\uN`` escapes) and emitted a paragraph at
+a time.
+
+"""
+import codecs
+import functools
+import itertools
+import os
+import re
+from typing import Iterable, Iterator, List, Optional
+
+from textit.metadata import Metadata
+from textit.helpers import Result, format_exception
+from textit.sniff import rtf_start
+
+HANDLER_VERSION = "1"
+
+CHUNK_SIZE = 2 ** 16
+
+# Longer than any token but text, which may be cut anywhere.
+MAX_TOKEN = 64
+
+TOKEN = re.compile(rb"\\([a-zA-Z]{1,32})(-?[0-9]{1,10})? ?"
+                   rb"|\\'([0-9a-fA-F]{2})"
+                   rb"|\\([^a-zA-Z])"
+                   rb"|([{}])"
+                   rb"|[\r\n]+"
+                   rb"|([^\\{}\r\n]+)")
+
+WORD, HEX, SYMBOL, GROUP_START, GROUP_END, TEXT = range(6)
+
+# \fcharset -> code page; the others (0 ANSI, 1 default, 2 symbol) use
+# that of the document.
+CHARSETS = {77: "mac_roman", 128: "cp932", 129: "cp949", 130: "cp1361", 134: "cp936",
+            136: "cp950", 161: "cp1253", 162: "cp1254", 163: "cp1258", 177: "cp1255",
+            178: "cp1256", 186: "cp1257", 204: "cp1251", 222: "cp874", 238: "cp1250",
+            255: "cp437"}
+
+# Destinations whose text isn't part of the body.
+SKIP_DESTINATIONS = {
+    "annotation", "atnauthor", "atnid", "author", "colortbl", "comment", "datastore",
+    "doccomm", "fldinst", "footer", "footerf", "footerl", "footerr", "footnote",
+    "header", "headerf", "headerl", "headerr", "info", "keywords", "latentstyles",
+    "listoverridetable", "listtable", "listtext", "nonshppict", "objdata", "operator",
+    "pict", "pn", "pntext", "private", "revtbl", "rsidtbl", "rxe", "shpinst",
+    "stylesheet", "subject", "tc", "template", "themedata", "title", "txe", "xe",
+    "xmlnstbl",
+}
+
+PARAGRAPH_ENDS = {"par", "sect", "page", "row"}
+
+CHARACTERS = {
+    "line": "\n", "tab": "\t", "cell": "\t", "nestcell": "\t",
+    "emdash": "\u2014", "endash": "\u2013", "emspace": "\u2003", "enspace": "\u2002",
+    "qmspace": "\u2005", "bullet": "\u2022", "lquote": "\u2018", "rquote": "\u2019",
+    "ldblquote": "\u201c", "rdblquote": "\u201d", "zwj": "\u200d", "zwnj": "\u200c",
+}
+
+SYMBOLS = {b"\\": "\\", b"{": "{", b"}": "}", b"~": "\u00a0", b"_": "\u2011", b"\t": "\t"}
+
+
+@functools.lru_cache(maxsize=None)
+def _codec(name: str) -> str:
+    try:
+        return codecs.lookup(name).name
+    except LookupError:
+        return "cp1252"
+
+
+def tokenize(chunks: Iterable[bytes]) -> Iterator[tuple]:
+    """Yields (kind, value, parameter) tokens; the data of ``\\bin`` is
+    skipped, without being kept in memory."""
+    chunks = iter(chunks)
+    data = b""
+    pos = 0
+    eof = False
+    while True:
+        if not eof and len(data) - pos < MAX_TOKEN:
+            chunk = next(chunks, None)
+            if chunk is None:
+                eof = True
+            else:
+                data = data[pos:] + chunk
+                pos = 0
+            continue
+        if pos >= len(data):
+            return
+
+        m = TOKEN.match(data, pos)
+        if m is None:
+            # A backslash at the very end.
+            pos += 1
+            continue
+        pos = m.end()
+        word, parameter, hex_byte, symbol, brace, text = m.groups()
+        if word is not None:
+            parameter = int(parameter) if parameter is not None else None
+            if word == b"bin" and parameter:
+                remaining = parameter
+                while remaining > len(data) - pos:
+                    remaining -= len(data) - pos
+                    data = next(chunks, b"")
+                    pos = 0
+                    if not data:
+                        eof = True
+                        break
+                else:
+                    pos += remaining
+            yield WORD, word.decode("ascii"), parameter
+        elif text is not None:
+            yield TEXT, text, None
+        elif hex_byte is not None:
+            yield HEX, bytes.fromhex(hex_byte.decode("ascii")), None
+        elif symbol is not None:
+            yield SYMBOL, symbol, None
+        elif brace == b"{":
+            yield GROUP_START, None, None
+        elif brace == b"}":
+            yield GROUP_END, None, None
+
+
+class _State(object):
+    """Properties of a group, inherited by the groups in it."""
+    __slots__ = ("uc", "font", "skip", "fonttbl")
+
+    def __init__(self):
+        self.uc = 1
+        self.font = None
+        self.skip = False
+        self.fonttbl = False
+
+    def copy(self) -> "_State":
+        state = _State()
+        state.uc, state.font, state.skip, state.fonttbl = self.uc, self.font, self.skip, self.fonttbl
+        return state
+
+
+class _Parser(object):
+    def __init__(self):
+        self.state = _State()
+        self.stack = []
+        self.codepage = "cp1252"
+        self.default_font = None
+        # Font number -> code page, None for that of the document.
+        self.fonts = {}
+        self.font_entry = None
+        # Bytes (\'hh or 8-bit text) of the current run, decoded together so
+        # that double-byte code pages work.
+        self.pending = bytearray()
+        # Characters left to skip after a \uN (its fallback).
+        self.fallback = 0
+        self.parts = []
+        self.surrogates = False
+
+    def _flush_bytes(self) -> None:
+        if self.pending:
+            font = self.state.font if self.state.font is not None else self.default_font
+            codepage = self.fonts.get(font) or self.codepage
+            self.parts.append(self.pending.decode(codepage, "replace"))
+            self.pending.clear()
+
+    def _paragraph(self) -> str:
+        self._flush_bytes()
+        text = "".join(self.parts)
+        self.parts.clear()
+        if self.surrogates:
+            # \uN escapes of characters outside the BMP come in pairs.
+            text = text.encode("utf-16-le", "surrogatepass").decode("utf-16-le", "replace")
+            self.surrogates = False
+        return text.strip()
+
+    def _font_table_word(self, word: str, parameter: Optional[int]) -> None:
+        if word == "f":
+            self.font_entry = parameter
+        elif word == "fcharset":
+            self.fonts[self.font_entry] = CHARSETS.get(parameter)
+        elif word == "cpg" and parameter:
+            self.fonts[self.font_entry] = _codec(f"cp{parameter}")
+
+    def _word(self, word: str, parameter: Optional[int]) -> bool:
+        """Returns whether the word ends a paragraph."""
+        state = self.state
+        if state.fonttbl:
+            self._font_table_word(word, parameter)
+        elif word in PARAGRAPH_ENDS:
+            return True
+        elif word in CHARACTERS:
+            self.parts.append(CHARACTERS[word])
+        elif word == "u":
+            if parameter is not None:
+                # Signed 16-bit.
+                code = parameter % 65536
+                self.parts.append(chr(code))
+                self.surrogates |= 0xd800 <= code < 0xe000
+                self.fallback = state.uc
+        elif word == "uc":
+            state.uc = parameter if parameter is not None else 1
+        elif word == "f":
+            state.font = parameter
+        elif word in SKIP_DESTINATIONS:
+            state.skip = True
+        elif word == "fonttbl":
+            state.fonttbl = True
+        elif word == "ansicpg" and parameter:
+            self.codepage = _codec(f"cp{parameter}")
+        elif word == "mac":
+            self.codepage = "mac_roman"
+        elif word == "pc":
+            self.codepage = "cp437"
+        elif word == "pca":
+            self.codepage = "cp850"
+        elif word == "deff":
+            self.default_font = parameter
+        return False
+
+    def _symbol(self, symbol: bytes) -> bool:
+        """Returns whether the symbol ends a paragraph."""
+        if symbol in (b"\n", b"\r"):
+            return True
+        if symbol == b"*":
+            # Destinations that readers may ignore; we do.
+            self.state.skip = True
+        elif symbol in SYMBOLS:
+            self.parts.append(SYMBOLS[symbol])
+        # Optional hyphens (\-) and index entries (\:) are dropped.
+        return False
+
+    def parse(self, chunks: Iterable[bytes]) -> Iterator[str]:
+        for kind, value, parameter in tokenize(chunks):
+            if kind == GROUP_START:
+                self._flush_bytes()
+                self.stack.append(self.state)
+                self.state = self.state.copy()
+                self.fallback = 0
+                continue
+            if kind == GROUP_END:
+                self._flush_bytes()
+                if self.stack:
+                    self.state = self.stack.pop()
+                self.fallback = 0
+                continue
+            if self.state.skip:
+                continue
+
+            if self.fallback:
+                if kind == TEXT and len(value) > self.fallback:
+                    value = value[self.fallback:]
+                    self.fallback = 0
+                else:
+                    self.fallback -= len(value) if kind == TEXT else 1
+                    continue
+
+            if kind == TEXT or kind == HEX:
+                if not self.state.fonttbl:
+                    self.pending += value
+                continue
+
+            # The font (and so the code page) may change.
+            self._flush_bytes()
+            if kind == WORD:
+                end = self._word(value, parameter)
+            else:
+                end = self._symbol(value)
+            if end:
+                paragraph = self._paragraph()
+                if paragraph:
+                    yield paragraph
+
+        paragraph = self._paragraph()
+        if paragraph:
+            yield paragraph
+
+
+def iter_paragraphs(chunks: Iterable[bytes]) -> Iterator[str]:
+    """Paragraphs of the text of an RTF document, read as ``chunks``."""
+    return _Parser().parse(chunks)
+
+
+def _limit(chunks: Iterable[bytes], max_bytes: int) -> Iterator[bytes]:
+    for chunk in chunks:
+        if max_bytes <= 0:
+            return
+        yield chunk[:max_bytes]
+        max_bytes -= len(chunk)
+
+
+def _extract(chunks: Iterator[bytes], size: int, file_path: str, metadata: Metadata,
+             max_bytes=None) -> tuple[Result[List[str]], Metadata]:
+    first = next(chunks, b"")
+    start = rtf_start(first)
+    if start is None:
+        return Result.err(f"Not an RTF document: '{file_path}'"), metadata
+
+    chunks = itertools.chain([first[start:]], chunks)
+    if max_bytes is not None:
+        metadata.preview_fraction = min(1.0, max_bytes / max(size, 1))
+        chunks = _limit(chunks, max_bytes)
+    paragraphs = list(iter_paragraphs(chunks))
+    if not paragraphs:
+        return Result.err(f"Failed to extract any text from RTF at '{file_path}'"), metadata
+    return Result.ok(paragraphs), metadata
+
+
+def rtf_handler(file_path: str, metadata: Metadata,
+                max_bytes=None) -> tuple[Result[List[str]], Metadata]:
+    """One string per paragraph. With ``max_bytes``, only the beginning of
+    the document is extracted (a preview)."""
+    try:
+        with open(file_path, "rb") as f:
+            chunks = iter(functools.partial(f.read, CHUNK_SIZE), b"")
+            return _extract(chunks, os.fstat(f.fileno()).st_size, file_path, metadata, max_bytes)
+    except Exception as e:
+        estr = format_exception(e)
+        return Result.err(f"Error extracting text from RTF at '{file_path}':{estr}"), metadata
+
+
+def rtf_buffer_handler(buffer, file_path: str, metadata: Metadata,
+                       max_bytes=None) -> tuple[Result[List[str]], Metadata]:
+    """Same as rtf_handler(), for contents that are already in memory."""
+    try:
+        chunks = (bytes(buffer[i:i + CHUNK_SIZE]) for i in range(0, len(buffer), CHUNK_SIZE))
+        return _extract(chunks, len(buffer), file_path, metadata, max_bytes)
+    except Exception as e:
+        estr = format_exception(e)
+        return Result.err(f"Error extracting text from RTF at '{file_path}':{estr}"), metadata
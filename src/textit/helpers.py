@@ -1,9 +1,12 @@
 import logging
 import os
-from typing import Generic, TypeVar, Callable, Optional
+from typing import Generic, TypeVar, Callable, Optional, Iterable, Iterator, Any
 import traceback
 import sys
 import hashlib
+import mmap
+import gc
+from contextlib import contextmanager
 
 T = TypeVar('T')
 U = TypeVar('U')
@@ -55,6 +58,33 @@ def get_path_hash(input_path: str) -> str:
     return pathhash
 
 
+@contextmanager
+def map_file(path: str):
+    """Maps the whole file in memory (copy-on-write, so that it can be
+    wrapped by ctypes without copying); empty files give b""."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            yield b""
+            return
+
+        mapping = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+
+    try:
+        yield mapping
+    finally:
+        try:
+            mapping.close()
+        except BufferError:
+            # pypdfium2 documents and pages reference each other, so the
+            # views they hold are only released by the cycle collector.
+            gc.collect()
+            try:
+                mapping.close()
+            except BufferError:
+                getLogger().debug(f"Mapping of '{path}' still in use, not closing it")
+
+
 def get_all_files(path: str) -> list[str]:
     """Recursively returns all files from path."""
     filelist = []
@@ -66,6 +96,44 @@ def get_all_files(path: str) -> list[str]:
     return filelist
 
 
+def iter_files(path: str) -> Iterator[tuple[str, int]]:
+    """Lazily yields (path, size) for all files under path, like get_all_files()."""
+    stack = [path]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        elif entry.is_file():
+                            yield entry.path, entry.stat().st_size
+                    except OSError as e:
+                        getLogger().warning(f"Skipping '{entry.path}': {e}")
+        except OSError as e:
+            # Same as os.walk(), which ignores directories it can't list.
+            getLogger().warning(f"Can't list directory: {e}")
+
+
+def windowed_sort(items: Iterable[T], window: int, key: Callable[[T], Any]) -> Iterator[T]:
+    """Sorts consecutive windows of at most ``window`` items.
+
+    A bounded-memory replacement for sorted() when the input is too large (or
+    too slow to enumerate) to be sorted as a whole.
+
+    """
+    buffer = []
+    for item in items:
+        buffer.append(item)
+        if len(buffer) >= window:
+            buffer.sort(key=key)
+            yield from buffer
+            buffer = []
+
+    buffer.sort(key=key)
+    yield from buffer
+
+
 class Result(Generic[T]):
     def __init__(self, value: Optional[T], error: Optional[str]):
         self._value = value
@@ -0,0 +1,249 @@
+"""Stage timers and counters.
+
+Disabled by default, in which case ``timer`` returns a shared no-op context
+manager and ``timed`` functions are called directly, so the instrumented
+code costs a function call and a branch. Once ``enable``-d, every worker
+accumulates the stage times and counters of the document that it's working
+on (between ``start_document`` and ``document_stats``); the main process
+aggregates them in a ``RunStats``.
+
+"""
+import functools
+import math
+import os
+import threading
+import time
+from collections import Counter, defaultdict
+from typing import Any, Optional
+
+enabled = False
+
+_lock = threading.Lock()
+_timings: dict[str, float] = {}
+_counters: Counter = Counter()
+_attributes: dict[str, Any] = {}
+
+# Upper bounds (seconds) of the stage time histogram buckets.
+BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0, 30.0, 60.0, 300.0, 1800.0, math.inf)
+
+
+def enable() -> None:
+    global enabled
+    enabled = True
+
+
+class _NullTimer(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _Timer(object):
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        add_time(self.stage, time.perf_counter() - self.start)
+        return False
+
+
+_null_timer = _NullTimer()
+
+
+def timer(stage: str):
+    """Context manager adding its run time to ``stage``."""
+    return _Timer(stage) if enabled else _null_timer
+
+
+def timed(stage: str):
+    """Decorator timing every call of the function as ``stage``."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return func(*args, **kwargs)
+            with _Timer(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def add_time(stage: str, seconds: float) -> None:
+    # Per-line processors run in threads.
+    with _lock:
+        _timings[stage] = _timings.get(stage, 0.0) + seconds
+
+
+def count(name: str, n: int = 1) -> None:
+    if enabled:
+        with _lock:
+            _counters[name] += n
+
+
+def annotate(**attributes) -> None:
+    """Document properties used to break the run summary down (file type...)."""
+    if enabled:
+        _attributes.update(attributes)
+
+
+def start_document() -> None:
+    with _lock:
+        _timings.clear()
+        _counters.clear()
+        _attributes.clear()
+
+
+def document_timings() -> dict[str, float]:
+    with _lock:
+        return {stage: round(seconds, 6) for stage, seconds in _timings.items()}
+
+
+def document_stats() -> dict[str, Any]:
+    with _lock:
+        return {"timings": dict(_timings), "counters": dict(_counters),
+                "attributes": dict(_attributes), "worker": os.getpid()}
+
+
+class Histogram(object):
+    def __init__(self):
+        self.buckets = [0] * len(BUCKETS)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.buckets[i] += 1
+                break
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-th quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if seen >= rank:
+                return bound
+        return math.inf
+
+
+class RunStats(object):
+    """Aggregates the document_stats() of the tasks of a run."""
+    def __init__(self):
+        self.start = time.monotonic()
+        self.stages = defaultdict(Histogram)
+        self.worker_stages = defaultdict(lambda: defaultdict(Histogram))
+        self.statuses = Counter()
+        self.documents = Counter()
+        self.bytes = Counter()
+        self.seconds = Counter()
+        self.ocr = Counter()
+        self.drop_reasons = Counter()
+        self.counters = Counter()
+        self.worker_documents = Counter()
+        self.worker_seconds = Counter()
+
+    def add(self, status: str, duration: Optional[float], stats: Optional[dict[str, Any]]) -> None:
+        self.statuses[status] += 1
+        if not stats:
+            return
+
+        worker = stats["worker"]
+        attributes = stats["attributes"]
+        file_type = attributes.get("file_type") or "unknown"
+        duration = duration or 0.0
+        self.documents[file_type] += 1
+        self.seconds[file_type] += duration
+        self.bytes[file_type] += stats["counters"].get("bytes", 0)
+        if attributes.get("ocr"):
+            self.ocr[file_type] += 1
+        if attributes.get("drop_reason"):
+            self.drop_reasons[attributes["drop_reason"]] += 1
+        self.counters.update(stats["counters"])
+        self.worker_documents[worker] += 1
+        self.worker_seconds[worker] += duration
+        for stage, seconds in stats["timings"].items():
+            self.stages[stage].observe(seconds)
+            self.worker_stages[worker][stage].observe(seconds)
+
+    def summary(self) -> str:
+        elapsed = time.monotonic() - self.start
+        lines = [f"Wall time: {elapsed:.1f}s"]
+        for file_type, n in sorted(self.documents.items()):
+            mb = self.bytes[file_type] / 2 ** 20
+            lines.append(f"{file_type}: {n} documents, {mb:.1f} MB, {n / elapsed:.2f} docs/s, "
+                         f"{mb / elapsed:.2f} MB/s, {self.seconds[file_type] / n:.2f}s/doc, "
+                         f"OCR {self.ocr[file_type]} ({100 * self.ocr[file_type] / n:.1f}%)")
+        if self.drop_reasons:
+            reasons = ", ".join(f"{r}: {n}" for r, n in self.drop_reasons.most_common())
+            lines.append(f"Drop reasons: {reasons}")
+        for stage, hist in sorted(self.stages.items(), key=lambda e: -e[1].sum):
+            lines.append(f"Stage {stage}: {hist.sum:.2f}s total, {hist.sum / hist.count:.4f}s mean, "
+                         f"p50 <= {hist.quantile(0.5)}s, p95 <= {hist.quantile(0.95)}s "
+                         f"({hist.count} documents)")
+        for worker in sorted(self.worker_documents):
+            lines.append(f"Worker {worker}: {self.worker_documents[worker]} documents, "
+                         f"{self.worker_seconds[worker]:.1f}s busy "
+                         f"({100 * self.worker_seconds[worker] / elapsed:.1f}%)")
+
+        return "\n".join(lines)
+
+    def write_prometheus(self, path: str) -> None:
+        """Writes the metrics in the Prometheus text format (for the
+        node_exporter textfile collector), atomically."""
+        lines = []
+
+        def metric(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def histogram(name, hist, labels):
+            cumulative = 0
+            for bound, n in zip(BUCKETS, hist.buckets):
+                cumulative += n
+                le = "+Inf" if bound == math.inf else repr(bound)
+                lines.append(f'{name}_bucket{{{labels},le="{le}"}} {cumulative}')
+            lines.append(f"{name}_sum{{{labels}}} {hist.sum}")
+            lines.append(f"{name}_count{{{labels}}} {hist.count}")
+
+        metric("textit_run_seconds", "gauge", "Wall time of the run")
+        lines.append(f"textit_run_seconds {time.monotonic() - self.start}")
+        metric("textit_tasks_total", "counter", "Tasks by final status")
+        for status, n in sorted(self.statuses.items()):
+            lines.append(f'textit_tasks_total{{status="{status}"}} {n}')
+        metric("textit_documents_total", "counter", "Documents by file type")
+        for file_type, n in sorted(self.documents.items()):
+            lines.append(f'textit_documents_total{{file_type="{file_type}"}} {n}')
+        metric("textit_input_bytes_total", "counter", "Input bytes by file type")
+        for file_type, n in sorted(self.bytes.items()):
+            lines.append(f'textit_input_bytes_total{{file_type="{file_type}"}} {n}')
+        metric("textit_ocr_documents_total", "counter", "Documents that needed OCR")
+        for file_type, n in sorted(self.ocr.items()):
+            lines.append(f'textit_ocr_documents_total{{file_type="{file_type}"}} {n}')
+        metric("textit_dropped_documents_total", "counter", "Dropped documents by reason")
+        for reason, n in sorted(self.drop_reasons.items()):
+            lines.append(f'textit_dropped_documents_total{{reason="{reason}"}} {n}')
+        metric("textit_stage_seconds", "histogram", "Time spent per document in each stage")
+        for stage, hist in sorted(self.stages.items()):
+            histogram("textit_stage_seconds", hist, f'stage="{stage}"')
+        metric("textit_worker_stage_seconds", "histogram", "Stage times per worker process")
+        for worker, stages in sorted(self.worker_stages.items()):
+            for stage, hist in sorted(stages.items()):
+                histogram("textit_worker_stage_seconds", hist, f'worker="{worker}",stage="{stage}"')
+        metric("textit_worker_busy_seconds_total", "counter", "Time spent on tasks per worker process")
+        for worker, seconds in sorted(self.worker_seconds.items()):
+            lines.append(f'textit_worker_busy_seconds_total{{worker="{worker}"}} {seconds}')
+
+        with open(path + ".tmp", "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.rename(path + ".tmp", path)
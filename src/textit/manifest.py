@@ -0,0 +1,164 @@
+import os
+import sqlite3
+import time
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+
+@dataclass
+class TaskRecord:
+    path_hash: str
+    input_path: str
+    # None if nothing was written (the worker died).
+    output_path: Optional[str]
+    status: str
+    digest: Optional[str] = None
+    duration: Optional[float] = None
+    predicted_cost: Optional[float] = None
+    # JSON, see scheduler.TaskFeatures.
+    features: Optional[str] = None
+    # Why the supervisor gave up on the task ("timeout" or "crash").
+    drop_reason: Optional[str] = None
+    # instrumentation.document_stats(), not stored.
+    stats: Optional[dict] = None
+    # preview.document_sample() in preview runs, not stored.
+    preview: Optional[dict] = None
+
+
+class RunManifest(object):
+    """Journal of the tasks of all the runs over an output directory.
+
+    Only the main process writes to it. Records are committed in batches, so
+    a crash loses at most the last ``batch_size`` of them (and those tasks
+    are simply done again).
+
+    """
+    def __init__(self, path: str, batch_size: int = 100):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = 0
+        self._db = sqlite3.connect(path, timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS tasks ("
+                         "path_hash TEXT PRIMARY KEY, input BLOB, output TEXT, status TEXT, "
+                         "digest TEXT, duration REAL, finished REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS tasks_status ON tasks (status)")
+        self._add_columns(predicted_cost="REAL", features="TEXT", drop_reason="TEXT")
+        # Runs whose records are all in the manifest.
+        self._db.execute("CREATE TABLE IF NOT EXISTS runs (run TEXT PRIMARY KEY, finished REAL)")
+        self._db.commit()
+
+    def _add_columns(self, **columns):
+        """Upgrades manifests written by older versions."""
+        existing = {row[1] for row in self._db.execute("PRAGMA table_info(tasks)")}
+        for name, sql_type in columns.items():
+            if name not in existing:
+                self._db.execute(f"ALTER TABLE tasks ADD COLUMN {name} {sql_type}")
+
+    def is_empty(self) -> bool:
+        return self._db.execute("SELECT 1 FROM tasks LIMIT 1").fetchone() is None
+
+    def record(self, task: TaskRecord) -> None:
+        # Paths aren't necessarily valid UTF-8, so keep their raw bytes.
+        self._db.execute("INSERT OR REPLACE INTO tasks (path_hash, input, output, status, digest, "
+                         "duration, finished, predicted_cost, features, drop_reason) "
+                         "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                         (task.path_hash, os.fsencode(task.input_path), task.output_path,
+                          task.status, task.digest, task.duration, time.time(),
+                          task.predicted_cost, task.features, task.drop_reason))
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.commit()
+
+    def record_all(self, tasks: Iterable[TaskRecord]) -> None:
+        for task in tasks:
+            self.record(task)
+        self.commit()
+
+    def commit(self) -> None:
+        self._db.commit()
+        self._pending = 0
+
+    def add_written(self, tasks: Iterable[TaskRecord]) -> int:
+        """Records tasks whose output was found written, unless they're
+        already recorded as done. Returns the number of tasks recorded."""
+        added = 0
+        for task in tasks:
+            cur = self._db.execute("INSERT INTO tasks (path_hash, input, output, status, digest, "
+                                   "finished) VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (path_hash) "
+                                   "DO UPDATE SET input = excluded.input, output = excluded.output, "
+                                   "status = excluded.status, digest = excluded.digest, "
+                                   "finished = excluded.finished, drop_reason = NULL "
+                                   "WHERE tasks.status NOT IN ('ok', 'duplicate')",
+                                   (task.path_hash, os.fsencode(task.input_path), task.output_path,
+                                    task.status, task.digest, time.time()))
+            added += cur.rowcount
+        self.commit()
+        return added
+
+    def finish_run(self, run: str) -> None:
+        self._db.execute("INSERT OR REPLACE INTO runs VALUES (?, ?)", (run, time.time()))
+        self.commit()
+
+    def finished_runs(self) -> set[str]:
+        return {row[0] for row in self._db.execute("SELECT run FROM runs")}
+
+    def done_hashes(self, retry: Iterable[str] = ()) -> set[str]:
+        """Path hashes of the tasks that don't need to run again."""
+        retry = list(retry)
+        placeholders = ", ".join("?" * len(retry))
+        rows = self._db.execute(f"SELECT path_hash FROM tasks WHERE status NOT IN ({placeholders})",
+                                retry)
+        return {row[0] for row in rows}
+
+    def finished_tasks(self) -> Iterator[tuple[str, str, str]]:
+        """(path hash, input path, digest) of the tasks that ended "ok"."""
+        # On a connection of its own, so that recording tasks while going
+        # through them doesn't disturb the query.
+        db = sqlite3.connect(self.path, timeout=600)
+        try:
+            rows = db.execute("SELECT path_hash, input, digest FROM tasks "
+                              "WHERE status = 'ok' AND digest IS NOT NULL")
+            for path_hash, input_path, digest in rows:
+                yield path_hash, os.fsdecode(input_path), digest
+        finally:
+            db.close()
+
+    def merge(self, path: str) -> int:
+        """Adds the tasks of another manifest (of another node), keeping the
+        latest record of the tasks that both have.
+
+        Returns the number of tasks added or updated.
+
+        """
+        # Upgrades it to the same columns.
+        RunManifest(path).close()
+        self.commit()
+        columns = ("path_hash, input, output, status, digest, duration, finished, "
+                   "predicted_cost, features, drop_reason")
+        updates = ", ".join(f"{c} = excluded.{c}" for c in columns.split(", ")[1:])
+        self._db.execute("ATTACH DATABASE ? AS other", (path,))
+        try:
+            # "WHERE true" disambiguates the upsert from a join.
+            cur = self._db.execute(f"INSERT INTO tasks ({columns}) SELECT {columns} FROM other.tasks "
+                                   f"WHERE true ON CONFLICT (path_hash) DO UPDATE SET {updates} "
+                                   f"WHERE excluded.finished > tasks.finished")
+            merged = cur.rowcount
+            self._db.commit()
+        finally:
+            self._db.execute("DETACH DATABASE other")
+        return merged
+
+    def cost_samples(self) -> Iterator[tuple[str, float, float]]:
+        """(features, predicted cost, actual duration) of the finished tasks."""
+        rows = self._db.execute("SELECT features, predicted_cost, duration FROM tasks "
+                                "WHERE status = 'ok' AND features IS NOT NULL")
+        yield from rows
+
+    def status_counts(self) -> dict[str, int]:
+        rows = self._db.execute("SELECT status, COUNT(*) FROM tasks GROUP BY status")
+        return dict(rows.fetchall())
+
+    def close(self) -> None:
+        self.commit()
+        self._db.close()
@@ -30,6 +30,12 @@ class Metadata:
     original_nlines: Optional[int] = 0
     version: Optional[str] = None
     drop_reason: Optional[str] = None
+    boilerplate_lines: Optional[int] = None
+    near_duplicate_of: Optional[str] = None
+    near_duplicate_similarity: Optional[float] = None
+    duplicate_of: Optional[str] = None
+    # Seconds per stage, when instrumentation is enabled.
+    timings: Optional[dict] = None
 
     def __repr__(self):
         """For dynamically added class members."""
@@ -0,0 +1,66 @@
+import json
+import sqlite3
+import zlib
+from typing import Any, Dict
+
+
+class PageCheckpoints(object):
+    """Per-page results of documents that are still being extracted, keyed
+    by file digest and page number.
+
+    A worker that dies (or is killed) in the middle of a long document
+    leaves the pages it finished behind, and the next attempt only extracts
+    the others. Pages are stored as zlib-compressed JSON, with the handler
+    version and whether they were OCR-ed; the checkpoints of a document are
+    removed once its record is written.
+
+    """
+    def __init__(self, path: str, level: int = 6):
+        self.path = path
+        self.level = level
+        # Also used from the writer thread of the worker.
+        self._db = sqlite3.connect(path, timeout=600, isolation_level=None,
+                                   check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS pages ("
+                         "digest TEXT, page INTEGER, handler_version TEXT, ocr INTEGER, "
+                         "contents BLOB, PRIMARY KEY (digest, page))")
+
+    def get(self, digest: str, handler_version: str, ocr: bool) -> Dict[int, Any]:
+        """Contents of the pages of the document found, by page number."""
+        rows = self._db.execute("SELECT page, contents FROM pages WHERE digest = ? AND "
+                                "handler_version = ? AND ocr = ?",
+                                (digest, handler_version, int(ocr)))
+        return {page: json.loads(zlib.decompress(contents)) for page, contents in rows}
+
+    def put(self, digest: str, handler_version: str, ocr: bool, pages: Dict[int, Any]) -> None:
+        rows = [(digest, page, handler_version, int(ocr),
+                 zlib.compress(json.dumps(contents).encode("utf-8"), self.level))
+                for page, contents in pages.items()]
+        self._db.executemany("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)", rows)
+
+    def remove(self, digest: str) -> None:
+        # Most documents have none, don't take the write lock for them.
+        if self._db.execute("SELECT 1 FROM pages WHERE digest = ? LIMIT 1", (digest,)).fetchone():
+            self._db.execute("DELETE FROM pages WHERE digest = ?", (digest,))
+
+    def document(self, digest: str, handler_version: str) -> "DocumentCheckpoint":
+        return DocumentCheckpoint(self, digest, handler_version)
+
+    def close(self):
+        self._db.close()
+
+
+class DocumentCheckpoint(object):
+    """The checkpoints of one document, as seen by its handler."""
+    def __init__(self, checkpoints: PageCheckpoints, digest: str, handler_version: str):
+        self.checkpoints = checkpoints
+        self.digest = digest
+        self.handler_version = handler_version
+
+    def load(self, ocr: bool = False) -> Dict[int, Any]:
+        return self.checkpoints.get(self.digest, self.handler_version, ocr)
+
+    def save(self, pages: Dict[int, Any], ocr: bool = False) -> None:
+        if pages:
+            self.checkpoints.put(self.digest, self.handler_version, ocr, pages)
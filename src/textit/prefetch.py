@@ -0,0 +1,147 @@
+"""I/O front end of the workers: reads, hashes and sniffs the next tasks.
+
+Runs in the main process, on a thread pool, between the ordering of the
+tasks and their dispatch. The digest and the file type are handed to the
+worker with the task, so that it doesn't compute them again. The contents of
+small files (up to ``inline_bytes``) go with the task too, and the worker
+doesn't open them at all. Bigger ones are left in the page cache, where the
+worker's own read (a mapping) finds them: the data crosses the disk or the
+network once (NFS clients serve it from their cache after checking that the
+file didn't change). At most ``depth`` tasks are read ahead, which also bounds
+what has to stay in the page cache until the workers get to it.
+
+Tasks are passed on as soon as they are read, in order, even while the next
+ones are still being produced (e.g. while a work queue waits for a batch).
+
+"""
+import hashlib
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Iterable, Iterator, Optional
+
+from textit.metadata import FileType
+from textit.sniff import get_file_type
+from textit.archives import split_member
+from textit.helpers import getLogger, format_exception
+
+CHUNK_SIZE = 2 ** 20
+
+# Files up to this size are handed to the worker with the task.
+INLINE_BYTES = 2 ** 20
+
+_END = object()
+
+# The file type wasn't sniffed by the scheduler.
+_UNKNOWN = object()
+
+
+@dataclass
+class Prefetched:
+    digest: str
+    file_type: Optional[FileType]
+    size: int
+    mtime_ns: int
+    # The contents of the file, if it's small.
+    data: Optional[bytes] = None
+
+    def matches(self, stat: os.stat_result) -> bool:
+        """Whether the file is still the one that was read."""
+        return stat.st_size == self.size and stat.st_mtime_ns == self.mtime_ns
+
+
+def prefetch_file(path: str, file_type=_UNKNOWN, inline_bytes: int = INLINE_BYTES) -> Prefetched:
+    sha1 = hashlib.sha1()
+    with open(path, "rb") as f:
+        stat = os.fstat(f.fileno())
+        data = None
+        if stat.st_size <= inline_bytes:
+            data = f.read()
+            sha1.update(data)
+            # Grew since the stat, hand over what was hashed anyway.
+            size = len(data)
+        else:
+            # hashlib releases the GIL, so the threads hash in parallel.
+            while chunk := f.read(CHUNK_SIZE):
+                sha1.update(chunk)
+            size = stat.st_size
+        if file_type is _UNKNOWN:
+            file_type = get_file_type(path, data) if data is not None else get_file_type(path, f)
+
+    return Prefetched("sha1:" + sha1.hexdigest(), file_type, size, stat.st_mtime_ns, data)
+
+
+class Prefetcher(object):
+    def __init__(self, threads: int, depth: int, inline_bytes: int = INLINE_BYTES):
+        self.threads = threads
+        self.depth = max(depth, threads)
+        self.inline_bytes = inline_bytes
+        self._lock = threading.Lock()
+        self.busy_seconds = 0.0
+        self.bytes = 0
+        self.files = 0
+        self.errors = 0
+        self.start = None
+        self.end = None
+
+    def _fetch(self, path: str, file_type) -> Optional[Prefetched]:
+        if split_member(path) is not None:
+            # Read by the worker, from the archive.
+            return None
+        start = time.perf_counter()
+        try:
+            fetched = prefetch_file(path, file_type, self.inline_bytes)
+        except Exception as e:
+            # The worker reads it itself, and reports what goes wrong.
+            getLogger().debug(f"Couldn't prefetch '{path}':{format_exception(e)}")
+            fetched = None
+        with self._lock:
+            self.busy_seconds += time.perf_counter() - start
+            if fetched is None:
+                self.errors += 1
+            else:
+                self.files += 1
+                self.bytes += fetched.size
+        return fetched
+
+    def run(self, tasks: Iterable[tuple]) -> Iterator[tuple]:
+        """Yields the (input, output, estimate) tasks, in the same order, with
+        their Prefetched (None if the file couldn't be read) appended."""
+        self.start = time.monotonic()
+        executor = ThreadPoolExecutor(self.threads, thread_name_prefix="prefetch")
+        # Bounds the tasks read ahead; a feeder thread takes the tasks, so
+        # that waiting for the next one doesn't hold back those already read.
+        window = queue.Queue(maxsize=self.depth)
+
+        def feed():
+            try:
+                for task in tasks:
+                    estimate = task[2]
+                    file_type = _UNKNOWN
+                    if estimate is not None:
+                        name = estimate.features.file_type
+                        file_type = FileType[name] if name is not None else None
+                    window.put((task, executor.submit(self._fetch, task[0], file_type)))
+            except BaseException as e:
+                window.put((e, None))
+            window.put((_END, None))
+
+        threading.Thread(target=feed, name="prefetch-feeder", daemon=True).start()
+        try:
+            while (item := window.get())[0] is not _END:
+                task, future = item
+                if isinstance(task, BaseException):
+                    raise task
+                yield (*task, future.result())
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+            self.end = time.monotonic()
+
+    def utilisation(self) -> float:
+        if self.start is None:
+            return 0.0
+        elapsed = (self.end or time.monotonic()) - self.start
+        return self.busy_seconds / (self.threads * elapsed) if elapsed > 0 else 0.0
@@ -0,0 +1,129 @@
+"""Yield report of a preview run.
+
+In a preview, the handlers only extract a bounded sample of every document
+(a few pages spread over a PDF, the first chapters of a book, the beginning
+of a web page) and record which fraction of the document it is
+(``preview_fraction``); everything else runs as usual. The kept text, the
+languages and the time of every document are projected to the whole
+document by dividing by that fraction, and to the whole corpus by dividing
+by the fraction of the input files that were looked at (``--shard``).
+
+"""
+import json
+import os
+from collections import Counter, defaultdict
+from enum import Enum
+from typing import Any, Optional
+
+
+def document_sample(result: dict[str, Any], lines, size: int) -> dict[str, Any]:
+    """What the report needs from the record of a document, in the worker."""
+    file_type = result.get("file_type")
+    if isinstance(file_type, Enum):
+        file_type = file_type.name
+    languages = result.get("languages") or {}
+    return {"file_type": file_type, "size": size,
+            "fraction": result.get("preview_fraction", 1.0),
+            "raw_chars": sum(languages.values()),
+            "chars": sum(len(line) for line in lines),
+            "languages": languages,
+            "ocr": bool(result.get("ocr")),
+            "drop_reason": result.get("drop_reason")}
+
+
+class PreviewReport(object):
+    """Aggregates the document_sample() of the tasks of a preview, in the
+    main process."""
+    def __init__(self, sample_rate: float = 1.0):
+        self.sample_rate = sample_rate
+        self.statuses = Counter()
+        self.documents = Counter()
+        self.bytes = Counter()
+        self.raw_chars = Counter()
+        self.chars = Counter()
+        self.seconds = Counter()
+        self.sampled = Counter()
+        self.ocr = Counter()
+        self.drop_reasons = Counter()
+        self.languages = defaultdict(Counter)
+
+    def add(self, status: str, duration: Optional[float], sample: Optional[dict[str, Any]]) -> None:
+        self.statuses[status] += 1
+        if sample is None:
+            return
+
+        file_type = sample["file_type"] or "unknown"
+        # Whole documents for the handlers that can't do less.
+        scale = 1 / sample["fraction"] if sample["fraction"] > 0 else 1.0
+        self.documents[file_type] += 1
+        self.bytes[file_type] += sample["size"]
+        self.sampled[file_type] += sample["fraction"] * sample["size"]
+        self.raw_chars[file_type] += scale * sample["raw_chars"]
+        self.chars[file_type] += scale * sample["chars"]
+        self.seconds[file_type] += scale * (duration or 0.0)
+        if sample["ocr"]:
+            self.ocr[file_type] += 1
+        if sample["drop_reason"]:
+            self.drop_reasons[sample["drop_reason"]] += 1
+        for language, chars in sample["languages"].items():
+            self.languages[file_type][language] += scale * chars
+
+    def _totals(self, documents, size, raw_chars, chars, seconds, ocr, languages) -> dict[str, Any]:
+        projected = 1 / self.sample_rate
+        raw_total = sum(languages.values())
+        return {"documents": documents,
+                "mb": size / 2 ** 20,
+                "ocr_fraction": ocr / documents if documents else 0.0,
+                # Share of the extracted text that the processors keep.
+                "yield": chars / raw_chars if raw_chars else 0.0,
+                "chars_per_mb": chars / (size / 2 ** 20) if size else 0.0,
+                "seconds_per_mb": seconds / (size / 2 ** 20) if size else 0.0,
+                "languages": {language: n / raw_total
+                              for language, n in languages.most_common(10)} if raw_total else {},
+                "projected": {"documents": round(documents * projected),
+                              "mb": size * projected / 2 ** 20,
+                              "raw_chars": round(raw_chars * projected),
+                              "chars": round(chars * projected),
+                              "cpu_hours": seconds * projected / 3600}}
+
+    def report(self) -> dict[str, Any]:
+        by_type = {}
+        all_languages = Counter()
+        for file_type in sorted(self.documents):
+            all_languages.update(self.languages[file_type])
+            by_type[file_type] = self._totals(self.documents[file_type], self.bytes[file_type],
+                                              self.raw_chars[file_type], self.chars[file_type],
+                                              self.seconds[file_type], self.ocr[file_type],
+                                              self.languages[file_type])
+
+        report = self._totals(sum(self.documents.values()), sum(self.bytes.values()),
+                              sum(self.raw_chars.values()), sum(self.chars.values()),
+                              sum(self.seconds.values()), sum(self.ocr.values()), all_languages)
+        report.update({"sample_rate": self.sample_rate,
+                       "sampled_mb": sum(self.sampled.values()) / 2 ** 20,
+                       "statuses": dict(self.statuses),
+                       "drop_reasons": dict(self.drop_reasons),
+                       "by_type": by_type})
+        return report
+
+    def summary(self) -> str:
+        report = self.report()
+        projected = report["projected"]
+        languages = ", ".join(f"{language} {100 * share:.0f}%"
+                              for language, share in list(report["languages"].items())[:5])
+        lines = [f"Preview: {report['documents']} documents ({report['sampled_mb']:.1f} of "
+                 f"{report['mb']:.1f} MB read), yield {100 * report['yield']:.1f}%, "
+                 f"OCR {100 * report['ocr_fraction']:.1f}%, languages: {languages or 'none'}",
+                 f"Projected: {projected['documents']} documents, {projected['mb']:.0f} MB, "
+                 f"{projected['chars'] / 1e6:.1f}M characters kept, "
+                 f"{projected['cpu_hours']:.1f} CPU hours"]
+        for file_type, totals in report["by_type"].items():
+            lines.append(f"{file_type}: {totals['chars_per_mb'] / 1e3:.1f}k characters/MB, "
+                         f"{totals['seconds_per_mb']:.2f}s/MB, "
+                         f"OCR {100 * totals['ocr_fraction']:.1f}%")
+        return "\n".join(lines)
+
+    def write(self, path: str) -> None:
+        with open(path + ".tmp", "w") as f:
+            json.dump(self.report(), f, indent=2)
+        os.rename(path + ".tmp", path)
@@ -1,3 +1,6 @@
 from .text_repair import text_repair
 from .quality_filter import quality_filter
-from .language_identification import language_identification
+from .language_identification import language_identification, LanguageMix
+from .boilerplate import BoilerplateFilter, CountMinSketch
+from .near_dedup import NearDuplicateFilter, LSHIndex
+from .segmenter import Segmenter
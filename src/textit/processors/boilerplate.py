@@ -0,0 +1,176 @@
+import hashlib
+import os
+from contextlib import nullcontext
+from typing import List, Optional
+
+import numpy as np
+
+from textit.metadata import Metadata
+from textit.processors.quality_filter import normalize
+
+# Magic + (depth, width) header of a saved sketch.
+SKETCH_MAGIC = b"TXCMS001"
+HEADER_DTYPE = np.dtype("<u8")
+COUNTER_DTYPE = np.dtype("<u4")
+
+# Number of header counters stored in front of the table: the number of
+# documents added so far.
+HEADER_CELLS = 1
+
+
+class CountMinSketch(object):
+    """Count-min sketch of line hashes with fixed memory.
+
+    The counters live in a flat uint32 buffer (``HEADER_CELLS`` + depth *
+    width cells), which may be a ``multiprocessing.Array`` so that all the
+    workers of a run update the same sketch. Sketches with the same shape
+    can be merged by adding the counters.
+
+    """
+    def __init__(self, width: int = 2 ** 20, depth: int = 4, buffer=None):
+        self.width = width
+        self.depth = depth
+        if buffer is None:
+            buffer = bytearray(self.buffer_size(width, depth) * COUNTER_DTYPE.itemsize)
+
+        cells = np.frombuffer(buffer, dtype=COUNTER_DTYPE)
+        assert len(cells) == self.buffer_size(width, depth), "Sketch buffer has the wrong size"
+        self._header = cells[:HEADER_CELLS]
+        self.table = cells[HEADER_CELLS:].reshape(depth, width)
+        self._rows = np.arange(depth, dtype=np.uint64)[:, None]
+
+    @staticmethod
+    def buffer_size(width: int, depth: int) -> int:
+        """Number of uint32 cells needed for a sketch of the given shape."""
+        return HEADER_CELLS + width * depth
+
+    @property
+    def documents(self) -> int:
+        return int(self._header[0])
+
+    def _columns(self, keys: List[bytes]) -> np.ndarray:
+        # Double hashing: column_i = h1 + i * h2 (mod width).
+        digests = b"".join(hashlib.blake2b(key, digest_size=16).digest() for key in keys)
+        hashes = np.frombuffer(digests, dtype=HEADER_DTYPE).reshape(-1, 2)
+        h1, h2 = hashes[:, 0], hashes[:, 1] | np.uint64(1)
+        with np.errstate(over="ignore"):
+            return (h1[None, :] + self._rows * h2[None, :]) % np.uint64(self.width)
+
+    def estimate(self, keys: List[bytes]) -> np.ndarray:
+        if not keys:
+            return np.zeros(0, dtype=COUNTER_DTYPE)
+
+        columns = self._columns(keys)
+        return self.table[np.arange(self.depth)[:, None], columns].min(axis=0)
+
+    def add_document(self, keys: List[bytes]) -> np.ndarray:
+        """Count each (distinct) key once; returns the counts seen before."""
+        self._header[0] += 1
+        if not keys:
+            return np.zeros(0, dtype=COUNTER_DTYPE)
+
+        columns = self._columns(keys)
+        rows = np.broadcast_to(np.arange(self.depth)[:, None], columns.shape)
+        before = self.table[rows, columns].min(axis=0)
+        np.add.at(self.table, (rows, columns), 1)
+        return before
+
+    def halve(self) -> None:
+        """Ages all the counts, so that old documents matter less."""
+        self.table >>= 1
+
+    def merge(self, other: "CountMinSketch") -> None:
+        if (self.width, self.depth) != (other.width, other.depth):
+            raise ValueError(f"Can't merge sketches of different shapes: "
+                             f"{(self.depth, self.width)} vs {(other.depth, other.width)}")
+
+        # Saturate instead of wrapping around.
+        total = self.table.astype(np.uint64) + other.table
+        np.minimum(total, np.iinfo(COUNTER_DTYPE).max, out=total)
+        self.table[:] = total
+        self._header[0] += other._header[0]
+
+    def save(self, path: str) -> None:
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(SKETCH_MAGIC)
+            f.write(np.array([self.depth, self.width], dtype=HEADER_DTYPE).tobytes())
+            f.write(self._header.tobytes())
+            f.write(self.table.tobytes())
+
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str, buffer=None) -> "CountMinSketch":
+        with open(path, "rb") as f:
+            magic = f.read(len(SKETCH_MAGIC))
+            if magic != SKETCH_MAGIC:
+                raise ValueError(f"Not a count-min sketch file: '{path}'")
+
+            depth, width = np.frombuffer(f.read(2 * HEADER_DTYPE.itemsize), dtype=HEADER_DTYPE)
+            sketch = cls(int(width), int(depth), buffer)
+            data = np.frombuffer(f.read(), dtype=COUNTER_DTYPE)
+            if len(data) != cls.buffer_size(sketch.width, sketch.depth):
+                raise ValueError(f"Truncated count-min sketch file: '{path}'")
+
+            sketch._header[:] = data[:HEADER_CELLS]
+            sketch.table.flat[:] = data[HEADER_CELLS:]
+
+        return sketch
+
+
+def line_key(line: str) -> Optional[bytes]:
+    normalized = normalize(line)
+    if not normalized:
+        return None
+
+    return normalized.encode("utf-8", "surrogateescape")
+
+
+class BoilerplateFilter(object):
+    """Document processor that drops lines repeated across the corpus.
+
+    A line is dropped once its normalized form was seen in at least
+    ``max_docs`` other documents. If ``window`` is set, the counts are halved
+    every ``window`` documents, so the threshold is roughly "``max_docs``
+    times in the last ``window`` documents". The ``lock`` (if any) guards the
+    sketch when it is shared between processes.
+
+    """
+    def __init__(self, sketch: CountMinSketch, max_docs: int = 20,
+                 window: Optional[int] = None, lock=None):
+        self.sketch = sketch
+        self.max_docs = max_docs
+        self.window = window
+        self.lock = lock if lock is not None else nullcontext()
+
+    def __call__(self, texts: List[str], metadata: Metadata) -> List[str]:
+        chunks = [text.split("\n") if text else [] for text in texts]
+        chunk_keys = [[line_key(line) for line in lines] for lines in chunks]
+        distinct = list({key: None for keys in chunk_keys for key in keys if key is not None})
+        with self.lock:
+            counts = self.sketch.add_document(distinct)
+            if self.window and self.sketch.documents % self.window == 0:
+                self.sketch.halve()
+
+        boilerplate = {key for key, count in zip(distinct, counts) if count >= self.max_docs}
+
+        removed = 0
+        result = []
+        for text, lines, keys in zip(texts, chunks, chunk_keys):
+            if not boilerplate:
+                result.append(text)
+                continue
+
+            kept = []
+            for line, key in zip(lines, keys):
+                if key in boilerplate:
+                    removed += 1
+                else:
+                    kept.append(line)
+
+            if kept:
+                result.append("\n".join(kept))
+
+        metadata.boilerplate_lines = removed
+        return result
@@ -1,7 +1,10 @@
 import fasttext
 import fasttext.util
 from pkg_resources import resource_filename
-from typing import Optional
+from collections import Counter
+from typing import List, Optional
+
+from textit.metadata import Metadata
 
 
 model_path = resource_filename('textit.processors.lang_id', 'lid.176.bin')
@@ -35,3 +38,22 @@ def language_identification(text: str) -> Optional[str]:
     if score < 0.5:
         return None
     return text
+
+
+def detect_language(text: str) -> str:
+    """ISO 639-1 code of the most likely language of the text."""
+    normalized_text = ' '.join(text.split())
+    labels, _ = model.predict(normalized_text, k=1)
+    return labels[0].replace('__label__', '') if labels else 'unknown'
+
+
+class LanguageMix(object):
+    """Counts the characters of a document per language (of its units), in
+    ``metadata.languages``; doesn't drop anything."""
+    def __call__(self, texts: List[str], metadata: Metadata) -> List[str]:
+        languages = Counter()
+        for text in texts:
+            if text and not text.isspace():
+                languages[detect_language(text)] += len(text)
+        metadata.languages = dict(languages)
+        return texts
@@ -0,0 +1,170 @@
+import hashlib
+import sqlite3
+from contextlib import contextmanager
+from typing import List, Optional
+
+import numpy as np
+
+from textit.metadata import Metadata
+from textit.processors.quality_filter import normalize, form_ngrams
+
+# Mersenne prime used for the universal hash permutations; the shingle hashes
+# and the permutation coefficients are 32-bit, so a * h + b fits in 64 bits.
+MERSENNE_PRIME = np.uint64((1 << 61) - 1)
+MAX_HASH = np.uint64((1 << 32) - 1)
+SIGNATURE_DTYPE = np.dtype("<u4")
+
+SEED = 0x7e47
+
+
+def make_permutations(num_perm: int, seed: int = SEED) -> tuple[np.ndarray, np.ndarray]:
+    gen = np.random.RandomState(seed)
+    a = gen.randint(1, 1 << 32, size=num_perm, dtype=np.uint64)
+    b = gen.randint(0, 1 << 32, size=num_perm, dtype=np.uint64)
+    return a, b
+
+
+def shingle_hashes(texts: List[str], shingle_size: int) -> np.ndarray:
+    """32-bit hashes of the distinct word shingles of the normalized text."""
+    words = normalize(" ".join(t for t in texts if t)).split()
+    shingles = {" ".join(ngram) for ngram in form_ngrams(iter(words), shingle_size)}
+    digests = b"".join(hashlib.blake2b(s.encode("utf-8", "surrogateescape"),
+                                       digest_size=4).digest() for s in shingles)
+    return np.frombuffer(digests, dtype=SIGNATURE_DTYPE).astype(np.uint64)
+
+
+def minhash_signature(hashes: np.ndarray, a: np.ndarray, b: np.ndarray) -> np.ndarray:
+    signature = np.full(len(a), MAX_HASH, dtype=np.uint64)
+    # Bounded blocks, so that huge books don't need a num_perm x shingles
+    # matrix at once.
+    for start in range(0, len(hashes), 4096):
+        block = hashes[start:start + 4096]
+        permuted = (np.outer(block, a) + b) % MERSENNE_PRIME & MAX_HASH
+        np.minimum(signature, permuted.min(axis=0), out=signature)
+
+    return signature.astype(SIGNATURE_DTYPE)
+
+
+def jaccard(sig1: np.ndarray, sig2: np.ndarray) -> float:
+    return float(np.count_nonzero(sig1 == sig2)) / len(sig1)
+
+
+class LSHIndex(object):
+    """Persistent MinHash-LSH index stored in SQLite.
+
+    Every process opens its own connection; lookups and inserts of a
+    document happen in the same write transaction, so concurrent workers
+    can't both miss each other's copy of a document.
+
+    """
+    def __init__(self, path: str, num_perm: int = 128, bands: int = 16):
+        if num_perm % bands != 0:
+            raise ValueError(f"num_perm ({num_perm}) must be a multiple of bands ({bands})")
+
+        self.path = path
+        self.num_perm = num_perm
+        self.bands = bands
+        self.rows = num_perm // bands
+        self._db = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS params (num_perm INTEGER, bands INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS signatures "
+                         "(doc_id TEXT PRIMARY KEY, signature BLOB)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS buckets "
+                         "(band INTEGER, bucket BLOB, doc_id TEXT)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS buckets_idx ON buckets (band, bucket)")
+        self._check_params()
+
+    def _check_params(self):
+        with self._transaction():
+            row = self._db.execute("SELECT num_perm, bands FROM params").fetchone()
+            if row is None:
+                self._db.execute("INSERT INTO params VALUES (?, ?)", (self.num_perm, self.bands))
+            elif tuple(row) != (self.num_perm, self.bands):
+                raise ValueError(f"LSH index '{self.path}' was built with num_perm={row[0]}, "
+                                 f"bands={row[1]}")
+
+    @contextmanager
+    def _transaction(self):
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+        self._db.execute("COMMIT")
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [hashlib.blake2b(signature[i * self.rows:(i + 1) * self.rows].tobytes(),
+                                digest_size=8).digest()
+                for i in range(self.bands)]
+
+    def query_and_insert(self, doc_id: str, signature: np.ndarray,
+                         threshold: float) -> Optional[tuple[str, float]]:
+        """Returns the best earlier match (if any); otherwise indexes the document."""
+        keys = self._band_keys(signature)
+        with self._transaction():
+            candidates = set()
+            for band, key in enumerate(keys):
+                rows = self._db.execute("SELECT doc_id FROM buckets WHERE band = ? AND bucket = ?",
+                                        (band, key))
+                candidates.update(r[0] for r in rows)
+
+            candidates.discard(doc_id)
+            best = None
+            for candidate in candidates:
+                row = self._db.execute("SELECT signature FROM signatures WHERE doc_id = ?",
+                                       (candidate,)).fetchone()
+                similarity = jaccard(signature, np.frombuffer(row[0], dtype=SIGNATURE_DTYPE))
+                if similarity >= threshold and (best is None or similarity > best[1]):
+                    best = (candidate, similarity)
+
+            if best is None:
+                self._db.execute("INSERT OR REPLACE INTO signatures VALUES (?, ?)",
+                                 (doc_id, signature.tobytes()))
+                self._db.executemany("INSERT INTO buckets VALUES (?, ?, ?)",
+                                     ((band, key, doc_id) for band, key in enumerate(keys)))
+
+        return best
+
+    def close(self):
+        self._db.close()
+
+
+class NearDuplicateFilter(object):
+    """Document processor that marks (or drops) near-duplicate documents.
+
+    Documents are identified by ``metadata.digest``. A document whose
+    estimated Jaccard similarity to an already indexed one is at least
+    ``threshold`` gets ``near_duplicate_of`` set; with ``drop`` it is also
+    emptied with the "near-duplicate" drop reason.
+
+    """
+    def __init__(self, index: LSHIndex, threshold: float = 0.8,
+                 shingle_size: int = 5, drop: bool = False):
+        self.index = index
+        self.threshold = threshold
+        self.shingle_size = shingle_size
+        self.drop = drop
+        self._a, self._b = make_permutations(index.num_perm)
+
+    def __call__(self, texts: List[str], metadata: Metadata) -> List[str]:
+        if metadata.digest is None:
+            return texts
+
+        hashes = shingle_hashes(texts, self.shingle_size)
+        if len(hashes) == 0:
+            return texts
+
+        signature = minhash_signature(hashes, self._a, self._b)
+        match = self.index.query_and_insert(metadata.digest, signature, self.threshold)
+        if match is None:
+            return texts
+
+        metadata.near_duplicate_of, metadata.near_duplicate_similarity = match
+        if self.drop:
+            metadata.drop_reason = "near-duplicate"
+            return []
+
+        return texts
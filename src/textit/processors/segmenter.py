@@ -0,0 +1,68 @@
+import re
+from typing import Iterable, Iterator, List
+
+from textit.metadata import Metadata
+
+# Whitespace after the end of a sentence.
+SENTENCE_END = re.compile(r"(?<=[.!?…])\s+")
+
+
+def split_line(line: str, unit_size: int) -> Iterator[str]:
+    """Pieces of at most ``unit_size`` characters, cut after the last
+    sentence that fits, or else at the last space, or else anywhere."""
+    while len(line) > unit_size:
+        window = line[:unit_size + 1]
+        cut = None
+        for cut in SENTENCE_END.finditer(window):
+            pass
+        if cut is not None and cut.start() > 0:
+            start, end = cut.start(), cut.end()
+        else:
+            start = end = window.rfind(" ")
+            if start > 0:
+                end += 1
+            else:
+                start = end = unit_size
+        yield line[:start]
+        line = line[end:]
+
+    yield line
+
+
+def segment(texts: Iterable[str], unit_size: int) -> Iterator[str]:
+    """Re-cuts the output of a handler into units of at most about
+    ``unit_size`` characters.
+
+    Lines are packed together, joined by newlines, so that the text of the
+    document doesn't change, except for the lines longer than a unit: those
+    are cut, after a sentence if possible, and the whitespace at the cut
+    becomes a newline (one is inserted where there's no whitespace to cut
+    at).
+
+    """
+    unit = []
+    size = 0
+    for text in texts:
+        for line in text.split("\n"):
+            for piece in split_line(line, unit_size):
+                if unit and size + len(piece) > unit_size:
+                    yield "\n".join(unit)
+                    unit = []
+                    size = 0
+                unit.append(piece)
+                size += len(piece) + 1
+
+    if unit:
+        yield "\n".join(unit)
+
+
+class Segmenter(object):
+    """Gives the processing pipeline units of similar size, whatever the
+    handler: whole documents (HTML, EPUB, DOC) are cut up, PDF paragraphs are
+    packed together. Document processors that work on lines see the same
+    lines as before, but for the pieces of the lines longer than a unit."""
+    def __init__(self, unit_size: int = 2000):
+        self.unit_size = unit_size
+
+    def __call__(self, texts: List[str], metadata: Metadata) -> List[str]:
+        return list(segment((text for text in texts if text is not None), self.unit_size))
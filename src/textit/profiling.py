@@ -0,0 +1,210 @@
+"""Profiles of the documents that take too long.
+
+Every document is profiled, and the profile is only kept if the document
+turns out to be slow. By default the profile comes from a thread that
+samples the stacks of all the threads of the worker every few milliseconds,
+which is cheap enough to leave on for a whole run; ``cprofile`` mode also
+runs cProfile (on the worker's main thread), which slows everything down but
+gives exact call counts.
+
+The stacks are written in the "collapsed" format of flamegraph.pl and
+speedscope (``frame;frame;frame count`` per line), and as a pstats file: that
+of cProfile, or one made from the samples (sample counts instead of call
+counts, times of ``samples * interval``).
+
+Once a document is slow, its profile so far is written every few seconds
+(``partial`` in its .json), so that the documents whose worker is killed
+(``--timeout``) have one too.
+
+"""
+import cProfile
+import json
+import marshal
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from typing import Any, Callable, Dict, Optional, Tuple
+
+# Leaf frames of threads waiting for work, which aren't worth sampling.
+IDLE_FRAMES = {("thread.py", "_worker"), ("threading.py", "wait")}
+
+PROFILE_EXTENSIONS = (".collapsed", ".pstats", ".json")
+
+# (file name, first line, function name), the keys of pstats.
+Frame = Tuple[str, int, str]
+
+
+def _frame_name(frame: Frame) -> str:
+    filename, line, name = frame
+    return f"{name} ({os.path.basename(filename)}:{line})"
+
+
+class StackSampler(object):
+    """Counts the stacks of the other threads, root first, each one under a
+    pseudo-frame (``("~", 0, <thread name>)``, like the built-ins of pstats). ``on_sample`` is called (from the
+    sampling thread) after every sample."""
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.on_sample = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self, on_sample: Optional[Callable[[], None]] = None) -> None:
+        self.stacks.clear()
+        self.on_sample = on_sample
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self) -> None:
+        me = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                code = frame.f_code
+                if (os.path.basename(code.co_filename), code.co_name) in IDLE_FRAMES:
+                    continue
+
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                # Pool threads are numbered, merge them.
+                thread = re.sub(r"_\d+$", "", names.get(ident, "thread"))
+                stack.append(("~", 0, thread))
+                self.stacks[tuple(reversed(stack))] += 1
+            if self.on_sample is not None:
+                self.on_sample()
+
+    def collapsed(self) -> str:
+        return "".join(";".join([stack[0][2]] + [_frame_name(f) for f in stack[1:]]) +
+                       f" {n}\n" for stack, n in self.stacks.most_common())
+
+    def pstats(self) -> Dict[Frame, tuple]:
+        """The samples in the format of pstats (what ``marshal`` writes to
+        a .pstats file): every sample counts as a call of each function on
+        its stack (once, even if recursive), of ``interval`` seconds."""
+        calls = Counter()
+        own = Counter()
+        callers = {}
+        for stack, n in self.stacks.items():
+            own[stack[-1]] += n
+            for frame in set(stack):
+                calls[frame] += n
+            for edge in set(zip(stack, stack[1:])):
+                caller, callee = edge
+                callers.setdefault(callee, Counter())[caller] += n
+        stats = {}
+        for frame, n in calls.items():
+            inclusive = n * self.interval
+            stats[frame] = (n, n, own[frame] * self.interval, inclusive,
+                            {caller: (m, m, 0.0, m * self.interval)
+                             for caller, m in callers.get(frame, {}).items()})
+        return stats
+
+
+def rename_profile(output_dir: str, name: str, new_name: str) -> Optional[str]:
+    """Renames the profile files ``<name>.*``, returning their new path
+    without the extension, or None if there is no such profile."""
+    base = os.path.join(output_dir, name)
+    if not os.path.exists(base + ".json"):
+        return None
+    new_base = os.path.join(output_dir, new_name)
+    for ext in PROFILE_EXTENSIONS:
+        if os.path.exists(base + ext):
+            os.replace(base + ext, new_base + ext)
+    return new_base
+
+
+class SlowDocumentProfiler(object):
+    """Runs functions under the profilers, saving the profiles of the calls
+    that take longer than ``threshold`` seconds to ``output_dir``, and the
+    profile so far of a call that is still running every ``flush_interval``
+    seconds once it is slow."""
+    def __init__(self, threshold: float, output_dir: str, mode: str = "sample",
+                 interval: float = 0.005, flush_interval: float = 5.0):
+        self.threshold = threshold
+        self.output_dir = output_dir
+        self.mode = mode
+        self.flush_interval = flush_interval
+        self.sampler = StackSampler(interval)
+        self.partial = None
+
+    def run(self, name: str, info: dict[str, Any], func: Callable, *args, **kwargs) -> Any:
+        """Returns what ``func`` returns; the profile is kept for
+        ``save_if_slow`` even if it raises. While it runs, the partial
+        profile is written as ``<name>.*``, with ``info``."""
+        self.profile = cProfile.Profile() if self.mode == "cprofile" else None
+        self.partial = None
+        start = time.monotonic()
+        next_flush = start + self.threshold
+
+        def flush():
+            nonlocal next_flush
+            now = time.monotonic()
+            if now >= next_flush:
+                self.partial = self._write(name, {**info, "partial": True}, now - start,
+                                           self.sampler.pstats())
+                next_flush = now + self.flush_interval
+
+        self.sampler.start(flush)
+        if self.profile is not None:
+            self.profile.enable()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            if self.profile is not None:
+                self.profile.disable()
+            self.duration = time.monotonic() - start
+            self.sampler.stop()
+
+    def save_if_slow(self, name: str, info: dict[str, Any]) -> Optional[str]:
+        """Saves the profile of the last run as ``<name>.*``, if it was slow.
+
+        Returns the path of the profile files without their extension.
+
+        """
+        if self.partial is not None and self.partial != os.path.join(self.output_dir, name):
+            for ext in PROFILE_EXTENSIONS:
+                try:
+                    os.remove(self.partial + ext)
+                except FileNotFoundError:
+                    pass
+        if self.duration < self.threshold:
+            return None
+
+        if self.profile is not None:
+            self.profile.create_stats()
+            stats = self.profile.stats
+        else:
+            stats = self.sampler.pstats()
+        return self._write(name, info, self.duration, stats)
+
+    def _write(self, name: str, info: dict[str, Any], duration: float,
+               stats: Dict[Frame, tuple]) -> str:
+        os.makedirs(self.output_dir, exist_ok=True)
+        base = os.path.join(self.output_dir, name)
+        # Written aside and renamed, the worker may be killed at any time.
+        with open(base + ".collapsed.tmp", "w") as f:
+            f.write(self.sampler.collapsed())
+        with open(base + ".pstats.tmp", "wb") as f:
+            marshal.dump(stats, f)
+        with open(base + ".json.tmp", "w") as f:
+            json.dump({**info, "duration": duration, "mode": self.mode,
+                       "samples": sum(self.sampler.stacks.values()),
+                       "interval": self.sampler.interval}, f, indent=2)
+        for ext in PROFILE_EXTENSIONS:
+            os.replace(base + ext + ".tmp", base + ext)
+
+        return base
@@ -0,0 +1,86 @@
+import json
+import sqlite3
+import zlib
+from dataclasses import dataclass
+from enum import Enum
+from typing import List, Optional
+
+from textit.metadata import Metadata, FileType, DocumentClass
+
+
+def metadata_to_dict(metadata: Metadata) -> dict:
+    return {k: (v.name if isinstance(v, Enum) else v)
+            for k, v in metadata.__dict__.items() if v is not None}
+
+
+def metadata_from_dict(fields: dict) -> Metadata:
+    metadata = Metadata()
+    for k, v in fields.items():
+        if k == "file_type":
+            v = FileType[v]
+        elif k == "document_class":
+            v = DocumentClass[v]
+        # Handlers may add their own members (e.g. "ocr"), so use setattr.
+        setattr(metadata, k, v)
+
+    return metadata
+
+
+@dataclass
+class CachedTask:
+    """Stands for the prefetched data of a task that is rerun from its raw
+    cache entry, without reading the input file."""
+    digest: str
+    file_type: Optional[FileType] = None
+
+
+class RawCache(object):
+    """Handler output (before processing) keyed by file digest.
+
+    Entries remember the file type and the handler version that produced
+    them, and are only returned for the same handler version. The text and
+    the metadata are stored as zlib-compressed JSON in a SQLite file, which
+    can be shared by the workers of a run.
+
+    """
+    def __init__(self, path: str, level: int = 6):
+        self.path = path
+        self.level = level
+        self._db = sqlite3.connect(path, timeout=600, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS raw ("
+                         "digest TEXT PRIMARY KEY, file_type TEXT, handler_version TEXT, "
+                         "metadata BLOB, text BLOB)")
+
+    def get(self, digest: str) -> Optional[tuple[FileType, str, List[str], Metadata]]:
+        """Returns (file type, handler version, text, metadata) or None."""
+        row = self._db.execute("SELECT file_type, handler_version, metadata, text FROM raw "
+                               "WHERE digest = ?", (digest,)).fetchone()
+        if row is None:
+            return None
+
+        file_type, handler_version, metadata, text = row
+        metadata = metadata_from_dict(json.loads(zlib.decompress(metadata)))
+        # Undecodable bytes of the input are kept as lone surrogates.
+        text = json.loads(zlib.decompress(text).decode("utf-8", "surrogateescape"))
+        return FileType[file_type], handler_version, text, metadata
+
+    def version(self, digest: str) -> Optional[tuple[FileType, str]]:
+        """Returns (file type, handler version) of the entry, without
+        decompressing it, or None."""
+        row = self._db.execute("SELECT file_type, handler_version FROM raw WHERE digest = ?",
+                               (digest,)).fetchone()
+        if row is None:
+            return None
+        return FileType[row[0]], row[1]
+
+    def put(self, digest: str, file_type: FileType, handler_version: str,
+            text: List[str], metadata: Metadata) -> None:
+        metadata = zlib.compress(json.dumps(metadata_to_dict(metadata)).encode("utf-8"), self.level)
+        text = zlib.compress(json.dumps(text, ensure_ascii=False)
+                             .encode("utf-8", "surrogateescape"), self.level)
+        self._db.execute("INSERT OR REPLACE INTO raw VALUES (?, ?, ?, ?, ?)",
+                         (digest, file_type.name, handler_version, metadata, text))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,207 @@
+"""Random access to output records through sidecar indexes.
+
+An index is a JSONL file with one entry per record::
+
+    {"file": ..., "offset": ..., "length": ..., "path_hash": ..., "metadata": {...}}
+
+``file`` is relative to the directory of the index, ``offset``/``length``
+delimit the record in it (a whole JSON file, or one compressed member of a
+shard) and ``metadata`` has all the members of the record except its
+content, for filtering without reading the records themselves.
+
+Every shard gets one (``<shard>.idx``, written along with it); a directory
+of per-file JSON outputs can be indexed with ``build_index``
+(``records.idx``), which goes stale as records are written after it;
+``stale_records`` finds those.
+
+Looking records up by path hash, digest or URL goes through RecordLookup, a
+SQLite copy of the indexes of a directory keyed on those.
+
+"""
+import json
+import os
+import sqlite3
+from typing import Any, Iterable, Iterator, Optional
+
+from textit.records import CONTENT_KEY
+
+INDEX_SUFFIX = ".idx"
+DIRECTORY_INDEX = "records.idx"
+LOOKUP_DB = "records.sqlite"
+
+
+def index_entry(record: dict[str, Any], file: str, offset: int, length: int,
+                path_hash: Optional[str] = None) -> dict[str, Any]:
+    metadata = {k: v for k, v in record.items() if k != CONTENT_KEY}
+    return {"file": file, "offset": offset, "length": length, "path_hash": path_hash,
+            "metadata": metadata}
+
+
+def write_entries(f, entries: Iterable[dict[str, Any]], default=None) -> None:
+    for entry in entries:
+        f.write(json.dumps(entry, ensure_ascii=False, default=default))
+        f.write("\n")
+
+
+def read_index(index_path: str) -> Iterator[dict[str, Any]]:
+    """Yields the entries of an index, with ``file`` made absolute."""
+    root = os.path.dirname(os.path.abspath(index_path))
+    with open(index_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+        for line in f:
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # Cut off by a crash.
+                continue
+            entry["file"] = os.path.join(root, entry["file"])
+            yield entry
+
+
+def find_indexes(path: str) -> list[str]:
+    """The index of a shard, or all the indexes in a directory."""
+    if os.path.isdir(path):
+        return sorted(e.path for e in os.scandir(path)
+                      if e.name.endswith(INDEX_SUFFIX) and e.is_file())
+
+    return [path + INDEX_SUFFIX] if os.path.exists(path + INDEX_SUFFIX) else []
+
+
+def read_record(entry: dict[str, Any]) -> dict[str, Any]:
+    """Reads only the bytes of the record that ``entry`` points to."""
+    # Imported here, since shards imports this module.
+    from textit.shards import compression_of, decompress_member
+
+    with open(entry["file"], "rb") as f:
+        f.seek(entry["offset"])
+        data = f.read(entry["length"])
+
+    compression = compression_of(entry["file"])
+    if compression is not None:
+        data = decompress_member(compression, data)
+
+    return json.loads(data.decode("utf-8", "surrogateescape"))
+
+
+def build_index(output_dir: str, default=None) -> int:
+    """Indexes the per-file JSON records under ``output_dir``.
+
+    Returns the number of records in the index.
+
+    """
+    index_path = os.path.join(output_dir, DIRECTORY_INDEX)
+    count = 0
+    with open(index_path + ".tmp", "w", encoding="utf-8", errors="surrogateescape") as f:
+        for root, _, files in os.walk(output_dir):
+            for name in sorted(files):
+                if not name.endswith(".json"):
+                    continue
+
+                path = os.path.join(root, name)
+                try:
+                    with open(path, "r", encoding="utf-8", errors="surrogateescape") as record_file:
+                        record = json.load(record_file)
+                except (OSError, json.JSONDecodeError):
+                    continue
+
+                entry = index_entry(record, os.path.relpath(path, output_dir), 0,
+                                    os.path.getsize(path), os.path.splitext(name)[0])
+                write_entries(f, [entry], default=default)
+                count += 1
+
+    os.rename(index_path + ".tmp", index_path)
+    return count
+
+
+def stale_records(output_dir: str) -> list[str]:
+    """The per-file JSON records under ``output_dir`` written (or rewritten)
+    after its ``records.idx``; all of them if there's no index."""
+    index_path = os.path.join(output_dir, DIRECTORY_INDEX)
+    try:
+        indexed = os.stat(index_path).st_mtime_ns
+    except FileNotFoundError:
+        indexed = -1
+
+    stale = []
+    for root, _, files in os.walk(output_dir):
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            if name.endswith(".json") and os.stat(path).st_mtime_ns > indexed:
+                stale.append(path)
+
+    return stale
+
+
+class RecordLookup(object):
+    """Index entries of an output directory by path hash, digest or URL.
+
+    The entries are kept in a SQLite file (``records.sqlite`` in the
+    directory), brought up to date when it's opened: the indexes added or
+    changed since (e.g. those of the shards finalized since) are read again,
+    and the entries of the removed ones dropped. Paths are stored relative to
+    the directory.
+
+    """
+    def __init__(self, output_dir: str, path: Optional[str] = None):
+        self.root = os.path.abspath(output_dir)
+        self._db = sqlite3.connect(path or os.path.join(output_dir, LOOKUP_DB), timeout=600)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS indexes ("
+                         "idx TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER)")
+        self._db.execute("CREATE TABLE IF NOT EXISTS entries ("
+                         "idx TEXT, file TEXT, offset INTEGER, length INTEGER, "
+                         "path_hash TEXT, digest TEXT, url TEXT, metadata TEXT)")
+        for column in ("idx", "path_hash", "digest", "url"):
+            self._db.execute(f"CREATE INDEX IF NOT EXISTS entries_{column} ON entries ({column})")
+        self.updated = self.update()
+
+    def update(self) -> int:
+        """Reads the indexes that changed; returns how many."""
+        current = {}
+        for index_path in find_indexes(self.root):
+            stat = os.stat(index_path)
+            current[os.path.basename(index_path)] = (stat.st_size, stat.st_mtime_ns)
+        known = {idx: (size, mtime_ns) for idx, size, mtime_ns
+                 in self._db.execute("SELECT idx, size, mtime_ns FROM indexes")}
+
+        changed = [idx for idx, stat in current.items() if known.get(idx) != stat]
+        with self._db:
+            for idx in changed + [idx for idx in known if idx not in current]:
+                self._db.execute("DELETE FROM entries WHERE idx = ?", (idx,))
+                self._db.execute("DELETE FROM indexes WHERE idx = ?", (idx,))
+            for idx in changed:
+                self._db.executemany(
+                    "INSERT INTO entries VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    ((idx, os.path.relpath(e["file"], self.root), e["offset"], e["length"],
+                      e["path_hash"], e["metadata"].get("digest"), e["metadata"].get("url"),
+                      json.dumps(e["metadata"], ensure_ascii=False))
+                     for e in read_index(os.path.join(self.root, idx))))
+                self._db.execute("INSERT INTO indexes VALUES (?, ?, ?)", (idx, *current[idx]))
+
+        return len(changed)
+
+    def find(self, path_hash: Optional[str] = None, digest: Optional[str] = None,
+             url: Optional[str] = None) -> Iterator[dict[str, Any]]:
+        """The entries with all of the given keys; a digest may leave out
+        its "sha1:"."""
+        conditions, params = [], []
+        if path_hash is not None:
+            conditions.append("path_hash = ?")
+            params.append(path_hash)
+        if digest is not None:
+            conditions.append("digest IN (?, ?)")
+            params += [digest, "sha1:" + digest]
+        if url is not None:
+            conditions.append("url = ?")
+            params.append(url)
+        if not conditions:
+            raise ValueError("No key to look up")
+
+        rows = self._db.execute("SELECT file, offset, length, path_hash, metadata FROM entries "
+                                "WHERE " + " AND ".join(conditions) + " ORDER BY idx, offset",
+                                params)
+        for file, offset, length, entry_path_hash, metadata in rows:
+            yield {"file": os.path.join(self.root, file), "offset": offset, "length": length,
+                   "path_hash": entry_path_hash, "metadata": json.loads(metadata)}
+
+    def close(self) -> None:
+        self._db.close()
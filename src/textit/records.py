@@ -0,0 +1,43 @@
+"""Incremental JSON encoding of output records.
+
+The text of a record can be large (whole books), so instead of joining its
+lines into one string and having ``json.dump`` escape that into yet another
+one, the content is encoded one line at a time. The result is byte for byte
+what ``json.dump`` writes for the record with the joined content as its last
+member.
+
+"""
+import json
+from typing import Any, Iterable, Iterator
+
+CONTENT_KEY = "raw_content"
+
+
+def iter_record_json(record: dict[str, Any], lines: Iterable[str], key: str = CONTENT_KEY,
+                     **kwargs) -> Iterator[str]:
+    """Yields the JSON of ``record`` with ``key`` set to ``"\\n".join(lines)``.
+
+    ``kwargs`` are passed to ``json.dumps`` (e.g. ``indent``, ``separators``,
+    ``default``); ``ensure_ascii`` defaults to False.
+
+    """
+    kwargs.setdefault("ensure_ascii", False)
+    separators = kwargs.get("separators")
+    key_separator = separators[1] if separators is not None else ": "
+
+    head = json.dumps({**record, key: ""}, **kwargs)
+    # Everything up to the opening quote of the (empty) content, and what
+    # comes after its closing quote.
+    empty = json.dumps(key, ensure_ascii=kwargs["ensure_ascii"]) + key_separator + '""'
+    split = head.rindex(empty) + len(empty) - 1
+    yield head[:split]
+
+    escape = json.JSONEncoder(ensure_ascii=kwargs["ensure_ascii"]).encode
+    first = True
+    for line in lines:
+        if not first:
+            yield "\\n"
+        first = False
+        yield escape(line)[1:-1]
+
+    yield head[split:]
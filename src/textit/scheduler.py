@@ -0,0 +1,253 @@
+"""Task cost estimation and longest-processing-time-first ordering.
+
+The cost of a task is predicted (in seconds) from cheap features of the input
+file: its type, size and, for PDFs, the page count and whether it will
+probably need OCR. Tasks are dispatched most expensive first, so that the
+long ones don't end up running alone at the end of the run; the cheap ones
+fill in the gaps.
+
+PDFs are opened by pdfium, which can crash or hang on broken files, so they
+are probed in worker processes with a time limit. A file that can't be
+probed gets the cost of its size.
+
+"""
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
+from dataclasses import dataclass, asdict
+from typing import Iterable, Iterator, Optional
+
+import numpy as np
+import pypdfium2
+
+from textit.metadata import FileType
+from textit.sniff import get_file_type
+from textit.archives import sort_size, split_member
+from textit.supervisor import Supervisor
+from textit.helpers import getLogger, format_exception
+
+MB = 2 ** 20
+
+# Pages looked at to guess if a PDF has a text layer.
+PROBE_PAGES = 3
+
+# Seconds that a PDF probe may take.
+PROBE_TIMEOUT = 10.0
+
+# The first windows are smaller, so that the workers don't wait for a whole
+# window to be probed at startup.
+FIRST_WINDOW = 64
+
+# pdfium isn't thread-safe.
+pdfium_lock = threading.Lock()
+
+# Seconds: fixed cost, per MB, per page with text, per page to OCR.
+DEFAULT_COEFFICIENTS = {
+    FileType.PDF.name: [0.5, 0.1, 0.05, 3.0],
+    FileType.DOC.name: [3.0, 1.0, 0.0, 0.0],
+    FileType.HTML.name: [0.05, 0.5, 0.0, 0.0],
+    FileType.RTF.name: [0.02, 0.1, 0.0, 0.0],
+    FileType.EPUB.name: [0.5, 5.0, 0.0, 0.0],
+    FileType.MOBI.name: [1.0, 5.0, 0.0, 0.0],
+    None: [0.01, 0.0, 0.0, 0.0],
+}
+
+# MB of memory that a task needs on top of an idle worker, with the same
+# features: fixed, per MB, per page with text, per page to OCR. Rough, only
+# meant to keep the big ones from starting together.
+MEMORY_COEFFICIENTS = {
+    FileType.PDF.name: [50, 10, 0.5, 20],
+    FileType.DOC.name: [50, 20, 0, 0],
+    FileType.HTML.name: [20, 50, 0, 0],
+    FileType.RTF.name: [10, 0, 0, 0],
+    FileType.EPUB.name: [50, 20, 0, 0],
+    FileType.MOBI.name: [50, 20, 0, 0],
+    None: [0, 0, 0, 0],
+}
+
+
+@dataclass
+class TaskFeatures:
+    file_type: Optional[str]
+    size: int
+    pages: Optional[int] = None
+    ocr_likely: Optional[bool] = None
+
+    def vector(self) -> list[float]:
+        pages = self.pages or 0
+        ocr_pages = pages if self.ocr_likely else 0
+        return [1.0, self.size / MB, pages - ocr_pages, ocr_pages]
+
+
+@dataclass
+class CostEstimate:
+    features: TaskFeatures
+    cost: float
+
+
+def probe_pdf(path: str) -> tuple[Optional[int], Optional[bool]]:
+    """Page count, and whether the first pages have no text (i.e. need OCR)."""
+    with pdfium_lock:
+        try:
+            pdf = pypdfium2.PdfDocument(path)
+        except Exception:
+            # Broken or encrypted; the handler will find out.
+            return None, None
+
+        try:
+            pages = len(pdf)
+            empty = 0
+            for i in range(min(PROBE_PAGES, pages)):
+                page = pdf[i]
+                if page.get_textpage().count_chars() == 0:
+                    empty += 1
+
+            return pages, pages > 0 and empty == min(PROBE_PAGES, pages)
+        finally:
+            pdf.close()
+
+
+def _probe_pdf_task(task: tuple[int, str]) -> tuple[int, tuple[Optional[int], Optional[bool]]]:
+    i, path = task
+    return i, probe_pdf(path)
+
+
+def _probe_pdf_failed(task, reason, events, elapsed, pid):
+    getLogger().warning(f"Probing '{task[1]}' failed ({reason} after {elapsed:.1f}s), "
+                        f"estimating its cost from its size")
+    return task[0], (None, None)
+
+
+def probe(path: str, size: int, pdf: bool = True) -> TaskFeatures:
+    """Features of a file; its size only if it can't be read. PDFs are only
+    opened if ``pdf``."""
+    if split_member(path) is not None:
+        # Not worth reading from the archive (see estimate()).
+        return TaskFeatures(None, size)
+
+    try:
+        file_type = get_file_type(path)
+        features = TaskFeatures(file_type.name if file_type else None, size)
+        if pdf and file_type == FileType.PDF:
+            features.pages, features.ocr_likely = probe_pdf(path)
+    except Exception as e:
+        getLogger().warning(f"Couldn't probe '{path}', estimating its cost from its size:"
+                            f"{format_exception(e)}")
+        return TaskFeatures(None, size)
+
+    return features
+
+
+class CostModel(object):
+    """Per file type linear model over TaskFeatures.vector()."""
+    def __init__(self, coefficients: Optional[dict] = None):
+        self.coefficients = dict(DEFAULT_COEFFICIENTS)
+        if coefficients:
+            self.coefficients.update(coefficients)
+
+    def predict(self, features: TaskFeatures) -> float:
+        coefficients = self.coefficients.get(features.file_type, self.coefficients[None])
+        return float(np.dot(coefficients, features.vector()))
+
+    def fit(self, samples: Iterable[tuple[TaskFeatures, float]], min_samples: int = 20) -> None:
+        """Recalibrates from (features, actual duration) pairs.
+
+        File types with fewer than ``min_samples`` samples keep their
+        coefficients.
+
+        """
+        by_type = {}
+        for features, duration in samples:
+            by_type.setdefault(features.file_type, []).append((features.vector(), duration))
+
+        for file_type, rows in by_type.items():
+            if len(rows) < min_samples:
+                continue
+
+            x = np.array([v for v, _ in rows])
+            y = np.array([d for _, d in rows])
+            coefficients, *_ = np.linalg.lstsq(x, y, rcond=None)
+            # Negative costs make no sense; they come from features that
+            # don't vary (e.g. no OCR-ed PDFs in the sample).
+            self.coefficients[file_type] = [max(0.0, float(c)) for c in coefficients]
+
+    def save(self, path: str) -> None:
+        with open(path, "w") as f:
+            json.dump({str(k): v for k, v in self.coefficients.items()}, f, indent=2)
+
+    @classmethod
+    def load(cls, path: str) -> "CostModel":
+        with open(path) as f:
+            coefficients = json.load(f)
+
+        return cls({(None if k == "None" else k): v for k, v in coefficients.items()})
+
+
+def predict_memory(features: TaskFeatures) -> int:
+    """Bytes of memory that the task will probably need."""
+    coefficients = MEMORY_COEFFICIENTS.get(features.file_type, MEMORY_COEFFICIENTS[None])
+    return int(np.dot(coefficients, features.vector()) * MB)
+
+
+def estimate(model: CostModel, path: str, size: int,
+             features: Optional[TaskFeatures] = None) -> CostEstimate:
+    if features is None:
+        features = probe(path, size)
+    if split_member(path) is not None:
+        # All the members of an archive cost the same, so that they keep its
+        # order.
+        return CostEstimate(features, model.predict(TaskFeatures(None, sort_size(path, size))))
+    return CostEstimate(features, model.predict(features))
+
+
+def schedule(tasks: Iterable[tuple[int, tuple[str, str]]], window: int, model: CostModel,
+             probe_threads: int = 8, probe_processes: int = 2,
+             probe_timeout: Optional[float] = PROBE_TIMEOUT,
+             context: str = "forkserver") -> Iterator[tuple[str, str, CostEstimate]]:
+    """Orders windows of (size, (input, output)) tasks, most expensive first.
+
+    The files of a window are sniffed by a thread pool, since that's mostly
+    waiting for I/O, and its PDFs probed by ``probe_processes`` processes,
+    each within ``probe_timeout`` seconds (0 processes to probe them on the
+    threads, with no time limit). Windows start at FIRST_WINDOW tasks and
+    double up to ``window``.
+
+    """
+    def flush(buffer):
+        inputs = [task[0] for _, task in buffer]
+        sizes = [size for size, _ in buffer]
+        features = list(executor.map(lambda a: probe(*a, pdf=pool is None), zip(inputs, sizes)))
+        pdfs = [(i, inputs[i]) for i, f in enumerate(features)
+                if f.file_type == FileType.PDF.name]
+        if pool is not None and pdfs:
+            for i, (pages, ocr_likely) in pool.imap_unordered(pdfs, prefetch=len(pdfs)):
+                features[i].pages, features[i].ocr_likely = pages, ocr_likely
+        scheduled = [(*task, estimate(model, path, size, f))
+                     for (size, task), path, f in zip(buffer, inputs, features)]
+        scheduled.sort(key=lambda e: e[2].cost, reverse=True)
+        return scheduled
+
+    pool = None
+    if probe_processes > 0:
+        pool = Supervisor(probe_processes, _probe_pdf_task, budget=lambda *_: probe_timeout,
+                          on_failure=_probe_pdf_failed, context=context)
+    with ThreadPoolExecutor(probe_threads) as executor, pool or nullcontext():
+        buffer = []
+        current_window = min(FIRST_WINDOW, window)
+        for item in tasks:
+            buffer.append(item)
+            if len(buffer) >= current_window:
+                yield from flush(buffer)
+                buffer = []
+                current_window = min(2 * current_window, window)
+
+        yield from flush(buffer)
+
+
+def features_to_json(features: Optional[TaskFeatures]) -> Optional[str]:
+    return None if features is None else json.dumps(asdict(features))
+
+
+def features_from_json(s: str) -> TaskFeatures:
+    return TaskFeatures(**json.loads(s))
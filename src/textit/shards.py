@@ -0,0 +1,292 @@
+"""Compressed JSONL output shards.
+
+Each worker appends its records to its own shard, as compact JSON lines. A
+record is compressed on its own (one gzip member or zstd frame), so that a
+shard is still a valid file after every record and a reader can start at
+any record boundary. Shards are written under a ``.tmp`` name and renamed
+once they are full (``max_bytes`` or ``max_records``) or the worker exits.
+Each shard has a sidecar index (see record_index) to find its records
+without decompressing it.
+
+"""
+import json
+import os
+import socket
+import zlib
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from textit.helpers import getLogger
+from textit.records import iter_record_json
+from textit.record_index import INDEX_SUFFIX, find_indexes, index_entry, read_index, write_entries
+
+SUFFIXES = {"gzip": ".jsonl.gz", "zstd": ".jsonl.zst"}
+TMP_SUFFIX = ".tmp"
+READ_SIZE = 2 ** 20
+
+
+def compression_of(path: str) -> Optional[str]:
+    for compression, suffix in SUFFIXES.items():
+        if path.endswith(suffix) or path.endswith(suffix + TMP_SUFFIX):
+            return compression
+
+    return None
+
+
+def _compressor(compression: str, level: Optional[int]) -> Callable[[], Any]:
+    """Factory of compressobj-like objects, each making one member/frame."""
+    if compression == "gzip":
+        level = 6 if level is None else level
+        return lambda: zlib.compressobj(level, zlib.DEFLATED, 31)
+    if compression == "zstd":
+        if zstandard is None:
+            raise ImportError("zstd shards need the 'zstandard' package")
+        cctx = zstandard.ZstdCompressor(level=3 if level is None else level)
+        return cctx.compressobj
+
+    raise ValueError(f"Unknown shard compression '{compression}'")
+
+
+def _decompressobj(compression: str):
+    if compression == "gzip":
+        return zlib.decompressobj(wbits=31)
+    if zstandard is None:
+        raise ImportError("zstd shards need the 'zstandard' package")
+    return zstandard.ZstdDecompressor().decompressobj()
+
+
+def decompress_member(compression: str, data: bytes) -> bytes:
+    d = _decompressobj(compression)
+    out = d.decompress(data)
+    if not d.eof:
+        raise ValueError("Truncated shard record")
+    return out
+
+
+def iter_members(path: str) -> Iterator[tuple[int, int, bytes]]:
+    """Yields (offset, length, data) for the complete records of a shard.
+
+    Stops at the first truncated or corrupt one (e.g. the tail of a shard
+    whose worker was killed). The shard is read in chunks: what's left of a
+    chunk after a record goes on to the next one.
+
+    """
+    compression = compression_of(path)
+    errors = (zlib.error, getattr(zstandard, "ZstdError", zlib.error))
+    with open(path, "rb") as f:
+        offset = 0
+        data = f.read(READ_SIZE)
+        while data:
+            d = _decompressobj(compression)
+            out = []
+            fed = 0
+            while True:
+                try:
+                    out.append(d.decompress(data))
+                except errors:
+                    return
+                if d.eof:
+                    break
+                fed += len(data)
+                data = f.read(READ_SIZE)
+                if not data:
+                    return
+
+            length = fed + len(data) - len(d.unused_data)
+            yield offset, length, b"".join(out)
+            offset += length
+            data = d.unused_data or f.read(READ_SIZE)
+
+
+def iter_records(path: str) -> Iterator[dict[str, Any]]:
+    for _, _, data in iter_members(path):
+        yield json.loads(data.decode("utf-8", "surrogateescape"))
+
+
+class ShardWriter(object):
+    """Appends records to rotating shards named
+    ``<host>-<pid>-<run>-<sequence><suffix>`` in ``output_dir``."""
+    def __init__(self, output_dir: str, run: str, compression: str = "gzip",
+                 max_bytes: int = 256 * 2 ** 20, max_records: int = 100000,
+                 level: Optional[int] = None):
+        self.output_dir = output_dir
+        self.name = f"{socket.gethostname()}-{os.getpid()}-{run}"
+        self.suffix = SUFFIXES[compression]
+        self.max_bytes = max_bytes
+        self.max_records = max_records
+        self._compress = _compressor(compression, level)
+        self._sequence = 0
+        self._file = None
+        self._path = None
+
+    def _open(self) -> None:
+        os.makedirs(self.output_dir, exist_ok=True)
+        self._path = os.path.join(self.output_dir,
+                                  f"{self.name}-{self._sequence:05d}{self.suffix}")
+        self._sequence += 1
+        self._file = open(self._path + TMP_SUFFIX, "wb")
+        self._index = open(self._path + INDEX_SUFFIX + TMP_SUFFIX, "w", encoding="utf-8",
+                           errors="surrogateescape")
+        self._records = 0
+
+    def write(self, record: dict[str, Any], default=None,
+              lines: Optional[Iterable[str]] = None, path_hash: Optional[str] = None) -> str:
+        """Returns the path that the shard will have once it's finalized.
+
+        If ``lines`` is given, they are streamed as the record's content
+        (see records.iter_record_json).
+
+        """
+        if self._file is None:
+            self._open()
+
+        if lines is None:
+            chunks = [json.dumps(record, ensure_ascii=False, separators=(",", ":"), default=default)]
+        else:
+            chunks = iter_record_json(record, lines, separators=(",", ":"), default=default)
+
+        start = self._file.tell()
+        compressor = self._compress()
+        try:
+            for chunk in chunks:
+                self._file.write(compressor.compress(chunk.encode("utf-8", "surrogateescape")))
+            self._file.write(compressor.compress(b"\n"))
+            self._file.write(compressor.flush())
+        except BaseException:
+            # Don't leave half a record in the middle of the shard.
+            self._file.seek(start)
+            self._file.truncate()
+            raise
+
+        # Finished tasks are in the file, even if the worker dies later.
+        self._file.flush()
+        entry = index_entry(record, os.path.basename(self._path), start,
+                            self._file.tell() - start, path_hash)
+        write_entries(self._index, [entry], default=default)
+        self._index.flush()
+        self._records += 1
+        path = self._path
+        if self._records >= self.max_records or self._file.tell() >= self.max_bytes:
+            self.finalize()
+
+        return path
+
+    def finalize(self) -> None:
+        if self._file is None:
+            return
+
+        for f in (self._index, self._file):
+            os.fsync(f.fileno())
+            f.close()
+        # A finalized shard always has its index.
+        os.rename(self._path + INDEX_SUFFIX + TMP_SUFFIX, self._path + INDEX_SUFFIX)
+        os.rename(self._path + TMP_SUFFIX, self._path)
+        getLogger().debug(f"Finalized shard '{self._path}' ({self._records} records)")
+        self._file = None
+
+    close = finalize
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def shard_run(name: str) -> Optional[str]:
+    """The run that wrote a shard (or its index), from its name."""
+    for suffix in SUFFIXES.values():
+        if suffix in name:
+            parts = name[:name.index(suffix)].rsplit("-", 3)
+            return parts[2] if len(parts) == 4 else None
+
+    return None
+
+
+def shard_runs(output_dir: str) -> dict[str, bool]:
+    """The runs that wrote shards in ``output_dir``, and whether all their
+    shards are finalized."""
+    runs = {}
+    for entry in os.scandir(output_dir):
+        run = shard_run(entry.name)
+        if run is not None:
+            runs[run] = runs.get(run, True) and not entry.name.endswith(TMP_SUFFIX)
+
+    return runs
+
+
+def run_entries(output_dir: str, run: str) -> Iterator[dict[str, Any]]:
+    """The index entries of the finalized shards of ``run``."""
+    for index in find_indexes(output_dir):
+        if shard_run(os.path.basename(index)) == run:
+            yield from read_index(index)
+
+
+def recover_shards(output_dir: str, path_hash: Optional[Callable[[dict], str]] = None,
+                   pid: Optional[int] = None) -> int:
+    """Finalizes the shards left behind by dead workers of this host (only
+    those of worker ``pid``, if given).
+
+    Their incomplete last record, if any, is cut off; the task it belongs to
+    wasn't recorded as done, so it runs again. The index entries of the
+    complete records that are missing (written right before the crash) are
+    rebuilt from the records, with ``path_hash(record)`` as their path hash.
+    Returns the number of shards recovered.
+
+    """
+    if not os.path.isdir(output_dir):
+        return 0
+
+    host = socket.gethostname()
+    recovered = 0
+    for entry in list(os.scandir(output_dir)):
+        if not entry.name.endswith(TMP_SUFFIX) or compression_of(entry.name) is None:
+            continue
+
+        # The host name may contain dashes, the rest doesn't.
+        owner, writer, *_ = entry.name.rsplit("-", 3)
+        if owner != host or not writer.isdigit():
+            continue
+        if int(writer) != pid if pid is not None else _pid_alive(int(writer)):
+            continue
+
+        path = entry.path[:-len(TMP_SUFFIX)]
+        index_tmp = path + INDEX_SUFFIX + TMP_SUFFIX
+        indexed = {}
+        if os.path.exists(index_tmp):
+            indexed = {e["offset"]: e for e in read_index(index_tmp)}
+
+        entries = []
+        for offset, length, data in iter_members(entry.path):
+            if offset in indexed and indexed[offset]["length"] == length:
+                item = indexed[offset]
+                item["file"] = os.path.basename(path)
+            else:
+                record = json.loads(data.decode("utf-8", "surrogateescape"))
+                item = index_entry(record, os.path.basename(path), offset, length,
+                                   path_hash(record) if path_hash is not None else None)
+            entries.append(item)
+
+        if entries:
+            end = entries[-1]["offset"] + entries[-1]["length"]
+            with open(entry.path, "r+b") as f:
+                f.truncate(end)
+            with open(index_tmp, "w", encoding="utf-8", errors="surrogateescape") as f:
+                write_entries(f, entries)
+            os.rename(index_tmp, path + INDEX_SUFFIX)
+            os.rename(entry.path, path)
+            recovered += 1
+        else:
+            os.remove(entry.path)
+            if os.path.exists(index_tmp):
+                os.remove(index_tmp)
+
+    return recovered
@@ -0,0 +1,211 @@
+"""In-process file type detection from magic bytes.
+
+Meant to agree with what ``file -b`` (libmagic) reports for the types that we
+handle, without forking a process per file. When the answer isn't clear, the
+result is an error and the caller should fall back to ``file``.
+
+"""
+import io
+import os
+import struct
+import subprocess
+import zipfile
+from typing import BinaryIO, Optional
+
+from textit.metadata import FileType
+from textit.helpers import Result, getLogger, format_exception
+
+# libmagic looks for HTML tags in the first 4K of text files.
+HEAD_SIZE = 4096
+
+OLE2_MAGIC = b"\xd0\xcf\x11\xe0\xa1\xb1\x1a\xe1"
+ZIP_MAGIC = b"PK\x03\x04"
+EPUB_MIMETYPE = b"mimetypeapplication/epub+zip"
+PALMDB_MOBI = b"BOOKMOBI"
+RTF_MAGIC = b"{\\rtf"
+UTF8_BOM = b"\xef\xbb\xbf"
+# Before the UTF-16 ones, which they start with.
+UTF32_BOMS = (b"\xff\xfe\x00\x00", b"\x00\x00\xfe\xff")
+UTF16_BOMS = (b"\xff\xfe", b"\xfe\xff")
+
+HTML_MARKERS = (b"<!doctype html", b"<html", b"<head", b"<title", b"<body")
+
+# Bytes that don't show up in text files.
+BINARY_BYTES = bytes(range(0, 8)) + bytes(range(14, 27)) + bytes(range(28, 32))
+WORD_STREAM = "WordDocument".encode("utf-16-le")
+
+
+def _sniff_ole2(f: BinaryIO, head: bytes) -> Result[Optional[FileType]]:
+    """Word documents have a "WordDocument" stream in the root directory."""
+    if len(head) < 0x34:
+        return Result.err("Truncated OLE2 header")
+
+    sector_shift, = struct.unpack_from("<H", head, 0x1e)
+    first_dir_sector, = struct.unpack_from("<I", head, 0x30)
+    # 512 byte sectors in version 3, 4096 in version 4.
+    if sector_shift not in (9, 12):
+        return Result.err(f"Bad OLE2 sector shift {sector_shift}")
+    sector_size = 1 << sector_shift
+    directory_offset = (first_dir_sector + 1) * sector_size
+    size = f.seek(0, os.SEEK_END)
+    if directory_offset >= size:
+        return Result.err("OLE2 directory past the end of the file")
+    f.seek(directory_offset)
+    directory = f.read(sector_size)
+    # Each entry is 128 bytes, starting with its UTF-16 name.
+    for offset in range(0, len(directory) - 127, 128):
+        name_len, = struct.unpack_from("<H", directory, offset + 64)
+        if directory[offset:offset + name_len - 2] == WORD_STREAM:
+            return Result.ok(FileType.DOC)
+
+    if len(directory) < sector_size:
+        return Result.err("Truncated OLE2 directory")
+
+    # The stream might be in another directory sector.
+    return Result.err("No WordDocument stream in the first OLE2 directory sector")
+
+
+def rtf_start(head: bytes) -> Optional[int]:
+    """Where an RTF document starts: ``{\\rtf``, after a UTF-8 BOM and
+    whitespace if any. None if it's not one.
+
+    The RTF handler goes by the same rule (libmagic only by the first one).
+
+    """
+    start = len(UTF8_BOM) if head.startswith(UTF8_BOM) else 0
+    start += len(head[start:]) - len(head[start:].lstrip())
+    return start if head.startswith(RTF_MAGIC, start) else None
+
+
+def _sniff_zip(f: BinaryIO, head: bytes) -> Result[Optional[FileType]]:
+    # Same check as libmagic: an uncompressed "mimetype" first entry.
+    if head[30:30 + len(EPUB_MIMETYPE)] == EPUB_MIMETYPE:
+        return Result.ok(FileType.EPUB)
+
+    try:
+        f.seek(0)
+        with zipfile.ZipFile(f) as zf:
+            names = zf.namelist()
+    except (zipfile.BadZipFile, OSError) as e:
+        return Result.err(f"Unreadable zip: {e}")
+
+    if "word/document.xml" in names:
+        # DOCX is handled by the DOC handler.
+        return Result.ok(FileType.DOC)
+
+    return Result.ok(None)
+
+
+def _looks_like_utf16(sample: bytes) -> bool:
+    """Mostly ASCII text in UTF-16, without a BOM: one byte of every pair is
+    zero."""
+    even, odd = sample[0::2], sample[1::2]
+    if len(odd) < 16:
+        return False
+    zeros = sorted((even.count(0) / len(even), odd.count(0) / len(odd)))
+    return zeros[0] < 0.1 and zeros[1] > 0.9
+
+
+def _sniff_text(head: bytes) -> Result[Optional[FileType]]:
+    if head.startswith(UTF8_BOM):
+        head = head[len(UTF8_BOM):]
+    elif head.startswith(UTF32_BOMS):
+        head = head.decode("utf-32", "ignore").encode("utf-8")
+    elif head.startswith(UTF16_BOMS):
+        head = head.decode("utf-16", "ignore").encode("utf-8")
+    elif _looks_like_utf16(head[:512]):
+        # libmagic reads it as text, leave it the decision.
+        return Result.err("UTF-16 text without a BOM")
+
+    lower = head.lower()
+    if any(b in BINARY_BYTES for b in head[:512]):
+        if b"%pdf-" in lower:
+            return Result.err("PDF header after the start of a binary file")
+        return Result.ok(None)
+
+    if any(marker in lower for marker in HTML_MARKERS):
+        return Result.ok(FileType.HTML)
+
+    if b"%pdf-" in lower:
+        # libmagic sometimes still calls these PDFs.
+        return Result.err("PDF header after the start of the file")
+
+    return Result.ok(None)
+
+
+def sniff_file_type(f: BinaryIO) -> Result[Optional[FileType]]:
+    """Guesses the file type from the contents of a seekable binary file.
+
+    Returns ``Result.ok(None)`` for files we know we can't handle and an
+    error when the type is ambiguous.
+
+    """
+    f.seek(0)
+    head = f.read(HEAD_SIZE)
+    if head.startswith(b"%PDF-"):
+        return Result.ok(FileType.PDF)
+    if head.startswith(OLE2_MAGIC):
+        return _sniff_ole2(f, head)
+    if head.startswith(ZIP_MAGIC):
+        return _sniff_zip(f, head)
+    if head[60:68] == PALMDB_MOBI:
+        return Result.ok(FileType.MOBI)
+    if rtf_start(head) is not None:
+        # Before the text checks: RTF converted from HTML has the tags in it.
+        return Result.ok(FileType.RTF)
+
+    return _sniff_text(head)
+
+
+def file_type_from_libmagic(file_path: str, buffer=None) -> Optional[FileType]:
+    """Asks ``file -b``; slow (one process per file), but authoritative.
+
+    Files that aren't on disk (archive members) are piped in from ``buffer``.
+
+    """
+    try:
+        if buffer is not None and not os.path.exists(file_path):
+            result = subprocess.run(['file', '-b', '-'], input=bytes(buffer),
+                                    capture_output=True, check=True)
+        else:
+            result = subprocess.run(['file', '-b', file_path], capture_output=True, check=True)
+        file_info = result.stdout.decode("utf-8", "replace").strip().upper()
+        if "HTML" in file_info:
+            return FileType.HTML
+        if "EPUB" in file_info:
+            return FileType.EPUB
+        if "MOBIPOCKET" in file_info:
+            return FileType.MOBI
+        if "RICH TEXT" in file_info:
+            return FileType.RTF
+        elif "PDF" in file_info:
+            return FileType.PDF
+        elif "MICROSOFT WORD" in file_info or "MICROSOFT OFFICE WORD" in file_info:
+            return FileType.DOC
+        else:
+            return None
+    except subprocess.CalledProcessError as e:
+        getLogger().error(f"Couldn't get file type for '{file_path}':{format_exception(e)}")
+        return None
+
+
+def get_file_type(file_path: str, buffer=None) -> Optional[FileType]:
+    """Sniffs the type in-process, only asking ``file`` if that's ambiguous.
+
+    ``buffer`` may be the contents of the file, if they are already in memory.
+
+    """
+    try:
+        if buffer is not None:
+            sniffed = sniff_file_type(buffer if hasattr(buffer, "seek") else io.BytesIO(buffer))
+        else:
+            with open(file_path, "rb") as f:
+                sniffed = sniff_file_type(f)
+    except (OSError, ValueError, struct.error) as e:
+        sniffed = Result.err(str(e))
+
+    if sniffed.is_ok():
+        return sniffed.unwrap()
+
+    getLogger().debug(f"Ambiguous file type for '{file_path}' ({sniffed._error}), asking 'file'")
+    return file_type_from_libmagic(file_path, buffer)
@@ -0,0 +1,474 @@
+"""Worker processes with a time budget per task.
+
+A replacement for ``multiprocessing.Pool.imap_unordered`` that knows which
+task each worker is running. A worker that goes over the budget of its task
+is killed together with its children (each worker leads its own process
+group, so this includes OCR and soffice subprocesses) and replaced; a worker
+that dies is replaced too. Either way the task is reported through the
+``on_failure`` callback instead of hanging the run.
+
+The budget can change while a task runs: workers ``report`` what they are
+doing (e.g. the file type once it's known, or that OCR started) and the
+``budget`` callback computes the new deadline from that. Events are kept as
+``{name: (value, seconds since the task started)}``.
+
+Workers are also recycled (asked to exit after their task, and replaced)
+once their RSS or the number of tasks they ran goes over a limit, and tasks
+expected to need a lot of memory wait until enough of it is available.
+
+With a writer queue, the work that a task ``defer``-s (writing its output)
+runs on a thread of the worker while the worker goes on with its next task.
+The worker is given that next task as soon as the previous one is handed to
+the writer, but a task is only reported as done once its deferred work is.
+The writer queue is bounded, so a worker whose writes fall behind stops
+taking new tasks. The budget of a task covers its deferred work too: a
+worker whose writer thread is still on it past the deadline is killed (and
+the task it was running meanwhile fails with it).
+
+"""
+import multiprocessing as mp
+import os
+import queue
+import signal
+import threading
+import time
+import traceback
+from multiprocessing.connection import wait
+from collections import Counter
+from typing import Any, Callable, Iterable, Iterator, Optional
+
+# report is called from the tasks, see textit.events.
+from textit.events import connect as _connect, report, send as _send
+
+# Writer thread of the worker, and the work deferred by its current task.
+_writer = None
+_deferred = []
+
+_END = object()
+
+MB = 2 ** 20
+
+# Seconds between RSS samples of the workers.
+RSS_INTERVAL = 1.0
+
+
+def process_rss(pid: int) -> Optional[int]:
+    """Resident set size in bytes, None if the process is gone."""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except (FileNotFoundError, ProcessLookupError):
+        return None
+    return 0
+
+
+def available_memory() -> Optional[int]:
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def defer(job: Callable[[Any], Any]) -> bool:
+    """Runs ``job(result)`` on the writer thread once the current task
+    returned ``result``; what it returns becomes the result of the task.
+
+    ``job`` should handle its own errors, an exception kills the worker.
+    Returns False, without running it, if the worker has no writer thread.
+
+    """
+    if _writer is None:
+        return False
+    _deferred.append(job)
+    return True
+
+
+def _write_loop(jobs: queue.Queue) -> None:
+    while (item := jobs.get()) is not None:
+        seq, deferred, result = item
+        start = time.perf_counter()
+        try:
+            for job in deferred:
+                result = job(result)
+        except BaseException:
+            traceback.print_exc()
+            os._exit(1)
+        _send(("done", seq, result, time.perf_counter() - start))
+
+
+def _worker_main(conn, initializer, initargs, func, writer_queue):
+    global _writer
+    # Our own process group, so that our children can be killed with us.
+    os.setpgid(0, 0)
+    _connect(conn)
+    if writer_queue:
+        jobs = queue.Queue(maxsize=writer_queue)
+        _writer = threading.Thread(target=_write_loop, args=(jobs,), name="writer")
+        _writer.start()
+    if initializer is not None:
+        initializer(*initargs)
+    _send(("ready", None))
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        seq, task = message
+        result = func(task)
+        if _deferred:
+            # Blocks while the writer is behind.
+            jobs.put((seq, list(_deferred), result))
+            _deferred.clear()
+            _send(("free", seq))
+        else:
+            _send(("done", seq, result, 0.0))
+
+    if _writer is not None:
+        jobs.put(None)
+        _writer.join()
+
+
+class _Worker(object):
+    def __init__(self, ctx, initializer, initargs, func, writer_queue):
+        self.conn, child_conn = ctx.Pipe()
+        self.process = ctx.Process(target=_worker_main, name="textit-worker",
+                                   args=(child_conn, initializer, initargs, func, writer_queue))
+        self.process.start()
+        child_conn.close()
+        self.ready = False
+        self.task = None
+        self.seq = 0
+        self.events = {}
+        self.start = None
+        self.deadline = None
+        self.tasks_done = 0
+        # Tasks handed to the writer: seq -> (task, events, start, deadline).
+        self.writing = {}
+        # Why the worker is to be recycled once it's idle.
+        self.retire = None
+        self.rss_peak = 0
+        self.rss_sum = 0
+        self.rss_samples = 0
+
+    def assign(self, task, budget: Optional[float]) -> None:
+        self.task = task
+        self.seq += 1
+        self.events = {}
+        self.start = time.monotonic()
+        self.deadline = None if budget is None else self.start + budget
+        self.conn.send((self.seq, task))
+
+    def busy(self) -> bool:
+        return self.task is not None or bool(self.writing)
+
+    def sample_rss(self) -> int:
+        rss = process_rss(self.process.pid) or 0
+        self.rss_peak = max(self.rss_peak, rss)
+        self.rss_sum += rss
+        self.rss_samples += 1
+        return rss
+
+    def stats(self) -> dict[str, Any]:
+        return {"pid": self.process.pid, "tasks": self.tasks_done, "rss_peak": self.rss_peak,
+                "rss_mean": self.rss_sum / self.rss_samples if self.rss_samples else 0}
+
+    def release(self) -> float:
+        """Frees the worker for another task, returns how long it took."""
+        self.task = None
+        self.deadline = None
+        return time.monotonic() - self.start
+
+    def kill(self) -> None:
+        pid = self.process.pid
+        try:
+            if os.getpgid(pid) == pid:
+                os.killpg(pid, signal.SIGKILL)
+            else:
+                # Still starting, it has no children yet.
+                self.process.kill()
+        except ProcessLookupError:
+            pass
+        self.process.join()
+        self.conn.close()
+
+
+class Supervisor(object):
+    """``budget(task, events)`` gives the budget in seconds (None for no
+    limit) of a task, from the events reported so far; ``on_failure(task,
+    reason, events, elapsed, pid)`` builds the result of a task whose worker
+    (process ``pid``) was killed ("timeout") or died ("crash").
+
+    Workers are recycled after ``max_tasks`` tasks or once their RSS is over
+    ``max_rss`` bytes. A task for which ``memory_needed(task)`` (bytes) is
+    more than the available memory minus ``memory_reserve`` waits for the
+    running ones, unless none are running.
+
+    ``writer_queue`` is how many tasks' deferred work can wait for the writer
+    thread of a worker (0 for no writer thread).
+
+    """
+    def __init__(self, num_workers: int, func: Callable, initializer: Optional[Callable] = None,
+                 initargs: Iterable = (),
+                 budget: Callable[[Any, dict], Optional[float]] = lambda *_: None,
+                 on_failure: Callable[[Any, str, dict, float, int], Any] = lambda *_: None,
+                 context: str = "forkserver", max_tasks: Optional[int] = None,
+                 max_rss: Optional[int] = None,
+                 memory_needed: Callable[[Any], int] = lambda _: 0, memory_reserve: int = 0,
+                 writer_queue: int = 0):
+        self.ctx = mp.get_context(context)
+        self.num_workers = num_workers
+        self.func = func
+        self.initializer = initializer
+        self.initargs = tuple(initargs)
+        self.budget = budget
+        self.on_failure = on_failure
+        self.max_tasks = max_tasks
+        self.max_rss = max_rss
+        self.memory_needed = memory_needed
+        self.memory_reserve = memory_reserve
+        self.writer_queue = writer_queue
+        self.workers = []
+        self.retiring = []
+        self.replaced = 0
+        self.recycled = Counter()
+        self.waited_for_memory = 0
+        # Stats of the workers that are gone.
+        self.worker_stats = []
+        # Seconds spent on tasks and on deferred work, by all the workers.
+        self.busy_seconds = 0.0
+        self.write_seconds = 0.0
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.monotonic()
+        self.workers = [self._spawn() for _ in range(self.num_workers)]
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+        return False
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self.ctx, self.initializer, self.initargs, self.func, self.writer_queue)
+
+    def _replace(self, worker: _Worker) -> None:
+        worker.kill()
+        self.workers[self.workers.index(worker)] = self._spawn()
+        self.worker_stats.append(worker.stats())
+        self.replaced += 1
+
+    def _recycle(self, worker: _Worker, reason: str) -> None:
+        """Lets an idle worker exit on its own and starts another one."""
+        try:
+            worker.conn.send(None)
+        except OSError:
+            pass
+        self.retiring.append(worker)
+        self.workers[self.workers.index(worker)] = self._spawn()
+        self.worker_stats.append(worker.stats())
+        self.recycled[reason] += 1
+
+    def _reap(self) -> None:
+        for worker in list(self.retiring):
+            if not worker.process.is_alive():
+                worker.process.join()
+                worker.conn.close()
+                self.retiring.remove(worker)
+
+    def _after_task(self, worker: _Worker) -> None:
+        rss = worker.sample_rss()
+        if self.max_rss is not None and rss > self.max_rss:
+            worker.retire = worker.retire or "memory"
+        elif self.max_tasks is not None and worker.tasks_done >= self.max_tasks:
+            worker.retire = worker.retire or "tasks"
+        # Not before its writer is done, the results would be lost.
+        if worker.retire and not worker.busy():
+            self._recycle(worker, worker.retire)
+
+    def _has_headroom(self, task) -> bool:
+        needed = self.memory_needed(task)
+        if not needed:
+            return True
+        available = available_memory()
+        return available is None or needed <= available - self.memory_reserve
+
+    def rss_stats(self) -> list[dict[str, Any]]:
+        """pid, tasks, rss_peak and rss_mean of every worker of the run."""
+        return self.worker_stats + [w.stats() for w in self.workers]
+
+    def utilisation(self) -> dict[str, float]:
+        """Fraction of the time that the workers spent on tasks, and their
+        writer threads on deferred work."""
+        capacity = self.num_workers * (time.monotonic() - self.started)
+        return {"workers": self.busy_seconds / capacity if capacity else 0.0,
+                "writers": self.write_seconds / capacity if capacity else 0.0}
+
+    def _fail(self, worker: _Worker, reason: str, late: Iterable[int] = ()) -> list[Any]:
+        """Results of the task of a worker that died or was killed, and of
+        the tasks that it hadn't written yet ("crash", or "timeout" for those
+        in ``late``)."""
+        now = time.monotonic()
+        pid = worker.process.pid
+        failed = [(task, "timeout" if seq in late else "crash", events, now - start, pid)
+                  for seq, (task, events, start, _) in worker.writing.items()]
+        if worker.task is not None:
+            failed.append((worker.task, reason, worker.events, now - worker.start, pid))
+            self.busy_seconds += worker.release()
+        self._replace(worker)
+        return [self.on_failure(*args) for args in failed]
+
+    def close(self) -> None:
+        """Lets the workers exit on their own, once they're done."""
+        for worker in self.workers:
+            try:
+                worker.conn.send(None)
+            except OSError:
+                pass
+        for worker in self.workers + self.retiring:
+            worker.process.join()
+            worker.conn.close()
+        self.retiring = []
+
+    def terminate(self) -> None:
+        for worker in self.workers + self.retiring:
+            worker.kill()
+
+    def imap_unordered(self, tasks: Iterable, prefetch: int = 1) -> Iterator[Any]:
+        """Results of the tasks, as they finish.
+
+        ``tasks`` is consumed by a thread, at most ``prefetch`` tasks ahead of
+        the workers.
+
+        """
+        pending = queue.Queue(maxsize=max(1, prefetch))
+
+        def feed():
+            try:
+                for task in tasks:
+                    pending.put(task)
+            except BaseException as e:
+                pending.put(e)
+            pending.put(_END)
+
+        threading.Thread(target=feed, name="task-feeder", daemon=True).start()
+
+        exhausted = False
+        held = None
+        last_sample = time.monotonic()
+        while True:
+            for worker in self.workers:
+                if not worker.ready or worker.task is not None or worker.retire or exhausted:
+                    continue
+                retried = held is not None
+                if retried:
+                    task, held = held, None
+                else:
+                    try:
+                        task = pending.get_nowait()
+                    except queue.Empty:
+                        break
+                if task is _END:
+                    exhausted = True
+                    break
+                if isinstance(task, BaseException):
+                    raise task
+                if not self._has_headroom(task) and any(w.busy() for w in self.workers):
+                    # Wait for some of the running tasks to free memory.
+                    if not retried:
+                        self.waited_for_memory += 1
+                    held = task
+                    break
+                worker.assign(task, self.budget(task, {}))
+
+            busy = [w for w in self.workers if w.busy()]
+            if exhausted and not busy:
+                return
+
+            now = time.monotonic()
+            if now - last_sample >= RSS_INTERVAL:
+                for worker in self.workers:
+                    worker.sample_rss()
+                self._reap()
+                last_sample = now
+
+            deadlines = [w.deadline for w in busy if w.deadline is not None]
+            deadlines += [entry[3] for w in busy for entry in w.writing.values()
+                          if entry[3] is not None]
+            timeout = max(0.0, min(deadlines) - now) if deadlines else None
+            if held is not None:
+                timeout = RSS_INTERVAL if timeout is None else min(timeout, RSS_INTERVAL)
+            elif not exhausted and any(w.ready and w.task is None and not w.retire
+                                       for w in self.workers):
+                # Idle workers, wait for new tasks.
+                timeout = 0.05 if timeout is None else min(timeout, 0.05)
+
+            handles = {}
+            for worker in self.workers:
+                if worker.busy() or not worker.ready:
+                    handles[worker.conn] = worker
+                    handles[worker.process.sentinel] = worker
+            for handle in wait(list(handles), timeout):
+                worker = handles[handle]
+                if worker not in self.workers:
+                    # Already replaced through its other handle.
+                    continue
+                try:
+                    while worker.conn.poll():
+                        message = worker.conn.recv()
+                        if message[0] == "ready":
+                            worker.ready = True
+                        elif message[0] == "free":
+                            if message[1] != worker.seq or worker.task is None:
+                                # The writer already sent its "done".
+                                continue
+                            # Their budget covers the deferred work too.
+                            worker.writing[message[1]] = (worker.task, worker.events, worker.start,
+                                                          worker.deadline)
+                            self.busy_seconds += worker.release()
+                        elif message[0] == "done":
+                            _, seq, result, write_seconds = message
+                            if worker.writing.pop(seq, None) is None:
+                                self.busy_seconds += worker.release()
+                            worker.tasks_done += 1
+                            self.write_seconds += write_seconds
+                            self._after_task(worker)
+                            yield result
+                            break
+                        else:
+                            _, event, value = message
+                            worker.events[event] = (value, time.monotonic() - worker.start)
+                            budget = self.budget(worker.task, worker.events)
+                            worker.deadline = None if budget is None else worker.start + budget
+                except (EOFError, OSError):
+                    pass
+                if worker not in self.workers or worker.process.is_alive():
+                    # Recycled after its task, or still running.
+                    continue
+                if not worker.ready:
+                    # Most likely the initializer failed, so would a new one.
+                    raise RuntimeError(f"Worker {worker.process.pid} died while starting "
+                                       f"(exit code {worker.process.exitcode})")
+                if worker.busy():
+                    yield from self._fail(worker, "crash")
+                else:
+                    self._replace(worker)
+
+            now = time.monotonic()
+            for worker in list(self.workers):
+                if worker.task is not None and worker.deadline is not None and now > worker.deadline:
+                    yield from self._fail(worker, "timeout")
+                    continue
+                late = [seq for seq, entry in worker.writing.items()
+                        if entry[3] is not None and now > entry[3]]
+                if late:
+                    # Stuck in deferred work; the task it runs dies with it.
+                    yield from self._fail(worker, "crash", late)
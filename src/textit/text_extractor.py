@@ -1,20 +1,34 @@
 from typing import List, Optional, Dict, Callable, Union
+import mmap
 from dataclasses import dataclass
 from enum import Enum, auto
 from concurrent.futures import ThreadPoolExecutor
 from concurrent.futures import ProcessPoolExecutor
 import os
 import hashlib
+import time
+import functools
 
 from textit.extractors import pdf_extractor, doc_extractor, epub_extractor
-from textit.extractors import html_extractor, mobi_extractor
+from textit.extractors import html_extractor, mobi_extractor, rtf_extractor
 
 from textit.metadata import Metadata, FileType, DocumentClass
 from textit.helpers import Result, getLogger
+from textit import instrumentation
 
 # Type aliases
 HandlerFunction = Callable[[str, Metadata], tuple[Result[List[str]], Metadata]]
 ProcessingFunction = Callable[[str], Optional[str]]
+# Handlers that work on the file contents already in memory (bytes or a
+# read-only mapping), so that the file isn't read once more. They also get the
+# path, for logging and for tools that need a real file.
+Buffer = Union[bytes, bytearray, memoryview, mmap.mmap]
+BufferHandlerFunction = Callable[[Buffer, str, Metadata], tuple[Result[List[str]], Metadata]]
+# Processors that need to see the whole document at once (e.g. corpus-wide
+# statistics); they run before the per-line pipeline.
+DocumentProcessingFunction = Callable[[List[str], Metadata], List[str]]
+# Re-cuts the output of the handlers into the units of the pipeline.
+SegmentingFunction = Callable[[List[str], Metadata], List[str]]
 
 def compute_sha1(text):
     text_bytes = text.encode('utf-8')
@@ -30,23 +44,96 @@ class TextExtractor:
             FileType.DOC: doc_extractor.doc_handler,
             FileType.DOCX: doc_extractor.doc_handler,
             FileType.HTML: html_extractor.html_handler,
-            #FileType.RTF: rtf_extractor.rtf_handler,
+            FileType.RTF: rtf_extractor.rtf_handler,
             #FileType.DVI: dvi_extractor.dvi_handler,
             FileType.MOBI: mobi_extractor.mobi_handler,
             FileType.EPUB: epub_extractor.epub_handler,
         }
+        self.buffer_handlers: Dict[FileType, BufferHandlerFunction] = {
+            FileType.PDF: pdf_extractor.pdf_buffer_handler,
+            FileType.HTML: html_extractor.html_buffer_handler,
+            FileType.RTF: rtf_extractor.rtf_buffer_handler,
+        }
+        # Keys for the raw extraction cache.
+        self.handler_versions: Dict[FileType, str] = {
+            FileType.PDF: f"pdf-{pdf_extractor.HANDLER_VERSION}",
+            FileType.DOC: f"doc-{doc_extractor.HANDLER_VERSION}",
+            FileType.DOCX: f"doc-{doc_extractor.HANDLER_VERSION}",
+            FileType.HTML: f"html-{html_extractor.HANDLER_VERSION}",
+            FileType.RTF: f"rtf-{rtf_extractor.HANDLER_VERSION}",
+            FileType.MOBI: f"mobi-{mobi_extractor.HANDLER_VERSION}",
+            FileType.EPUB: f"epub-{epub_extractor.HANDLER_VERSION}",
+        }
         self.processing_pipeline: List[ProcessingFunction] = []
+        self.document_pipeline: List[DocumentProcessingFunction] = []
+        self.segmenter: Optional[SegmentingFunction] = None
 
-    def register_handler(self, file_type: FileType, handler: HandlerFunction) -> None:
+    def register_handler(self, file_type: FileType, handler: HandlerFunction,
+                         version: Optional[str] = None) -> None:
         self.handlers[file_type] = handler
+        if version is None:
+            version = f"{handler.__module__}.{handler.__qualname__}"
+        self.handler_versions[file_type] = version
+
+    def set_handler_options(self, file_type: FileType, version: Optional[str] = None,
+                            **options) -> None:
+        """Binds keyword arguments of the handlers of ``file_type`` (e.g.
+        ``max_pages`` of the PDF ones). Options that change their output
+        need a new ``version``."""
+        self.handlers[file_type] = functools.partial(self.handlers[file_type], **options)
+        if file_type in self.buffer_handlers:
+            self.buffer_handlers[file_type] = functools.partial(self.buffer_handlers[file_type],
+                                                                **options)
+        if version is not None:
+            self.handler_versions[file_type] = version
+
+    def register_buffer_handler(self, file_type: FileType, handler: BufferHandlerFunction) -> None:
+        """Must produce the same output as the regular handler of the type."""
+        self.buffer_handlers[file_type] = handler
+
+    def has_buffer_handler(self, file_type: Optional[FileType]) -> bool:
+        return file_type in self.buffer_handlers
+
+    def get_handler_version(self, file_type: Optional[FileType]) -> Optional[str]:
+        return self.handler_versions.get(file_type)
 
     def add_processor(self, processor: ProcessingFunction) -> None:
         self.processing_pipeline.append(processor)
 
+    def add_document_processor(self, processor: DocumentProcessingFunction) -> None:
+        self.document_pipeline.append(processor)
+
+    def set_segmenter(self, segmenter: Optional[SegmentingFunction]) -> None:
+        self.segmenter = segmenter
+
     def extract_text(self, file_path: str, metadata: Optional[Metadata] = None) -> tuple[Result[List[str]], Metadata]:
+        text, newmetadata = self.extract_raw(file_path, metadata)
+        return self.process_raw(text, newmetadata)
+
+    def extract_raw(self, file_path: str, metadata: Optional[Metadata] = None,
+                    buffer: Optional[Buffer] = None) -> tuple[Result[List[str]], Metadata]:
+        """Only runs the handler, without the processing pipeline.
+
+        If the contents of the file are given in ``buffer``, they are used
+        instead of reading ``file_path`` whenever the type has a buffer
+        handler.
+
+        """
         if metadata is None:
             metadata = Metadata()
 
+        stage = "handler." + (self._determine_file_type(file_path, metadata)
+            .map(lambda file_type: file_type.name)
+            .unwrap_or("unknown"))
+
+        if buffer is not None:
+            buffer_handler = (self._determine_file_type(file_path, metadata)
+                .map(self.buffer_handlers.get)
+                .unwrap_or(None))
+            if buffer_handler is not None:
+                with instrumentation.timer(stage):
+                    return buffer_handler(buffer, file_path, metadata)
+
         # Identify the file type and the handler. and_then simply applies the
         # function received as an argument if the value is Result[T] and not
         # Error
@@ -55,7 +142,14 @@ class TextExtractor:
             )
 
         # Extract the text using the right handler
-        text, newmetadata = file_type_handler.and_then(lambda handler: handler(file_path, metadata))
+        if file_type_handler.is_err():
+            return file_type_handler, metadata
+
+        with instrumentation.timer(stage):
+            return file_type_handler.unwrap()(file_path, metadata)
+
+    def process_raw(self, text: Result[List[str]], newmetadata: Metadata) -> tuple[Result[List[str]], Metadata]:
+        """Runs the processing pipeline on the output of extract_raw()."""
         if text.is_err():
             logger = getLogger()
             logger.error(text._error)
@@ -64,10 +158,21 @@ class TextExtractor:
 
             return Result.ok([""]), newmetadata
 
+        if self.segmenter is not None:
+            with instrumentation.timer("segmenter"):
+                text = text.map(lambda lines: self.segmenter(lines, newmetadata))
+
         newmetadata.original_nlines = len(text.unwrap())
 
+        # Document-level stages run first, so that whatever they remove does
+        # not cost anything in the per-line pipeline.
+        for processor in self.document_pipeline:
+            with instrumentation.timer(f"document.{type(processor).__name__}"):
+                text = text.map(lambda lines: processor(lines, newmetadata))
+
         # Call the pipeline functions for text processing
-        processed_text = text.map(self._process_text)
+        with instrumentation.timer("processors"):
+            processed_text = text.map(self._process_text)
 
         if processed_text.is_ok():
             newmetadata.nlines = len(processed_text.unwrap())
@@ -86,7 +191,7 @@ class TextExtractor:
             'doc': FileType.DOC,
             'docx': FileType.DOC,
             'html': FileType.HTML,
-            #'rtf': FileType.RTF,
+            'rtf': FileType.RTF,
             #'dvi': FileType.DVI,
             'mobi': FileType.MOBI,
             'epub': FileType.EPUB
@@ -110,7 +215,21 @@ class TextExtractor:
         return processed_text
 
     def _apply_pipeline(self, text: Optional[str]) -> Optional[str]:
+        if instrumentation.enabled:
+            return self._apply_pipeline_timed(text)
+
         for processor in self.processing_pipeline:
             text = None if text is None else processor(text)
 
         return text
+
+    def _apply_pipeline_timed(self, text: Optional[str]) -> Optional[str]:
+        # Summed over the lines, so over all the threads of _process_text.
+        for processor in self.processing_pipeline:
+            if text is None:
+                break
+            start = time.perf_counter()
+            text = processor(text)
+            instrumentation.add_time(f"processor.{processor.__name__}", time.perf_counter() - start)
+
+        return text
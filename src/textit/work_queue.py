@@ -0,0 +1,344 @@
+"""Batches of input files shared by the nodes of a run, claimed with leases.
+
+The nodes only need a shared filesystem. The queue is a directory::
+
+    batches/<n>     input files of batch n, one JSON [path, size] per line
+    plan            written once all the batches are, with their number
+    leases/<n>      the node working on batch n
+    done/<n>        batch n is finished
+
+The first node to take the lease of the plan walks the input directory and
+writes the batches; every node (the planner too) claims batches as soon as
+they appear, so that the work starts before the walk is over. Files are
+created with ``O_EXCL`` or renamed into place, which is atomic on local
+filesystems and on NFS.
+
+A node renews its leases (their mtime) from a thread; a lease that wasn't
+renewed for ``lease_seconds`` belongs to a dead or stuck node, and is taken
+over by the next node looking for work. Nodes wait for the leases of the
+others to be released or to expire before exiting, so that nothing is left
+behind by a node that dies near the end. A batch taken over is run again
+from its start; the outputs of its files are simply written again.
+
+"""
+import json
+import os
+import socket
+import threading
+import time
+from collections import Counter
+from typing import Callable, Iterable, Iterator, Optional
+
+from textit.helpers import getLogger
+
+PLAN = "plan"
+
+
+def parse_shard(s: str) -> tuple[int, int]:
+    """``i/N`` -> (i, N), with 0 <= i < N."""
+    index, sep, count = s.partition("/")
+    if not sep:
+        raise ValueError(f"expected i/N, got '{s}'")
+    index, count = int(index), int(count)
+    if not 0 <= index < count:
+        raise ValueError(f"shard {index} out of range for {count} shards")
+    return index, count
+
+
+def in_shard(path_hash: str, shard: tuple[int, int]) -> bool:
+    index, count = shard
+    return int(path_hash, 16) % count == index
+
+
+class WorkQueue(object):
+    def __init__(self, path: str, node: str, lease_seconds: float = 600, poll_seconds: float = 5):
+        self.path = path
+        self.node = node
+        self.lease_seconds = lease_seconds
+        self.poll_seconds = poll_seconds
+        self.owner = json.dumps({"node": node, "host": socket.gethostname(), "pid": os.getpid()})
+        for directory in ("batches", "leases", "done"):
+            os.makedirs(os.path.join(path, directory), exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._leases = set()
+        # Tasks left per batch, and whether all the tasks of the batch were seen.
+        self._remaining = Counter()
+        self._enumerated = set()
+        self._batch_of = {}
+        self._files = None
+        self._batch_size = None
+        self.completed = 0
+        self._stop = threading.Event()
+        self._heartbeat = threading.Thread(target=self._renew_leases, name="lease-heartbeat",
+                                           daemon=True)
+        self._heartbeat.start()
+
+    def _file(self, directory: str, name) -> str:
+        return os.path.join(self.path, directory, str(name))
+
+    # Leases.
+
+    def _try_lease(self, name) -> bool:
+        lease = self._file("leases", name)
+        try:
+            fd = os.open(lease, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except FileExistsError:
+            return self._take_over(name)
+
+        with os.fdopen(fd, "w") as f:
+            f.write(self.owner)
+        with self._lock:
+            self._leases.add(name)
+        return True
+
+    def _take_over(self, name) -> bool:
+        """Replaces the lease of batch ``name`` if it expired.
+
+        The nodes that saw it expire compete for a marker named after that
+        lease (its inode and mtime) with ``O_EXCL``; the winner checks that
+        the lease is still the same one and renames its own over it. A node
+        that dies in the middle only holds the others back until the lease
+        has been expired for another ``lease_seconds``.
+
+        """
+        lease = self._file("leases", name)
+        try:
+            seen = os.stat(lease)
+        except FileNotFoundError:
+            return False
+        expired_for = time.time() - seen.st_mtime - self.lease_seconds
+        if expired_for <= 0:
+            return False
+
+        marker = self._takeover_marker(lease, seen, expired_for)
+        try:
+            os.close(os.open(marker, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+        except FileExistsError:
+            return False
+
+        mine = f"{lease}.{socket.gethostname()}-{os.getpid()}.tmp"
+        try:
+            with open(mine, "w") as f:
+                f.write(self.owner)
+            try:
+                current = os.stat(lease)
+            except FileNotFoundError:
+                current = None
+            if current is None or (current.st_ino, current.st_mtime_ns) != \
+                    (seen.st_ino, seen.st_mtime_ns):
+                # Renewed, released or already taken over.
+                os.remove(mine)
+                return False if current is not None else self._try_lease(name)
+
+            os.rename(mine, lease)
+            with self._lock:
+                self._leases.add(name)
+            # Left by the nodes that died taking it over before.
+            prefix = os.path.basename(marker).rsplit("-", 1)[0] + "-"
+            for entry in os.scandir(os.path.dirname(lease)):
+                if entry.name.startswith(prefix) and entry.path != marker:
+                    try:
+                        os.remove(entry.path)
+                    except FileNotFoundError:
+                        pass
+        finally:
+            os.remove(marker)
+
+        getLogger().warning(f"Took over the expired lease of batch {name}")
+        return True
+
+    def _takeover_marker(self, lease: str, seen: os.stat_result, expired_for: float) -> str:
+        attempt = int(expired_for // self.lease_seconds)
+        return f"{lease}.takeover-{seen.st_ino}-{seen.st_mtime_ns}-{attempt}"
+
+    def _expired(self, lease: str) -> bool:
+        try:
+            return time.time() - os.stat(lease).st_mtime > self.lease_seconds
+        except FileNotFoundError:
+            return False
+
+    def _owns(self, lease: str) -> bool:
+        try:
+            with open(lease) as f:
+                return f.read() == self.owner
+        except FileNotFoundError:
+            return False
+
+    def _release(self, name) -> None:
+        """Removes the lease, unless it was taken over (it can't be while
+        it's ours: the heartbeat keeps it from expiring)."""
+        with self._lock:
+            held = name in self._leases
+            self._leases.discard(name)
+        lease = self._file("leases", name)
+        if not held or not self._owns(lease):
+            getLogger().warning(f"Not releasing the lease of batch {name}, it's not ours any more")
+            return
+        try:
+            os.remove(lease)
+        except FileNotFoundError:
+            pass
+
+    def _renew_leases(self) -> None:
+        while not self._stop.wait(self.lease_seconds / 4):
+            with self._lock:
+                leases = list(self._leases)
+            for name in leases:
+                lease = self._file("leases", name)
+                owned = self._owns(lease)
+                if owned:
+                    try:
+                        os.utime(lease)
+                    except FileNotFoundError:
+                        owned = False
+                if not owned:
+                    # We were too slow to renew it, someone else runs the batch again.
+                    getLogger().warning(f"Lost the lease of batch {name}")
+                    with self._lock:
+                        self._leases.discard(name)
+
+    def _is_done(self, name) -> bool:
+        return os.path.exists(self._file("done", name))
+
+    def _mark_done(self, name) -> None:
+        with open(self._file("done", name), "w") as f:
+            f.write(self.owner)
+        self._release(name)
+
+    # Planning.
+
+    def _planned(self) -> Optional[int]:
+        """Number of batches, once they were all written."""
+        try:
+            with open(os.path.join(self.path, PLAN)) as f:
+                return json.load(f)["batches"]
+        except FileNotFoundError:
+            return None
+
+    def plan(self, files: Iterable[tuple[str, int]], batch_size: int) -> bool:
+        """Writes the batches, unless another node is (or was) doing it.
+
+        Returns False if the plan was left to another node.
+
+        """
+        if self._planned() is not None or not self._try_lease(PLAN):
+            return False
+
+        batches = 0
+        batch = []
+
+        def flush():
+            nonlocal batches
+            path = self._file("batches", batches)
+            # Written again after a planner died; the walk gives the same
+            # batches as long as the input directory didn't change.
+            if not os.path.exists(path):
+                with open(path + ".tmp", "w", encoding="utf-8") as f:
+                    for entry in batch:
+                        # ensure_ascii keeps undecodable paths as \udcxx escapes.
+                        f.write(json.dumps(entry) + "\n")
+                os.rename(path + ".tmp", path)
+            batches += 1
+            batch.clear()
+
+        for entry in files:
+            batch.append(entry)
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+
+        plan = os.path.join(self.path, PLAN)
+        with open(plan + ".tmp", "w") as f:
+            json.dump({"batches": batches, "node": self.node}, f)
+        os.rename(plan + ".tmp", plan)
+        self._release(PLAN)
+        getLogger().info(f"Planned {batches} batches of at most {batch_size} files")
+        return True
+
+    def start_planning(self, files: Callable[[], Iterable[tuple[str, int]]], batch_size: int) -> None:
+        """Plans from a thread, so that the batches can be claimed meanwhile.
+
+        ``files`` gives the input files; it's called again if the node that
+        was planning dies.
+
+        """
+        self._files = files
+        self._batch_size = batch_size
+        threading.Thread(target=lambda: self.plan(files(), batch_size), name="planner",
+                         daemon=True).start()
+
+    def _planner_gone(self) -> bool:
+        lease = self._file("leases", PLAN)
+        return not os.path.exists(lease) or self._expired(lease)
+
+    # Claiming.
+
+    def claim(self) -> Optional[int]:
+        """Waits for a batch to work on; None once all of them are done or
+        being done by this node (which won't complete them while it waits)."""
+        first = 0
+        while True:
+            planned = self._planned()
+            n = first
+            while os.path.exists(self._file("batches", n)):
+                with self._lock:
+                    ours = n in self._leases
+                if ours or self._is_done(n):
+                    if n == first:
+                        first += 1
+                elif self._try_lease(n):
+                    return n
+                n += 1
+
+            if planned is not None and first >= planned:
+                return None
+            if planned is None and self._planner_gone():
+                self.start_planning(self._files, self._batch_size)
+            # The other batches are leased by other nodes, wait for them to be
+            # done or to expire.
+            time.sleep(self.poll_seconds if planned is not None else min(1, self.poll_seconds))
+
+    def read_batch(self, batch: int) -> Iterator[tuple[str, int]]:
+        with open(self._file("batches", batch), encoding="utf-8") as f:
+            for line in f:
+                path, size = json.loads(line)
+                yield path, size
+
+    # Tracking the tasks of the claimed batches, from the feeder and the main thread.
+
+    def add_task(self, batch: int, key: str) -> None:
+        with self._lock:
+            self._remaining[batch] += 1
+            self._batch_of[key] = batch
+
+    def batch_enumerated(self, batch: int) -> None:
+        with self._lock:
+            self._enumerated.add(batch)
+            finished = self._remaining[batch] == 0
+        if finished:
+            self.complete(batch)
+
+    def task_done(self, key: str) -> Optional[int]:
+        """Returns the batch of the task if it was the last one, for the
+        caller to ``complete`` once the results are safely stored."""
+        with self._lock:
+            batch = self._batch_of.pop(key, None)
+            if batch is None:
+                return None
+            self._remaining[batch] -= 1
+            finished = self._remaining[batch] == 0 and batch in self._enumerated
+        return batch if finished else None
+
+    def complete(self, batch: int) -> None:
+        with self._lock:
+            del self._remaining[batch]
+            self._enumerated.discard(batch)
+            self.completed += 1
+        self._mark_done(batch)
+
+    def close(self) -> None:
+        """Stops renewing the leases; those of unfinished batches will expire."""
+        self._stop.set()
+        self._heartbeat.join()
@@ -0,0 +1,19 @@
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "src"))
+
+FIXTURES = os.path.join(ROOT, "tests", "fixtures")
+
+
+@pytest.fixture(scope="session")
+def book_lines():
+    """Paragraphs of the EPUB fixture, the way the handler extracts them."""
+    from textit.extractors.epub_extractor import epub_handler
+    from textit.metadata import Metadata
+
+    text, _ = epub_handler(os.path.join(FIXTURES, "1984 - George Orwell.epub"), Metadata())
+    return [line for line in text.unwrap()[0].split("\n") if line.strip()]
@@ -0,0 +1,120 @@
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+from textit.archives import ArchiveReader, iter_inputs, member_url, sort_size, split_member
+from textit.helpers import iter_files
+
+MEMBERS = {"a.html": b"<p>a</p>", "dir/b.txt": b"bb", "dir/c.pdf": b"%PDF-1.4 ccc"}
+
+
+def make_zip(path, members=MEMBERS):
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("dir/", b"")
+        for name, data in members.items():
+            zf.writestr(name, data)
+
+
+def make_tar(path, mode, members=MEMBERS):
+    with tarfile.open(path, mode) as tf:
+        directory = tarfile.TarInfo("./dir")
+        directory.type = tarfile.DIRTYPE
+        tf.addfile(directory)
+        for name, data in members.items():
+            info = tarfile.TarInfo("./" + name)
+            info.size = len(data)
+            tf.addfile(info, io.BytesIO(data))
+
+
+@pytest.fixture(params=["zip", "tar", "tar.gz"])
+def archive(request, tmp_path):
+    path = str(tmp_path / f"docs.{request.param}")
+    if request.param == "zip":
+        make_zip(path)
+    else:
+        make_tar(path, "w" if request.param == "tar" else "w:gz")
+    return path
+
+
+def test_member_urls():
+    url = member_url("in/docs.zip", "dir/b.txt")
+
+    assert url == "in/docs.zip!/dir/b.txt"
+    assert split_member(url) == ("in/docs.zip", "dir/b.txt")
+    # Only after an archive.
+    assert split_member("in/odd!/name.zip!/x.html") == ("in/odd!/name.zip", "x.html")
+    assert split_member("in/odd!/name.html") is None
+
+
+def test_iter_inputs(tmp_path, archive):
+    with open(tmp_path / "plain.html", "wb") as f:
+        f.write(b"<p>plain</p>")
+
+    found = dict(iter_inputs(str(tmp_path), iter_files))
+
+    expected = {member_url(archive, name): len(data) for name, data in MEMBERS.items()}
+    expected[str(tmp_path / "plain.html")] = 12
+    assert found == expected
+    # In the order of the archive.
+    assert [url for url in found if url.startswith(archive)] == list(expected)[:3]
+
+
+def test_zip_names_without_the_utf8_flag(tmp_path):
+    path = str(tmp_path / "names.zip")
+    # UTF-8 bytes, written by an archiver that doesn't set the flag for them.
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("cafxx.html", b"data")
+    with open(path, "rb") as f:
+        data = f.read()
+    with open(path, "wb") as f:
+        f.write(data.replace(b"cafxx.html", "café.html".encode("utf-8")))
+    with zipfile.ZipFile(path) as zf:
+        assert not zf.infolist()[0].flag_bits & 0x800
+
+    assert list(iter_inputs(path, lambda p: [(p, 0)])) == [(member_url(path, "café.html"), 4)]
+
+
+def test_corrupt_archive_skipped(tmp_path):
+    with open(tmp_path / "broken.zip", "wb") as f:
+        f.write(b"PK\x03\x04 not really")
+    make_zip(str(tmp_path / "good.zip"))
+
+    found = [url for url, _ in iter_inputs(str(tmp_path), iter_files)]
+
+    assert sorted(found) == sorted(member_url(str(tmp_path / "good.zip"), name) for name in MEMBERS)
+
+
+def test_read(archive):
+    reader = ArchiveReader()
+    names = list(MEMBERS)
+    # Forwards, backwards (a compressed tar starts over) and again.
+    for name in names + names[::-1] + names:
+        assert reader.read(archive, name) == MEMBERS[name]
+
+    with pytest.raises(FileNotFoundError):
+        reader.read(archive, "missing.txt")
+    # Still usable.
+    assert reader.read(archive, names[0]) == MEMBERS[names[0]]
+    reader.close()
+
+
+def test_read_switches_archives(tmp_path):
+    first, second = str(tmp_path / "1.zip"), str(tmp_path / "2.tar")
+    make_zip(first)
+    make_tar(second, "w", {"a.html": b"other"})
+    reader = ArchiveReader()
+
+    assert reader.read(first, "a.html") == MEMBERS["a.html"]
+    assert reader.read(second, "a.html") == b"other"
+    assert reader.read(first, "dir/b.txt") == MEMBERS["dir/b.txt"]
+    reader.close()
+
+
+def test_members_sorted_with_their_archive(tmp_path, archive):
+    url = member_url(archive, "dir/b.txt")
+
+    assert sort_size(url, 2) == os.path.getsize(archive)
+    assert sort_size("in/plain.html", 12) == 12
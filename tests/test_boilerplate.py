@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+
+from textit.metadata import Metadata
+from textit.processors import BoilerplateFilter, CountMinSketch
+from textit.processors.boilerplate import COUNTER_DTYPE, line_key
+
+
+def keys(lines):
+    return [line_key(line) for line in lines]
+
+
+def test_merge_adds_counts_and_documents(book_lines):
+    first, second = CountMinSketch(1024, 4), CountMinSketch(1024, 4)
+    first.add_document(keys(book_lines[:10]))
+    second.add_document(keys(book_lines[5:15]))
+    second.add_document(keys(book_lines[5:15]))
+
+    first.merge(second)
+
+    assert first.documents == 3
+    counts = first.estimate(keys(book_lines[:15]))
+    # Count-min only overestimates.
+    assert all(counts[:5] >= 1)
+    assert all(counts[5:10] >= 3)
+    assert all(counts[10:15] >= 2)
+
+
+def test_merge_saturates():
+    first, second = CountMinSketch(16, 2), CountMinSketch(16, 2)
+    first.table[:] = np.iinfo(COUNTER_DTYPE).max - 1
+    second.table[:] = 5
+
+    first.merge(second)
+
+    assert (first.table == np.iinfo(COUNTER_DTYPE).max).all()
+
+
+def test_merge_different_shapes():
+    with pytest.raises(ValueError):
+        CountMinSketch(1024, 4).merge(CountMinSketch(2048, 4))
+
+
+def test_save_load(tmp_path, book_lines):
+    sketch = CountMinSketch(1024, 4)
+    sketch.add_document(keys(book_lines))
+    path = str(tmp_path / "sketch.cms")
+    sketch.save(path)
+
+    loaded = CountMinSketch.load(path)
+
+    assert loaded.documents == 1
+    assert (loaded.table == sketch.table).all()
+
+
+def test_filter_threshold(book_lines):
+    footer = "Toate drepturile rezervate. Reproducerea fara acord este interzisa."
+    boilerplate = BoilerplateFilter(CountMinSketch(2 ** 16, 4), max_docs=3)
+
+    for i in range(5):
+        # A different part of the page every time, the same footer.
+        page = book_lines[i * 3:i * 3 + 3]
+        metadata = Metadata()
+        result = boilerplate(["\n".join(page + [footer])], metadata)
+
+        # Seen in 0, 1, 2 other documents: kept; in 3 or more: dropped.
+        if i < 3:
+            assert result == ["\n".join(page + [footer])]
+            assert metadata.boilerplate_lines == 0
+        else:
+            assert result == ["\n".join(page)]
+            assert metadata.boilerplate_lines == 1
@@ -0,0 +1,50 @@
+import os
+
+from textit.digest_index import DigestIndex
+
+DIGEST = "sha1:" + "ab" * 20
+
+
+def test_first_claim_extracts(tmp_path):
+    index = DigestIndex(str(tmp_path / "digests.sqlite"), str(tmp_path))
+    first, second = str(tmp_path / "a" / "1.json"), str(tmp_path / "b" / "2.json")
+
+    assert index.claim(DIGEST, "1", first) is None
+    assert index.claim(DIGEST, "1", second) == (first, DigestIndex.PENDING)
+    index.complete(DIGEST, "1")
+    assert index.claim(DIGEST, "1", second) == (first, DigestIndex.DONE)
+    # Our own claim, from a run that didn't finish.
+    assert index.claim(DIGEST, "1", first) is None
+    # Extracted again by another version.
+    assert index.claim(DIGEST, "2", second) is None
+    index.close()
+
+
+def test_release(tmp_path):
+    index = DigestIndex(str(tmp_path / "digests.sqlite"), str(tmp_path))
+    first, second = str(tmp_path / "1.json"), str(tmp_path / "2.json")
+    index.claim(DIGEST, "1", first)
+
+    # Only by the claim's owner.
+    index.release(DIGEST, "1", second)
+    assert index.claim(DIGEST, "1", second) == (first, DigestIndex.PENDING)
+    index.release(DIGEST, "1", first)
+    assert index.claim(DIGEST, "1", second) is None
+    index.close()
+
+
+def test_release_pending(tmp_path):
+    path = str(tmp_path / "digests.sqlite")
+    index = DigestIndex(path, str(tmp_path))
+    index.claim(DIGEST, "1", str(tmp_path / "1.json"))
+    index.claim("sha1:" + "cd" * 20, "1", str(tmp_path / "2.json"))
+    index.complete(DIGEST, "1")
+    index.close()
+
+    # The next run drops the claims of the workers that died.
+    index = DigestIndex(path, str(tmp_path))
+    assert index.release_pending() == 1
+    assert index.claim("sha1:" + "cd" * 20, "1", str(tmp_path / "3.json")) is None
+    assert index.claim(DIGEST, "1", str(tmp_path / "3.json")) == \
+        (os.path.join(str(tmp_path), "1.json"), DigestIndex.DONE)
+    index.close()
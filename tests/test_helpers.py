@@ -0,0 +1,67 @@
+import os
+
+from textit.helpers import get_all_files, iter_files, windowed_sort
+
+
+def tree(tmp_path):
+    sizes = {"a.txt": 1, "b/c.txt": 22, "b/d/e.txt": 333, "b/d/f.txt": 0}
+    for name, size in sizes.items():
+        path = tmp_path / name
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_bytes(b"x" * size)
+    return {str(tmp_path / name): size for name, size in sizes.items()}
+
+
+def test_iter_files(tmp_path):
+    sizes = tree(tmp_path)
+
+    assert dict(iter_files(str(tmp_path))) == sizes
+    assert sorted(path for path, _ in iter_files(str(tmp_path))) == \
+        sorted(get_all_files(str(tmp_path)))
+
+
+def test_iter_files_is_lazy(tmp_path):
+    tree(tmp_path)
+    files = iter_files(str(tmp_path))
+    next(files)
+    # Files created meanwhile are still found, the tree isn't listed up front.
+    (tmp_path / "b" / "d" / "new.txt").write_bytes(b"xx")
+
+    assert str(tmp_path / "b" / "d" / "new.txt") in dict(files)
+
+
+def test_iter_files_skips_symlinked_dirs(tmp_path):
+    sizes = tree(tmp_path)
+    os.symlink(tmp_path / "b", tmp_path / "loop")
+
+    assert dict(iter_files(str(tmp_path))) == sizes
+
+
+def test_iter_files_skips_unlistable_dirs(tmp_path):
+    sizes = tree(tmp_path)
+    missing = str(tmp_path / "missing")
+
+    assert list(iter_files(missing)) == []
+    assert dict(iter_files(str(tmp_path))) == sizes
+
+
+def test_windowed_sort():
+    items = [5, 3, 9, 1, 8, 2, 7]
+
+    assert list(windowed_sort(items, 3, key=lambda x: x)) == [3, 5, 9, 1, 2, 8, 7]
+    assert list(windowed_sort(items, 100, key=lambda x: x)) == sorted(items)
+    assert list(windowed_sort([], 3, key=lambda x: x)) == []
+
+
+def test_windowed_sort_is_stable_and_lazy():
+    consumed = []
+
+    def items():
+        for i in range(10):
+            consumed.append(i)
+            yield i // 4, i
+
+    sorted_items = windowed_sort(items(), 4, key=lambda item: item[0])
+    assert [next(sorted_items) for _ in range(4)] == [(0, 0), (0, 1), (0, 2), (0, 3)]
+    assert consumed == [0, 1, 2, 3]
+    assert list(sorted_items) == [(i // 4, i) for i in range(4, 10)]
@@ -0,0 +1,102 @@
+import math
+import time
+
+import pytest
+
+from textit import instrumentation
+from textit.instrumentation import Histogram, RunStats
+
+
+@pytest.fixture
+def enabled(monkeypatch):
+    monkeypatch.setattr(instrumentation, "enabled", True)
+    instrumentation.start_document()
+    yield
+    instrumentation.start_document()
+
+
+def test_disabled_is_a_no_op():
+    assert not instrumentation.enabled
+    instrumentation.start_document()
+    with instrumentation.timer("stage"):
+        pass
+    instrumentation.count("bytes", 10)
+    instrumentation.annotate(file_type="PDF")
+
+    stats = instrumentation.document_stats()
+    assert (stats["timings"], stats["counters"], stats["attributes"]) == ({}, {}, {})
+
+
+def test_document_stats(enabled):
+    @instrumentation.timed("decorated")
+    def work(x):
+        time.sleep(0.01)
+        return x * 2
+
+    with instrumentation.timer("stage"):
+        time.sleep(0.01)
+    with instrumentation.timer("stage"):
+        pass
+    assert work(21) == 42
+    instrumentation.count("bytes", 10)
+    instrumentation.count("bytes", 5)
+    instrumentation.annotate(file_type="PDF")
+
+    stats = instrumentation.document_stats()
+    assert set(stats["timings"]) == {"stage", "decorated"}
+    assert stats["timings"]["stage"] >= 0.01 and stats["timings"]["decorated"] >= 0.01
+    assert instrumentation.document_timings() == \
+        {stage: round(seconds, 6) for stage, seconds in stats["timings"].items()}
+    assert stats["counters"] == {"bytes": 15}
+    assert stats["attributes"] == {"file_type": "PDF"}
+
+    # The next document starts from scratch.
+    instrumentation.start_document()
+    assert instrumentation.document_timings() == {}
+
+
+def test_histogram():
+    hist = Histogram()
+    for value in (0.0005, 0.002, 0.002, 0.3, 4000):
+        hist.observe(value)
+
+    assert hist.count == 5
+    assert hist.sum == pytest.approx(4000.3045)
+    assert hist.quantile(0.5) == 0.005
+    assert hist.quantile(0.8) == 0.5
+    assert hist.quantile(1.0) == math.inf
+
+
+def document(file_type, seconds, worker=1, **attributes):
+    return {"timings": {"extract": seconds}, "counters": {"bytes": 2 ** 20},
+            "attributes": {"file_type": file_type, **attributes}, "worker": worker}
+
+
+def test_run_stats(tmp_path):
+    stats = RunStats()
+    stats.add("ok", 2.0, document("PDF", 1.5, ocr=True))
+    stats.add("ok", 1.0, document("PDF", 0.5, worker=2))
+    stats.add("dropped", 0.5, document("HTML", 0.2, drop_reason="quality"))
+    # Failed tasks have no stats.
+    stats.add("timeout", None, None)
+
+    assert stats.statuses == {"ok": 2, "dropped": 1, "timeout": 1}
+    assert stats.documents == {"PDF": 2, "HTML": 1}
+    assert stats.ocr == {"PDF": 1}
+    assert stats.drop_reasons == {"quality": 1}
+    assert stats.worker_seconds == {1: 2.5, 2: 1.0}
+    summary = stats.summary()
+    assert "PDF: 2 documents, 2.0 MB" in summary
+    assert "OCR 1 (50.0%)" in summary
+    assert "Drop reasons: quality: 1" in summary
+    assert "Stage extract: 2.20s total" in summary
+
+    path = str(tmp_path / "textit.prom")
+    stats.write_prometheus(path)
+    with open(path) as f:
+        metrics = f.read().splitlines()
+    assert 'textit_tasks_total{status="timeout"} 1' in metrics
+    assert 'textit_documents_total{file_type="PDF"} 2' in metrics
+    assert 'textit_stage_seconds_bucket{stage="extract",le="+Inf"} 3' in metrics
+    assert 'textit_stage_seconds_count{stage="extract"} 3' in metrics
+    assert 'textit_worker_busy_seconds_total{worker="1"} 2.5' in metrics
@@ -0,0 +1,94 @@
+import os
+import sqlite3
+
+from textit.manifest import RunManifest, TaskRecord
+
+
+def task(i, status="ok", **kwargs):
+    return TaskRecord(f"{i:040x}", f"in/{i}.pdf", f"out/{i:040x}.json", status,
+                      digest=f"sha1:{i:040x}", **kwargs)
+
+
+def test_done_hashes(tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"))
+    assert manifest.is_empty()
+    manifest.record_all([task(0), task(1, "error"), task(2, "timeout"), task(3, "duplicate")])
+
+    assert manifest.done_hashes(["error"]) == {task(i).path_hash for i in (0, 2, 3)}
+    assert manifest.done_hashes(["error", "timeout"]) == {task(i).path_hash for i in (0, 3)}
+    assert manifest.status_counts() == {"ok": 1, "error": 1, "timeout": 1, "duplicate": 1}
+    manifest.close()
+
+
+def test_records_committed_in_batches(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    manifest = RunManifest(path, batch_size=2)
+    for i in range(3):
+        manifest.record(task(i))
+
+    # What a crash would leave.
+    other = sqlite3.connect(path)
+    assert other.execute("SELECT COUNT(*) FROM tasks").fetchone() == (2,)
+    other.close()
+    manifest.close()
+    assert len(RunManifest(path).done_hashes()) == 3
+
+
+def test_non_utf8_input_path(tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"))
+    record = task(0)
+    record.input_path = os.fsdecode(b"in/caf\xe9.pdf")
+    manifest.record_all([record])
+
+    assert list(manifest.finished_tasks()) == [(record.path_hash, record.input_path,
+                                                record.digest)]
+    manifest.close()
+
+
+def test_add_written_keeps_finished_tasks(tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.record_all([task(0, duration=1.0), task(1, "error", drop_reason="crash")])
+
+    assert manifest.add_written([task(0, "duplicate"), task(1), task(2)]) == 2
+
+    rows = dict(manifest._db.execute("SELECT path_hash, status FROM tasks"))
+    assert rows == {task(0).path_hash: "ok", task(1).path_hash: "ok", task(2).path_hash: "ok"}
+    manifest.close()
+
+
+def test_finished_runs(tmp_path):
+    manifest = RunManifest(str(tmp_path / "manifest.sqlite"))
+    manifest.finish_run("20261019000000")
+
+    assert manifest.finished_runs() == {"20261019000000"}
+    manifest.close()
+
+
+def test_merge_keeps_the_latest(tmp_path):
+    a = RunManifest(str(tmp_path / "manifest-a.sqlite"))
+    b = RunManifest(str(tmp_path / "manifest-b.sqlite"))
+    a.record_all([task(0, "error"), task(1)])
+    b.record_all([task(0), task(2)])
+    b.close()
+
+    assert a.merge(str(tmp_path / "manifest-b.sqlite")) == 2
+
+    assert a.status_counts() == {"ok": 3}
+    a.close()
+
+
+def test_upgrades_old_manifests(tmp_path):
+    path = str(tmp_path / "manifest.sqlite")
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE tasks (path_hash TEXT PRIMARY KEY, input BLOB, output TEXT, "
+               "status TEXT, digest TEXT, duration REAL, finished REAL)")
+    db.execute("INSERT INTO tasks VALUES ('a', X'', 'out', 'ok', NULL, 1.0, 0)")
+    db.commit()
+    db.close()
+
+    manifest = RunManifest(path)
+    manifest.record_all([task(1, predicted_cost=2.0, features="{}")])
+
+    assert list(manifest.cost_samples()) == [("{}", 2.0, None)]
+    assert manifest.done_hashes() == {"a", task(1).path_hash}
+    manifest.close()
@@ -0,0 +1,74 @@
+import pytest
+
+from textit.metadata import Metadata
+from textit.processors import LSHIndex, NearDuplicateFilter
+
+
+@pytest.fixture
+def index(tmp_path):
+    index = LSHIndex(str(tmp_path / "lsh.sqlite"))
+    yield index
+    index.close()
+
+
+def run(dedup, digest, lines):
+    metadata = Metadata(digest=digest)
+    return dedup(["\n".join(lines)], metadata), metadata
+
+
+def test_near_duplicate_marked(index, book_lines):
+    dedup = NearDuplicateFilter(index, threshold=0.8)
+    chapter = book_lines[:200]
+
+    _, original = run(dedup, "sha1:original", chapter)
+    # A few paragraphs changed out of 200.
+    edited = chapter[:100] + ["Un paragraf nou, care nu era acolo."] + chapter[101:]
+    texts, copy = run(dedup, "sha1:copy", edited)
+
+    assert original.near_duplicate_of is None
+    assert copy.near_duplicate_of == "sha1:original"
+    assert copy.near_duplicate_similarity >= 0.8
+    assert texts == ["\n".join(edited)]
+
+
+def test_different_documents(index, book_lines):
+    dedup = NearDuplicateFilter(index, threshold=0.8)
+
+    run(dedup, "sha1:first", book_lines[:200])
+    _, other = run(dedup, "sha1:second", book_lines[200:400])
+
+    assert other.near_duplicate_of is None
+
+
+def test_drop(index, book_lines):
+    dedup = NearDuplicateFilter(index, threshold=0.8, drop=True)
+
+    run(dedup, "sha1:original", book_lines[:200])
+    texts, copy = run(dedup, "sha1:copy", book_lines[:200])
+
+    assert texts == []
+    assert copy.drop_reason == "near-duplicate"
+    assert copy.near_duplicate_similarity == 1.0
+
+
+def test_index_persists(tmp_path, book_lines):
+    path = str(tmp_path / "lsh.sqlite")
+    first = LSHIndex(path)
+    run(NearDuplicateFilter(first), "sha1:original", book_lines[:200])
+    first.close()
+
+    second = LSHIndex(path)
+    _, copy = run(NearDuplicateFilter(second), "sha1:copy", book_lines[:200])
+    second.close()
+
+    assert copy.near_duplicate_of == "sha1:original"
+
+
+def test_index_parameters(tmp_path):
+    path = str(tmp_path / "lsh.sqlite")
+    LSHIndex(path, num_perm=128, bands=16).close()
+
+    with pytest.raises(ValueError):
+        LSHIndex(path, num_perm=128, bands=32)
+    with pytest.raises(ValueError):
+        LSHIndex(str(tmp_path / "other.sqlite"), num_perm=100, bands=16)
@@ -0,0 +1,108 @@
+import json
+import os
+import shutil
+
+import pytest
+
+from conftest import FIXTURES
+from textit.extractors import pdf_extractor
+from textit.extractors.pdf_extractor import PdfProcessor, apply_ocr
+from textit.page_checkpoints import PageCheckpoints
+
+PDF = os.path.join(FIXTURES, "Friedrich Nietzsche - The Use and Abuse of History.mobi")
+PAGES = 54
+
+
+@pytest.fixture
+def checkpoints(tmp_path):
+    checkpoints = PageCheckpoints(str(tmp_path / "pages.sqlite"))
+    yield checkpoints
+    checkpoints.close()
+
+
+def as_json(contents):
+    return json.loads(json.dumps(contents))
+
+
+def test_keyed_by_version_and_ocr(checkpoints):
+    checkpoints.put("sha1:a", "1", False, {0: ["text"], 3: ["more"]})
+    checkpoints.put("sha1:a", "1", True, {1: ["ocr"]})
+
+    assert checkpoints.get("sha1:a", "1", False) == {0: ["text"], 3: ["more"]}
+    assert checkpoints.get("sha1:a", "1", True) == {1: ["ocr"]}
+    assert checkpoints.get("sha1:a", "2", False) == {}
+    assert checkpoints.get("sha1:b", "1", False) == {}
+
+    checkpoints.remove("sha1:a")
+    assert checkpoints.get("sha1:a", "1", False) == {}
+
+
+def test_pages_saved_as_they_are_extracted(checkpoints):
+    checkpoint = checkpoints.document("sha1:a", pdf_extractor.HANDLER_VERSION)
+    proc = PdfProcessor(PDF, checkpoint=checkpoint)
+
+    contents = proc.get_contents()
+
+    assert len(contents) == PAGES
+    assert checkpoint.load() == {page[0]: as_json(page) for page in contents}
+    assert checkpoint.load(ocr=True) == {}
+
+
+def test_checkpointed_pages_not_extracted_again(checkpoints, monkeypatch):
+    checkpoint = checkpoints.document("sha1:a", pdf_extractor.HANDLER_VERSION)
+    expected = as_json(PdfProcessor(PDF).get_contents())
+    done = {i: expected[i] for i in range(0, PAGES, 2)}
+    checkpoint.save(done)
+    extracted = []
+    get_line_boxes = pdf_extractor.Page.get_line_boxes
+
+    def line_boxes(page):
+        extracted.append(page.pnumber)
+        return get_line_boxes(page)
+
+    monkeypatch.setattr(pdf_extractor.Page, "get_line_boxes", line_boxes)
+
+    contents = PdfProcessor(PDF, checkpoint=checkpoint).get_contents()
+
+    assert extracted == list(range(1, PAGES, 2))
+    assert as_json(contents) == expected
+
+
+@pytest.fixture
+def ocr_calls(monkeypatch):
+    calls = []
+
+    def run_ocrmypdf(pdf_path, output_path, pages=None):
+        calls.append(pages)
+        shutil.copy(pdf_path, output_path)
+
+    monkeypatch.setattr(pdf_extractor, "run_ocrmypdf", run_ocrmypdf)
+    return calls
+
+
+def test_ocr_resumes_with_the_missing_pages(tmp_path, checkpoints, ocr_calls):
+    checkpoint = checkpoints.document("sha1:a", pdf_extractor.HANDLER_VERSION)
+    expected = as_json(PdfProcessor(PDF).get_contents())
+    # Pages that the killed worker had OCR-ed.
+    checkpoint.save({i: expected[i] for i in range(10)}, ocr=True)
+
+    proc = apply_ocr(PDF, str(tmp_path), checkpoint=checkpoint)
+
+    assert ocr_calls == [list(range(10, PAGES))]
+    # Down to the last page, the processor was reopened.
+    assert as_json(proc.get_contents()) == expected
+    assert sorted(checkpoint.load(ocr=True)) == list(range(PAGES))
+    assert not os.path.exists(tmp_path / "ocr-missing.pdf")
+
+    # All done, nothing left to OCR.
+    proc = apply_ocr(PDF, str(tmp_path), checkpoint=checkpoint)
+    assert ocr_calls == [list(range(10, PAGES))]
+    assert as_json(proc.get_contents()) == expected
+
+
+def test_ocr_without_checkpoints(tmp_path, ocr_calls):
+    proc = apply_ocr(PDF, str(tmp_path), page_range=[1, 5])
+
+    # A preview only OCRs its pages.
+    assert ocr_calls == [[1, 5]]
+    assert [page[0] for page in proc.get_contents()] == [1, 5]
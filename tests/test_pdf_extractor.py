@@ -0,0 +1,128 @@
+import os
+import shutil
+import subprocess
+
+import ocrmypdf
+import pikepdf
+import pytest
+
+from conftest import FIXTURES
+from textit.extractors import pdf_extractor
+from textit.extractors.pdf_extractor import PdfProcessor, decrypt_pdf, process_pdf
+
+PDF = os.path.join(FIXTURES, "Friedrich Nietzsche - The Use and Abuse of History.mobi")
+
+
+@pytest.fixture
+def encrypted(tmp_path):
+    """The fixture with an owner password only, which opens without one."""
+    path = str(tmp_path / "encrypted.pdf")
+    with pikepdf.open(PDF) as pdf:
+        pdf.save(path, encryption=pikepdf.Encryption(owner="secret", user="",
+                                                     allow=pikepdf.Permissions(extract=False)))
+    return path
+
+
+def is_encrypted(path):
+    with pikepdf.open(path) as pdf:
+        return pdf.is_encrypted
+
+
+def test_decrypt_with_pikepdf(tmp_path, encrypted, monkeypatch):
+    def no_qpdf(*args, **kwargs):
+        raise AssertionError("qpdf run")
+
+    monkeypatch.setattr(pdf_extractor.subprocess, "run", no_qpdf)
+    output = str(tmp_path / "decrypted.pdf")
+
+    decrypt_pdf(encrypted, output)
+
+    assert is_encrypted(encrypted) and not is_encrypted(output)
+    assert not PdfProcessor(output).is_encrypted()
+
+
+@pytest.mark.parametrize("returncode", [0, 3])
+def test_qpdf_fallback(tmp_path, encrypted, monkeypatch, returncode):
+    def broken(path):
+        raise pikepdf.PdfError("unsupported")
+
+    commands = []
+
+    def qpdf(command, **kwargs):
+        commands.append(command)
+        shutil.copy(command[2], command[3])
+        return subprocess.CompletedProcess(command, returncode, stderr=b"warning")
+
+    monkeypatch.setattr(pdf_extractor.pikepdf, "open", broken)
+    monkeypatch.setattr(pdf_extractor.subprocess, "run", qpdf)
+    output = str(tmp_path / "decrypted.pdf")
+
+    decrypt_pdf(encrypted, output)
+
+    assert commands == [["qpdf", "--decrypt", encrypted, output]]
+
+
+def test_qpdf_failure(tmp_path, encrypted, monkeypatch):
+    def broken(path):
+        raise pikepdf.PdfError("unsupported")
+
+    monkeypatch.setattr(pdf_extractor.pikepdf, "open", broken)
+    monkeypatch.setattr(pdf_extractor.subprocess, "run", lambda command, **kwargs:
+                        subprocess.CompletedProcess(command, 2, stderr=b"invalid password\n"))
+
+    with pytest.raises(RuntimeError, match="exit code 2: invalid password$"):
+        decrypt_pdf(encrypted, str(tmp_path / "decrypted.pdf"))
+
+
+@pytest.fixture
+def ocr_calls(monkeypatch):
+    calls = []
+
+    def run_ocrmypdf(pdf_path, output_path, pages=None):
+        calls.append(os.path.basename(pdf_path))
+        shutil.copy(pdf_path, output_path)
+
+    monkeypatch.setattr(pdf_extractor, "run_ocrmypdf", run_ocrmypdf)
+    return calls
+
+
+def test_decrypted_without_ocr(tmp_path, encrypted, ocr_calls):
+    proc, meta = process_pdf(encrypted, str(tmp_path))
+
+    # The text of the decrypted document is good enough.
+    assert meta == {"decrypted": True}
+    assert ocr_calls == []
+    assert len(proc.get_contents()) == PdfProcessor(PDF).page_count()
+
+
+def test_decrypted_then_ocr(tmp_path, encrypted, ocr_calls, monkeypatch):
+    monkeypatch.setattr(PdfProcessor, "broken_pdf", lambda self: True)
+
+    _, meta = process_pdf(encrypted, str(tmp_path))
+
+    assert meta == {"decrypted": True, "ocr": True}
+    # ocrmypdf only gets the decrypted one.
+    assert ocr_calls == ["decrypted.pdf"]
+
+
+def test_encryption_found_by_ocrmypdf(tmp_path, ocr_calls, monkeypatch):
+    def run_ocrmypdf(pdf_path, output_path, pages=None):
+        if os.path.basename(pdf_path) != "decrypted.pdf":
+            raise ocrmypdf.exceptions.EncryptedPdfError()
+        ocr_calls.append(os.path.basename(pdf_path))
+        shutil.copy(pdf_path, output_path)
+
+    monkeypatch.setattr(pdf_extractor, "run_ocrmypdf", run_ocrmypdf)
+    monkeypatch.setattr(PdfProcessor, "broken_pdf", lambda self: True)
+
+    _, meta = process_pdf(PDF, str(tmp_path))
+
+    assert meta == {"ocr": True, "decrypted": True}
+    assert ocr_calls == ["decrypted.pdf"]
+
+
+def test_max_pages_spread_over_the_document():
+    proc = PdfProcessor(PDF, max_pages=5)
+
+    assert [page[0] for page in proc.get_contents()] == [0, 10, 21, 32, 43]
+    assert proc.page_count() == 54
@@ -0,0 +1,56 @@
+import json
+
+import pytest
+
+from textit.metadata import FileType
+from textit.preview import PreviewReport, document_sample
+
+MB = 2 ** 20
+
+
+def test_document_sample():
+    result = {"file_type": FileType.PDF, "preview_fraction": 0.25, "ocr": True,
+              "languages": {"ro": 300, "en": 100}}
+
+    assert document_sample(result, ["kept", "lines"], 4 * MB) == {
+        "file_type": "PDF", "size": 4 * MB, "fraction": 0.25, "raw_chars": 400, "chars": 9,
+        "languages": {"ro": 300, "en": 100}, "ocr": True, "drop_reason": None}
+    # Whole documents, for the handlers that can't do less.
+    assert document_sample({}, [], 10)["fraction"] == 1.0
+
+
+def sample(file_type, fraction, size, raw_chars, chars, **kwargs):
+    return {"file_type": file_type, "size": size, "fraction": fraction, "raw_chars": raw_chars,
+            "chars": chars, "languages": {"ro": raw_chars}, "ocr": False, "drop_reason": None,
+            **kwargs}
+
+
+def test_projected_to_the_documents_and_the_corpus(tmp_path):
+    preview = PreviewReport(sample_rate=0.5)
+    # A tenth of a PDF, the whole of a web page.
+    preview.add("ok", 1.0, sample("PDF", 0.1, 10 * MB, 1000, 800, ocr=True))
+    preview.add("ok", 0.5, sample("HTML", 1.0, MB, 500, 100))
+    preview.add("dropped", 0.1, sample("HTML", 1.0, MB, 0, 0, drop_reason="quality"))
+    preview.add("timeout", None, None)
+
+    report = preview.report()
+
+    assert report["documents"] == 3
+    assert report["statuses"] == {"ok": 2, "dropped": 1, "timeout": 1}
+    assert report["sampled_mb"] == pytest.approx(3)
+    assert report["yield"] == pytest.approx((8000 + 100) / (10000 + 500))
+    assert report["ocr_fraction"] == pytest.approx(1 / 3)
+    assert report["drop_reasons"] == {"quality": 1}
+    assert report["projected"]["documents"] == 6
+    assert report["projected"]["mb"] == pytest.approx(24)
+    assert report["projected"]["chars"] == 2 * 8100
+    assert report["projected"]["cpu_hours"] == pytest.approx(2 * (10 + 0.6) / 3600)
+    pdf = report["by_type"]["PDF"]
+    assert pdf["chars_per_mb"] == pytest.approx(800)
+    assert pdf["seconds_per_mb"] == pytest.approx(1)
+    assert "Projected: 6 documents, 24 MB" in preview.summary()
+
+    path = str(tmp_path / "preview.json")
+    preview.write(path)
+    with open(path) as f:
+        assert json.load(f)["projected"]["documents"] == 6
@@ -0,0 +1,89 @@
+import json
+import os
+import pstats
+import time
+
+import pytest
+
+from textit.profiling import PROFILE_EXTENSIONS, SlowDocumentProfiler, rename_profile
+
+
+def slow_function(seconds):
+    time.sleep(seconds)
+    return seconds
+
+
+def files(directory):
+    return sorted(os.listdir(directory)) if os.path.exists(directory) else []
+
+
+def load(base):
+    with open(base + ".json") as f:
+        return json.load(f)
+
+
+@pytest.mark.parametrize("mode", ["sample", "cprofile"])
+def test_slow_document(tmp_path, mode):
+    profiler = SlowDocumentProfiler(0.05, str(tmp_path), mode=mode, interval=0.002)
+
+    assert profiler.run("doc", {}, slow_function, 0.2) == 0.2
+    base = profiler.save_if_slow("doc", {"input": "in/doc.pdf"})
+
+    assert base == str(tmp_path / "doc")
+    assert files(tmp_path) == sorted("doc" + ext for ext in PROFILE_EXTENSIONS)
+    info = load(base)
+    assert info["input"] == "in/doc.pdf" and info["mode"] == mode
+    assert info["duration"] >= 0.2 and info["samples"] > 0
+    with open(base + ".collapsed") as f:
+        assert "slow_function" in f.read()
+    functions = {name for _, _, name in pstats.Stats(base + ".pstats").stats}
+    assert "slow_function" in functions
+
+
+def test_fast_document(tmp_path):
+    profiler = SlowDocumentProfiler(10, str(tmp_path))
+
+    profiler.run("doc", {}, slow_function, 0)
+
+    assert profiler.save_if_slow("doc", {}) is None
+    assert files(tmp_path) == []
+
+
+def test_profile_of_a_failed_call(tmp_path):
+    def fail():
+        slow_function(0.1)
+        raise ValueError("broken")
+
+    profiler = SlowDocumentProfiler(0.05, str(tmp_path))
+    with pytest.raises(ValueError):
+        profiler.run("doc", {}, fail)
+
+    assert profiler.save_if_slow("doc", {}) is not None
+
+
+def test_partial_profile(tmp_path):
+    profiler = SlowDocumentProfiler(0.05, str(tmp_path), interval=0.002, flush_interval=0.05)
+    seen = []
+
+    def work():
+        slow_function(0.3)
+        # What is left if the worker is killed now.
+        seen.append(load(str(tmp_path / "pending")))
+
+    profiler.run("pending", {"input": "in/doc.pdf"}, work)
+
+    assert seen[0]["partial"] and seen[0]["input"] == "in/doc.pdf"
+    # Saved under its final name, the partial one is gone.
+    base = profiler.save_if_slow("done", {"input": "in/doc.pdf"})
+    assert files(tmp_path) == sorted("done" + ext for ext in PROFILE_EXTENSIONS)
+    assert "partial" not in load(base)
+
+
+def test_rename_profile(tmp_path):
+    profiler = SlowDocumentProfiler(0, str(tmp_path))
+    profiler.run("pending", {}, slow_function, 0.01)
+    profiler.save_if_slow("pending", {})
+
+    assert rename_profile(str(tmp_path), "pending", "timeout") == str(tmp_path / "timeout")
+    assert files(tmp_path) == sorted("timeout" + ext for ext in PROFILE_EXTENSIONS)
+    assert rename_profile(str(tmp_path), "pending", "other") is None
@@ -0,0 +1,28 @@
+from textit.metadata import DocumentClass, FileType, Metadata
+from textit.raw_cache import RawCache
+
+DIGEST = "sha1:" + "ab" * 20
+
+
+def test_round_trip(tmp_path):
+    # A line with bytes of the input that aren't UTF-8.
+    text = ["Română", b"caf\xe9 \xff".decode("utf-8", "surrogateescape"), ""]
+    metadata = Metadata(file_type=FileType.PDF, document_class=DocumentClass.BOOK, nlines=2)
+    metadata.ocr = True
+    cache = RawCache(str(tmp_path / "raw.sqlite"))
+    cache.put(DIGEST, FileType.PDF, "pdf-1", text, metadata)
+
+    file_type, version, cached_text, cached = cache.get(DIGEST)
+
+    assert (file_type, version, cached_text) == (FileType.PDF, "pdf-1", text)
+    assert cached.__dict__ == metadata.__dict__
+    assert cache.version(DIGEST) == (FileType.PDF, "pdf-1")
+    cache.close()
+
+
+def test_missing(tmp_path):
+    cache = RawCache(str(tmp_path / "raw.sqlite"))
+
+    assert cache.get(DIGEST) is None
+    assert cache.version(DIGEST) is None
+    cache.close()
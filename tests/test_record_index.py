@@ -0,0 +1,87 @@
+import json
+import os
+import time
+
+from textit.record_index import (DIRECTORY_INDEX, RecordLookup, build_index, find_indexes,
+                                 read_index, read_record, stale_records)
+from textit.shards import ShardWriter
+
+
+def write_json(path, record):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(record, f, indent=2, ensure_ascii=False)
+
+
+def test_build_index(tmp_path, book_lines):
+    outputs = {
+        "a1b2.json": {"url": "1984.epub", "nlines": 2, "raw_content": "\n".join(book_lines[:2])},
+        "sub/c3d4.json": {"url": "sub/ş.html", "nlines": 1, "raw_content": book_lines[2]},
+    }
+    for name, record in outputs.items():
+        write_json(str(tmp_path / name), record)
+    # Not records.
+    (tmp_path / "broken.json").write_text('{"url": ')
+    (tmp_path / "notes.txt").write_text("notes")
+
+    assert build_index(str(tmp_path)) == 2
+    assert find_indexes(str(tmp_path)) == [str(tmp_path / DIRECTORY_INDEX)]
+
+    entries = {e["path_hash"]: e for e in read_index(str(tmp_path / DIRECTORY_INDEX))}
+    assert set(entries) == {"a1b2", "c3d4"}
+    for name, record in outputs.items():
+        entry = entries[os.path.splitext(os.path.basename(name))[0]]
+        assert entry["file"] == str(tmp_path / name)
+        assert entry["metadata"] == {k: v for k, v in record.items() if k != "raw_content"}
+        assert read_record(entry) == record
+
+
+def test_read_index_skips_a_cut_entry(tmp_path):
+    write_json(str(tmp_path / "a1b2.json"), {"url": "a", "raw_content": ""})
+    build_index(str(tmp_path))
+    with open(tmp_path / DIRECTORY_INDEX, "a") as f:
+        f.write('{"file": "cut')
+
+    assert [e["path_hash"] for e in read_index(str(tmp_path / DIRECTORY_INDEX))] == ["a1b2"]
+
+
+def test_stale_records(tmp_path):
+    write_json(str(tmp_path / "a1b2.json"), {"url": "a", "raw_content": ""})
+    assert stale_records(str(tmp_path)) == [str(tmp_path / "a1b2.json")]
+
+    build_index(str(tmp_path))
+    assert stale_records(str(tmp_path)) == []
+
+    later = time.time() + 10
+    write_json(str(tmp_path / "sub" / "c3d4.json"), {"url": "c", "raw_content": ""})
+    os.utime(tmp_path / "sub" / "c3d4.json", (later, later))
+    assert stale_records(str(tmp_path)) == [str(tmp_path / "sub" / "c3d4.json")]
+
+
+def test_lookup(tmp_path, book_lines):
+    writer = ShardWriter(str(tmp_path), "20261019000000", max_records=2)
+    for i in range(3):
+        writer.write({"url": f"books/{i}.epub", "digest": f"sha1:{i:040x}"},
+                     lines=book_lines[i:i + 2], path_hash=f"{i:032x}")
+    writer.close()
+
+    lookup = RecordLookup(str(tmp_path))
+    assert lookup.updated == 2
+    [entry] = lookup.find(path_hash=f"{1:032x}")
+    assert read_record(entry) == {"url": "books/1.epub", "digest": f"sha1:{1:040x}",
+                                  "raw_content": "\n".join(book_lines[1:3])}
+    assert [e["metadata"]["url"] for e in lookup.find(digest=f"{2:040x}")] == ["books/2.epub"]
+    assert list(lookup.find(url="books/0.epub", path_hash=f"{1:032x}")) == []
+    lookup.close()
+
+    # A shard finalized since, and one removed.
+    writer.write({"url": "books/3.epub"}, lines=book_lines[:1], path_hash=f"{3:032x}")
+    writer.close()
+    first = sorted(find_indexes(str(tmp_path)))[0]
+    os.remove(first)
+
+    lookup = RecordLookup(str(tmp_path))
+    assert lookup.updated == 1
+    assert [e["metadata"]["url"] for e in lookup.find(url="books/3.epub")] == ["books/3.epub"]
+    assert list(lookup.find(url="books/0.epub")) == []
+    lookup.close()
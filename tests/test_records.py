@@ -0,0 +1,59 @@
+import json
+
+import pytest
+
+from textit.metadata import FileType
+from textit.records import iter_record_json
+
+
+def json_default_serializer(obj):
+    if isinstance(obj, FileType):
+        return obj.to_json()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+RECORD = {"file_type": FileType.EPUB, "nlines": 3, "url": "cărţi/1984.epub",
+          "digest": "sha1:347eb8e43feb2503e1230743dd9acdc038efee32"}
+
+LINES = [
+    "",
+    "plain",
+    "quotes \" and backslashes \\ and a tab\t",
+    "controls \x00\x1f\x7f and separators   ",
+    "non-BMP \U0001F600, lone surrogate \udc80",
+    "ŞşŢţ ĂăÂâÎî",
+]
+
+
+@pytest.mark.parametrize("kwargs", [
+    {"indent": 2, "default": json_default_serializer},
+    {"separators": (",", ":"), "default": json_default_serializer},
+    {"ensure_ascii": True, "default": json_default_serializer},
+])
+def test_same_as_json_dumps(kwargs):
+    expected = json.dumps({**RECORD, "raw_content": "\n".join(LINES)},
+                          **{"ensure_ascii": False, **kwargs})
+
+    assert "".join(iter_record_json(RECORD, LINES, **kwargs)) == expected
+
+
+def test_book(book_lines):
+    expected = json.dumps({**RECORD, "raw_content": "\n".join(book_lines)}, indent=2,
+                          ensure_ascii=False, default=json_default_serializer)
+
+    assert "".join(iter_record_json(RECORD, iter(book_lines), indent=2,
+                                    default=json_default_serializer)) == expected
+
+
+def test_no_lines():
+    assert "".join(iter_record_json(RECORD, [], default=json_default_serializer)) == \
+        json.dumps({**RECORD, "raw_content": ""}, ensure_ascii=False,
+                   default=json_default_serializer)
+
+
+def test_content_in_other_members():
+    # The empty content must be found after the other members.
+    record = {"note": '"raw_content": ""', "raw_content": "stale"}
+
+    assert "".join(iter_record_json(record, ["a", "b"])) == \
+        json.dumps({**record, "raw_content": "a\nb"}, ensure_ascii=False)
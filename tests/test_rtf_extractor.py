@@ -0,0 +1,128 @@
+import io
+
+import pytest
+
+from textit.extractors.rtf_extractor import iter_paragraphs, rtf_buffer_handler, rtf_handler
+from textit.metadata import FileType, Metadata
+from textit.sniff import sniff_file_type
+
+
+def paragraphs(document: bytes, chunk_size: int = 1 << 16):
+    chunks = [document[i:i + chunk_size] for i in range(0, len(document), chunk_size)]
+    return list(iter_paragraphs(chunks))
+
+
+HEADER = rb"{\rtf1\ansi\ansicpg1250\deff0{\fonttbl{\f0\fnil Times;}{\f1\fcharset204 Arial;}}"
+
+DOCUMENT = HEADER + (
+    rb"{\info{\title Not this}{\author Nor this}}"
+    rb"{\*\generator Writer;}"
+    rb"Rom\'e2n\'e3 \'ee\'fe\par "
+    rb"\f1 \'cf\'f0\'e8\'e2\'e5\'f2\f0\par "
+    rb"{\pict\pngblip 89504e470d0a1a0a}"
+    rb"Unicode: \u537?\u-3913?\uc2\u8364 EU end\uc1\par "
+    rb"Binary: {\object\objdata\bin6 {\}\ab}after\par "
+    rb"Emoji: \u-10179?\u-8704?\par "
+    rb"Tab\tab cell\cell quote \ldblquote q\rdblquote \par "
+    rb"}"
+)
+
+EXPECTED = [
+    "Română îţ",
+    "Привет",
+    "Unicode: ș\uf0b7€ end",
+    "Binary: after",
+    "Emoji: \U0001F600",
+    "Tab\tcell\tquote “q”",
+]
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 64, 1 << 16])
+def test_paragraphs(chunk_size):
+    # Tokens, \bin data and multi-byte escapes cut anywhere.
+    assert paragraphs(DOCUMENT, chunk_size) == EXPECTED
+
+
+def test_uc_fallback():
+    # The fallback of \uN is \uc characters long; a \'hh counts as one.
+    document = HEADER + rb"a\uc3\u233 xyzb\uc1\u233\'e9c\uc0\u233 d\par }"
+    assert paragraphs(document) == ["aébécéd"]
+
+
+def test_uc_scoped_to_group():
+    document = HEADER + rb"{\uc2 \u233 xx}\u233 yz\par }"
+    assert paragraphs(document) == ["ééz"]
+
+
+def test_bin_skipped_across_chunks():
+    data = bytes(range(256)) * 4
+    document = HEADER + rb"before{\*\blob\bin" + str(len(data)).encode() + b" " + data + \
+        rb"}after\par }"
+    for chunk_size in (5, 100, 1000):
+        assert paragraphs(document, chunk_size) == ["beforeafter"]
+
+
+def test_double_byte_code_page():
+    document = (rb"{\rtf1\ansi\ansicpg932\deff0{\fonttbl{\f0\fcharset128 MS Mincho;}}"
+                rb"\'93\'fa\'96\'7b\'8c\'ea\par }")
+    # The bytes of a character can be split between chunks.
+    for chunk_size in (1, 2, 3, 64):
+        assert paragraphs(document, chunk_size) == ["日本語"]
+
+
+def test_code_page_of_font_cpg():
+    document = HEADER + rb"{\fonttbl{\f2\cpg1253 Greek;}}\f2 \'e1\'e2\'e3\f0  \'e3\par }"
+    assert paragraphs(document) == ["αβγ ă"]
+
+
+def test_mac_code_page():
+    document = rb"{\rtf1\mac\deff0 caf\'8e\par }"
+    assert paragraphs(document) == ["café"]
+
+
+def test_handlers(tmp_path):
+    path = tmp_path / "test.rtf"
+    path.write_bytes(DOCUMENT)
+
+    text, _ = rtf_handler(str(path), Metadata())
+    buffer_text, _ = rtf_buffer_handler(bytearray(DOCUMENT), str(path), Metadata())
+
+    assert text.unwrap() == buffer_text.unwrap() == EXPECTED
+
+
+def test_not_rtf(tmp_path):
+    path = tmp_path / "test.rtf"
+    path.write_bytes(b"Plain text, not RTF")
+
+    text, _ = rtf_handler(str(path), Metadata())
+
+    assert text.is_err()
+
+
+def test_preview(tmp_path):
+    path = tmp_path / "test.rtf"
+    path.write_bytes(DOCUMENT)
+
+    # Up to the end of the second paragraph.
+    text, metadata = rtf_handler(str(path), Metadata(), max_bytes=DOCUMENT.index(rb"\f0\par"))
+
+    assert text.unwrap() == EXPECTED[:2]
+    assert 0 < metadata.preview_fraction < 1
+
+
+@pytest.mark.parametrize("prefix", [b"", b"\r\n  ", b"\xef\xbb\xbf", b"\xef\xbb\xbf\n"])
+def test_same_rule_as_the_sniffer(tmp_path, prefix):
+    path = tmp_path / "test.rtf"
+    path.write_bytes(prefix + DOCUMENT)
+
+    text, _ = rtf_handler(str(path), Metadata())
+
+    assert sniff_file_type(io.BytesIO(prefix + DOCUMENT)).unwrap() == FileType.RTF
+    assert text.unwrap() == EXPECTED
+
+
+def test_not_rtf_for_either():
+    for data in (b"x" + DOCUMENT, b"\xef\xbb\xbf\xef\xbb\xbf" + DOCUMENT):
+        text, _ = rtf_buffer_handler(bytearray(data), "test.rtf", Metadata())
+        assert text.is_err()
+        assert sniff_file_type(io.BytesIO(data)).unwrap() != FileType.RTF
@@ -0,0 +1,84 @@
+import os
+import time
+
+import pytest
+
+from conftest import FIXTURES
+from textit import scheduler
+from textit.metadata import FileType
+from textit.scheduler import CostModel, TaskFeatures, probe_pdf, schedule
+
+PDF = os.path.join(FIXTURES, "Friedrich Nietzsche - The Use and Abuse of History.mobi")
+NAMES = ["hotnews_page.html", "1984 - George Orwell.epub", os.path.basename(PDF),
+         "Tom Clancy - Rainbow Six 01 #2.0~5.doc"]
+
+MB = 2 ** 20
+
+
+def tasks():
+    for name in NAMES:
+        path = os.path.join(FIXTURES, name)
+        yield os.path.getsize(path), (path, name + ".json")
+
+
+def run(**kwargs):
+    kwargs.setdefault("probe_processes", 0)
+    return list(schedule(tasks(), 100, CostModel(), context="fork", **kwargs))
+
+
+def test_most_expensive_first():
+    scheduled = run()
+
+    costs = [estimate.cost for _, _, estimate in scheduled]
+    assert costs == sorted(costs, reverse=True)
+    assert sorted(path for path, _, _ in scheduled) == sorted(path for _, (path, _) in tasks())
+    by_name = {os.path.basename(path): estimate for path, _, estimate in scheduled}
+    assert by_name[os.path.basename(PDF)].features.file_type == FileType.PDF.name
+    assert by_name[os.path.basename(PDF)].features.pages == probe_pdf(PDF)[0] > 0
+    for estimate in by_name.values():
+        assert estimate.cost == CostModel().predict(estimate.features)
+
+
+def test_windows_are_ordered_on_their_own(monkeypatch):
+    monkeypatch.setattr(scheduler, "FIRST_WINDOW", 2)
+    sizes = [1, 5, 3, 8, 2, 9]
+    items = [(size * MB, (f"missing/{i}.bin", f"{i}.json")) for i, size in enumerate(sizes)]
+
+    scheduled = list(schedule(items, 100, CostModel({None: [0, 1, 0, 0]}), probe_processes=0))
+
+    # Windows of 2, then 4.
+    assert [estimate.cost for _, _, estimate in scheduled] == [5, 1, 9, 8, 3, 2]
+
+
+def test_unreadable_file_costs_its_size(monkeypatch):
+    def broken(path):
+        raise ValueError("broken")
+
+    monkeypatch.setattr(scheduler, "get_file_type", broken)
+
+    for _, _, estimate in run():
+        assert estimate.features == TaskFeatures(None, estimate.features.size)
+        assert estimate.cost == CostModel().predict(TaskFeatures(None, estimate.features.size))
+
+
+def test_probe_processes():
+    assert run(probe_processes=2) == run()
+
+
+@pytest.mark.parametrize("failure", ["hang", "crash"])
+def test_failed_pdf_probe_costs_its_size(monkeypatch, failure):
+    def probe(path):
+        if failure == "hang":
+            time.sleep(30)
+        os._exit(1)
+
+    # Forked, the probe processes see it too.
+    monkeypatch.setattr(scheduler, "probe_pdf", probe)
+    started = time.monotonic()
+
+    scheduled = run(probe_processes=1, probe_timeout=0.5)
+
+    assert time.monotonic() - started < 10
+    pdf = [estimate for path, _, estimate in scheduled if path == PDF][0]
+    assert pdf.features == TaskFeatures(FileType.PDF.name, os.path.getsize(PDF))
+    assert pdf.cost == CostModel().predict(pdf.features)
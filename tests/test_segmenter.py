@@ -0,0 +1,45 @@
+from textit.metadata import Metadata
+from textit.processors import Segmenter
+from textit.processors.segmenter import segment, split_line
+
+
+def test_lines_packed_without_changing_the_text():
+    lines = [f"Line {i}." for i in range(20)]
+    units = list(segment(["\n".join(lines[:7]), "\n".join(lines[7:])], 30))
+
+    assert all(len(unit) <= 30 for unit in units)
+    assert "\n".join(units) == "\n".join(lines)
+    # No line split between units.
+    assert [line for unit in units for line in unit.split("\n")] == lines
+
+
+def test_cut_after_a_sentence():
+    line = "First sentence here. Second one, a bit longer. Third."
+
+    assert list(split_line(line, 30)) == ["First sentence here.", "Second one, a bit longer.",
+                                          "Third."]
+
+
+def test_cut_at_a_space():
+    assert list(split_line("no sentence ends in this long line", 15)) == \
+        ["no sentence", "ends in this", "long line"]
+
+
+def test_cut_anywhere():
+    assert list(split_line("x" * 25, 10)) == ["x" * 10, "x" * 10, "x" * 5]
+
+
+def test_cut_line_changes_only_the_separator():
+    line = "First sentence here.  Second one, a bit longer. Third part"
+    units = list(segment([line], 30))
+
+    # The whitespace at each cut became a newline.
+    assert "\n".join(units) == "First sentence here.\nSecond one, a bit longer.\nThird part"
+    assert all(len(unit) <= 30 for unit in units)
+
+
+def test_segmenter():
+    texts = ["a\nb", None, "c " * 20]
+
+    assert Segmenter(10)(texts, Metadata()) == ["a\nb", "c c c c c", "c c c c c", "c c c c c",
+                                                "c c c c c "]
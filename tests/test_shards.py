@@ -0,0 +1,160 @@
+import os
+import socket
+import subprocess
+
+import pytest
+
+from textit import shards
+from textit.record_index import INDEX_SUFFIX, read_index, read_record
+from textit.shards import (TMP_SUFFIX, ShardWriter, iter_members, iter_records, recover_shards,
+                           shard_run, shard_runs, zstandard)
+
+RUN = "20261019000000"
+
+
+def records(book_lines, n):
+    return [({"url": f"books/{i}.epub", "nlines": 10}, book_lines[i * 10:(i + 1) * 10])
+            for i in range(n)]
+
+
+def expected(record, lines):
+    return {**record, "raw_content": "\n".join(lines)}
+
+
+@pytest.fixture
+def dead_pid():
+    process = subprocess.Popen(["true"])
+    process.wait()
+    return process.pid
+
+
+def dead_writer(output_dir, pid, **kwargs):
+    writer = ShardWriter(output_dir, RUN, **kwargs)
+    writer.name = f"{socket.gethostname()}-{pid}-{RUN}"
+    return writer
+
+
+def test_write_and_rotate(tmp_path, book_lines):
+    writer = ShardWriter(str(tmp_path), RUN, max_records=2)
+    paths = [writer.write(record, lines=lines, path_hash=record["url"])
+             for record, lines in records(book_lines, 5)]
+    writer.close()
+
+    assert len(set(paths)) == 3
+    assert all(os.path.exists(path) and os.path.exists(path + INDEX_SUFFIX) for path in paths)
+    assert [r for path in sorted(set(paths)) for r in iter_records(path)] == \
+        [expected(*r) for r in records(book_lines, 5)]
+    assert shard_run(os.path.basename(paths[0])) == RUN
+    assert shard_runs(str(tmp_path)) == {RUN: True}
+
+
+@pytest.mark.parametrize("compression", ["gzip", "zstd"])
+@pytest.mark.parametrize("read_size", [7, 100, 2 ** 20])
+def test_records_across_reads(tmp_path, book_lines, monkeypatch, compression, read_size):
+    if compression == "zstd" and zstandard is None:
+        pytest.skip("no zstandard")
+    writer = ShardWriter(str(tmp_path), RUN, compression=compression)
+    for record, lines in records(book_lines, 4):
+        path = writer.write(record, lines=lines)
+    writer.close()
+    with open(path, "rb") as f:
+        data = f.read()
+
+    monkeypatch.setattr(shards, "READ_SIZE", read_size)
+    members = list(iter_members(path))
+
+    assert [(length, data[offset:offset + length]) for offset, length, _ in members] == \
+        [(e["length"], data[e["offset"]:e["offset"] + e["length"]])
+         for e in read_index(path + INDEX_SUFFIX)]
+    assert list(iter_records(path)) == [expected(*r) for r in records(book_lines, 4)]
+
+
+def test_index_points_to_records(tmp_path, book_lines):
+    writer = ShardWriter(str(tmp_path), RUN)
+    path = None
+    for record, lines in records(book_lines, 3):
+        path = writer.write(record, lines=lines, path_hash=record["url"])
+    writer.close()
+
+    entries = list(read_index(path + INDEX_SUFFIX))
+
+    assert [e["path_hash"] for e in entries] == [f"books/{i}.epub" for i in range(3)]
+    assert [e["metadata"] for e in entries] == [record for record, _ in records(book_lines, 3)]
+    assert [read_record(e) for e in entries] == [expected(*r) for r in records(book_lines, 3)]
+
+
+def test_recover_cuts_the_last_record(tmp_path, book_lines, dead_pid):
+    writer = dead_writer(str(tmp_path), dead_pid)
+    for record, lines in records(book_lines, 3):
+        path = writer.write(record, lines=lines, path_hash=record["url"])
+    # Killed while writing the fourth record.
+    writer._file.write(b"\x1f\x8b\x08\x00partial")
+    writer._file.flush()
+    for f in (writer._file, writer._index):
+        f.close()
+
+    assert shard_runs(str(tmp_path)) == {RUN: False}
+    assert recover_shards(str(tmp_path)) == 1
+
+    assert not os.path.exists(path + TMP_SUFFIX)
+    assert list(iter_records(path)) == [expected(*r) for r in records(book_lines, 3)]
+    assert [read_record(e) for e in read_index(path + INDEX_SUFFIX)] == \
+        [expected(*r) for r in records(book_lines, 3)]
+    assert shard_runs(str(tmp_path)) == {RUN: True}
+
+
+def test_recover_rebuilds_the_index(tmp_path, book_lines, dead_pid):
+    writer = dead_writer(str(tmp_path), dead_pid)
+    for record, lines in records(book_lines, 4):
+        path = writer.write(record, lines=lines, path_hash=record["url"])
+    for f in (writer._file, writer._index):
+        f.close()
+    # Only the first entry made it to the index.
+    index_tmp = path + INDEX_SUFFIX + TMP_SUFFIX
+    with open(index_tmp) as f:
+        first = f.readline()
+    with open(index_tmp, "w") as f:
+        f.write(first + '{"file": "cut')
+
+    assert recover_shards(str(tmp_path), lambda record: "rebuilt:" + record["url"]) == 1
+
+    entries = list(read_index(path + INDEX_SUFFIX))
+    assert [e["path_hash"] for e in entries] == \
+        ["books/0.epub"] + [f"rebuilt:books/{i}.epub" for i in range(1, 4)]
+    assert [read_record(e) for e in entries] == [expected(*r) for r in records(book_lines, 4)]
+
+
+def test_recover_removes_empty_shards(tmp_path, dead_pid):
+    writer = dead_writer(str(tmp_path), dead_pid)
+    writer._open()
+    writer._file.write(b"\x1f\x8b")
+    for f in (writer._file, writer._index):
+        f.close()
+
+    assert recover_shards(str(tmp_path)) == 0
+    assert os.listdir(tmp_path) == []
+
+
+def test_recover_leaves_live_workers_alone(tmp_path, book_lines):
+    writer = ShardWriter(str(tmp_path), RUN)
+    record, lines = records(book_lines, 1)[0]
+    path = writer.write(record, lines=lines)
+
+    assert recover_shards(str(tmp_path)) == 0
+    assert os.path.exists(path + TMP_SUFFIX)
+    writer.close()
+
+
+def test_recover_only_the_given_worker(tmp_path, book_lines, dead_pid):
+    other = subprocess.Popen(["true"])
+    other.wait()
+    paths = []
+    for pid in (dead_pid, other.pid):
+        writer = dead_writer(str(tmp_path), pid)
+        record, lines = records(book_lines, 1)[0]
+        paths.append(writer.write(record, lines=lines))
+        for f in (writer._file, writer._index):
+            f.close()
+
+    assert recover_shards(str(tmp_path), pid=dead_pid) == 1
+    assert os.path.exists(paths[0]) and os.path.exists(paths[1] + TMP_SUFFIX)
@@ -0,0 +1,90 @@
+import io
+import os
+import struct
+
+import pytest
+
+from conftest import FIXTURES
+from textit import sniff
+from textit.metadata import FileType
+from textit.sniff import get_file_type, sniff_file_type
+
+HTML = "<!DOCTYPE html><html><head><title>Știri</title></head><body><p>Text în română.</p></body></html>"
+
+
+@pytest.mark.parametrize("name, file_type", [
+    ("1984 - George Orwell.epub", FileType.EPUB),
+    ("J.R.R. Tolkien - Stapinul inelelor 1 - Fratia inelului.mobi", FileType.MOBI),
+    # A PDF, whatever its name says.
+    ("Friedrich Nietzsche - The Use and Abuse of History.mobi", FileType.PDF),
+    ("RAZEC INES-IDENTITATEA ÎN EPOCA NOILOR TEHNOLOGII.docx", FileType.DOC),
+    ("Tom Clancy - Rainbow Six 01 #2.0~5.doc", FileType.DOC),
+    ("hotnews_page.html", FileType.HTML),
+])
+def test_fixtures(name, file_type):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        assert sniff_file_type(f).unwrap() == file_type
+
+
+@pytest.mark.parametrize("encoding", ["utf-8-sig", "utf-16", "utf-16-be", "utf-32"])
+def test_html_with_bom(encoding):
+    data = HTML.encode(encoding)
+    if encoding == "utf-16-be":
+        data = b"\xfe\xff" + data
+
+    assert sniff_file_type(io.BytesIO(data)).unwrap() == FileType.HTML
+
+
+def test_utf16_without_bom_is_ambiguous():
+    assert sniff_file_type(io.BytesIO(HTML.encode("utf-16-le"))).is_err()
+
+
+def test_ambiguous_asks_libmagic(tmp_path, monkeypatch):
+    asked = []
+
+    def libmagic(path, buffer=None):
+        asked.append(path)
+        return FileType.HTML
+
+    monkeypatch.setattr(sniff, "file_type_from_libmagic", libmagic)
+    path = tmp_path / "page.html"
+    path.write_bytes(HTML.encode("utf-16-le"))
+
+    assert get_file_type(str(path)) == FileType.HTML
+    assert asked == [str(path)]
+
+
+@pytest.mark.parametrize("data", [b"\x00\x01binary\x02 %PDF-1.4", b"Some text, then %PDF-1.4"])
+def test_late_pdf_header_is_ambiguous(data):
+    assert sniff_file_type(io.BytesIO(data)).is_err()
+
+
+def test_not_handled():
+    assert sniff_file_type(io.BytesIO(b"Just some plain text.\n")).unwrap() is None
+    assert sniff_file_type(io.BytesIO(bytes(range(256)))).unwrap() is None
+
+
+def ole2_header(sector_shift, first_dir_sector):
+    head = bytearray(512)
+    head[:8] = sniff.OLE2_MAGIC
+    struct.pack_into("<H", head, 0x1e, sector_shift)
+    struct.pack_into("<I", head, 0x30, first_dir_sector)
+    return bytes(head)
+
+
+@pytest.mark.parametrize("data", [
+    ole2_header(9, 0)[:0x20],
+    # A sector size in the exabytes.
+    ole2_header(0xffff, 0),
+    ole2_header(63, 0),
+    # The directory is past the end of the file, or cut.
+    ole2_header(9, 0xfffffffe),
+    ole2_header(9, 0) + b"\x00" * 100,
+], ids=["short header", "huge sector", "exabyte sector", "directory past the end", "cut directory"])
+def test_corrupt_ole2(tmp_path, monkeypatch, data):
+    assert sniff_file_type(io.BytesIO(data)).is_err()
+
+    monkeypatch.setattr(sniff, "file_type_from_libmagic", lambda path, buffer=None: None)
+    path = tmp_path / "corrupt.doc"
+    path.write_bytes(data)
+    assert get_file_type(str(path)) is None
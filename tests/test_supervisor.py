@@ -0,0 +1,164 @@
+import os
+import subprocess
+import time
+
+import pytest
+
+from textit import events, supervisor
+from textit.supervisor import Supervisor, available_memory
+
+# Forking is enough here, and doesn't need the test module to be importable
+# by a fork server.
+CONTEXT = "fork"
+
+
+def work(task):
+    kind, arg = task
+    if kind == "sleep":
+        time.sleep(arg)
+    elif kind == "crash":
+        os._exit(1)
+    elif kind == "child":
+        # A subprocess that would outlive its worker, if it weren't killed too.
+        child = subprocess.Popen(["sleep", "60"])
+        with open(arg, "w") as f:
+            f.write(str(child.pid))
+        time.sleep(60)
+    elif kind == "ocr":
+        events.report("ocr")
+        time.sleep(arg)
+    elif kind == "write":
+        supervisor.defer(lambda result: result + ("written",))
+    elif kind == "stuck_write":
+        supervisor.defer(lambda result: time.sleep(60))
+    return kind, arg, os.getpid()
+
+
+def failed(task, reason, events, elapsed, pid):
+    return "failed", task, reason, events
+
+
+def run(tasks, **kwargs):
+    kwargs.setdefault("on_failure", failed)
+    with Supervisor(2, work, context=CONTEXT, **kwargs) as pool:
+        results = list(pool.imap_unordered(tasks))
+    return pool, results
+
+
+def pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    # A zombie until its parent (gone) is reaped.
+    with open(f"/proc/{pid}/stat") as f:
+        return f.read().split()[2] != "Z"
+
+
+def test_results():
+    pool, results = run([("sleep", 0), ("sleep", 0.1), ("sleep", 0)])
+
+    assert sorted(r[:2] for r in results) == [("sleep", 0), ("sleep", 0), ("sleep", 0.1)]
+    assert pool.replaced == 0
+
+
+def test_timeout():
+    pool, results = run([("sleep", 30), ("sleep", 0), ("sleep", 0)],
+                        budget=lambda task, events: 0.5)
+
+    assert ("failed", ("sleep", 30), "timeout", {}) in results
+    assert sorted(r[:2] for r in results if r[0] != "failed") == [("sleep", 0), ("sleep", 0)]
+    assert pool.replaced == 1
+
+
+def test_timeout_kills_the_children(tmp_path):
+    pid_file = str(tmp_path / "child.pid")
+    pool, results = run([("child", pid_file)], budget=lambda task, events: 1.0)
+
+    assert results[0][:3] == ("failed", ("child", pid_file), "timeout")
+    with open(pid_file) as f:
+        assert not pid_alive(int(f.read()))
+
+
+def test_budget_follows_the_events():
+    def budget(task, events):
+        return 5.0 if "ocr" in events else 0.3
+
+    pool, results = run([("ocr", 1.0)], budget=budget)
+
+    assert results[0][:2] == ("ocr", 1.0)
+    assert pool.replaced == 0
+
+
+def test_crash():
+    pool, results = run([("crash", None), ("sleep", 0)])
+
+    assert ("failed", ("crash", None), "crash", {}) in results
+    assert [r[:2] for r in results if r[0] != "failed"] == [("sleep", 0)]
+    assert pool.replaced == 1
+
+
+def test_recycle_after_max_tasks():
+    pool, results = run([("sleep", 0.05)] * 8, max_tasks=2)
+
+    assert len(results) == 8
+    # No worker ran more than two tasks.
+    pids = [r[2] for r in results]
+    assert max(pids.count(pid) for pid in pids) <= 2
+    assert pool.recycled["tasks"] >= 3
+    assert pool.replaced == 0
+
+
+def test_recycle_over_max_rss():
+    pool, results = run([("sleep", 0)] * 4, max_rss=1)
+
+    assert len(results) == 4
+    assert len({r[2] for r in results}) == 4
+    assert pool.recycled["memory"] == 4
+
+
+def test_wait_for_memory():
+    memory = available_memory()
+    if memory is None:
+        pytest.skip("no /proc/meminfo")
+
+    def memory_needed(task):
+        return 10 * memory if task[0] == "ocr" else 0
+
+    # The big task is held (and retried every second) until the other one is done.
+    pool, results = run([("sleep", 2.5), ("ocr", 0)], memory_needed=memory_needed)
+
+    assert sorted(r[:2] for r in results) == [("ocr", 0), ("sleep", 2.5)]
+    assert pool.waited_for_memory == 1
+
+
+def test_deferred_work():
+    pool, results = run([("write", i) for i in range(4)], writer_queue=2)
+
+    assert sorted((r[1], r[3]) for r in results) == [(i, "written") for i in range(4)]
+
+
+def test_deferred_work_timeout():
+    started = time.monotonic()
+    pool, results = run([("stuck_write", None), ("write", 0)], writer_queue=2,
+                        budget=lambda task, events: 1.0)
+
+    assert time.monotonic() - started < 30
+    assert ("failed", ("stuck_write", None), "timeout", {}) in results
+    assert pool.replaced == 1
+
+
+def test_tasks_consumed_a_few_ahead():
+    consumed = []
+
+    def tasks():
+        for i in range(20):
+            consumed.append(i)
+            yield "sleep", 0.05
+
+    with Supervisor(2, work, on_failure=failed, context=CONTEXT) as pool:
+        results = pool.imap_unordered(tasks(), prefetch=3)
+        next(results)
+        # Two running, three queued, one held by the feeder, and one done.
+        assert len(consumed) <= 2 + 3 + 1 + 1
+        assert len(list(results)) == 19
@@ -0,0 +1,63 @@
+import os
+
+import pytest
+
+from conftest import FIXTURES
+from textit.helpers import Result, map_file
+from textit.metadata import FileType, Metadata
+from textit.text_extractor import TextExtractor
+
+PDF = "Friedrich Nietzsche - The Use and Abuse of History.mobi"
+
+
+@pytest.mark.parametrize("name, file_type", [
+    ("hotnews_page.html", FileType.HTML),
+    (PDF, FileType.PDF),
+])
+def test_buffer_handlers_match_the_path_handlers(name, file_type):
+    path = os.path.join(FIXTURES, name)
+    extractor = TextExtractor()
+
+    from_path, _ = extractor.extract_raw(path, Metadata(file_type=file_type))
+    with map_file(path) as buffer:
+        from_buffer, _ = extractor.extract_raw(path, Metadata(file_type=file_type), buffer)
+
+    assert from_path.unwrap()
+    assert from_buffer.unwrap() == from_path.unwrap()
+
+
+def test_buffer_used_if_the_type_has_a_handler():
+    calls = []
+
+    def path_handler(path, metadata):
+        calls.append("path")
+        return Result.ok(["from the path"]), metadata
+
+    def buffer_handler(buffer, path, metadata):
+        calls.append(bytes(buffer))
+        return Result.ok(["from the buffer"]), metadata
+
+    extractor = TextExtractor()
+    extractor.register_handler(FileType.HTML, path_handler)
+    extractor.register_buffer_handler(FileType.HTML, buffer_handler)
+    extractor.register_handler(FileType.EPUB, path_handler)
+
+    assert extractor.extract_raw("a.html", buffer=b"<html>")[0].unwrap() == ["from the buffer"]
+    assert extractor.extract_raw("a.html")[0].unwrap() == ["from the path"]
+    # No buffer handler: the path it is.
+    assert extractor.extract_raw("a.epub", buffer=b"PK")[0].unwrap() == ["from the path"]
+    assert calls == [b"<html>", "path", "path"]
+
+
+def test_map_file(tmp_path):
+    path = tmp_path / "file.bin"
+    path.write_bytes(b"contents")
+    with map_file(str(path)) as buffer:
+        assert buffer[:] == b"contents"
+        # Copy-on-write: the file doesn't change.
+        buffer[0:1] = b"C"
+    assert path.read_bytes() == b"contents"
+
+    (tmp_path / "empty").write_bytes(b"")
+    with map_file(str(tmp_path / "empty")) as buffer:
+        assert buffer == b""
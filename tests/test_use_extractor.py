@@ -0,0 +1,220 @@
+"""End-to-end runs of use_extractor.py on small inputs."""
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import subprocess
+import sys
+import zipfile
+
+import pytest
+
+from conftest import FIXTURES, ROOT
+from textit.shards import iter_records
+
+sys.path.insert(0, ROOT)
+import use_extractor  # noqa: E402
+
+HTML = "hotnews_page.html"
+
+
+def extract(tmp_path, *args, input_dir="in", output_dir="out"):
+    """Runs the extractor from ``tmp_path``, on relative paths (the outputs
+    of absolute input paths would go next to the inputs)."""
+    command = [sys.executable, os.path.join(ROOT, "use_extractor.py"), input_dir, output_dir,
+               "--num_processes", "1", "--logdir", "logs", "--probe_processes", "0", *args]
+    process = subprocess.run(command, cwd=tmp_path, capture_output=True, text=True, timeout=300)
+    assert process.returncode == 0, process.stderr
+    return process
+
+
+def manifest_rows(output_dir, columns="path_hash, status, output"):
+    db = sqlite3.connect(os.path.join(output_dir, "manifest.sqlite"))
+    rows = db.execute(f"SELECT {columns} FROM tasks ORDER BY input").fetchall()
+    db.close()
+    return rows
+
+
+def inputs(tmp_path, *names):
+    os.makedirs(tmp_path / "in", exist_ok=True)
+    for name in names:
+        shutil.copy(os.path.join(FIXTURES, name), tmp_path / "in" / name)
+
+
+def shard_records(output_dir):
+    return [record for name in sorted(os.listdir(output_dir)) if name.endswith(".jsonl.gz")
+            for record in iter_records(os.path.join(output_dir, name))]
+
+
+def test_non_utf8_path(tmp_path):
+    name = os.fsdecode(b"caf\xe9.html")
+    os.makedirs(tmp_path / "in")
+    shutil.copy(os.path.join(FIXTURES, HTML), tmp_path / "in" / name)
+
+    extract(tmp_path, "--output_format", "jsonl.gz")
+
+    [record] = shard_records(str(tmp_path / "out"))
+    assert record["url"] == "in/caf\\xe9.html"
+    assert record["path_hash"] == hashlib.sha1(b"in/caf\xe9.html").hexdigest()
+    assert record["raw_content"]
+
+
+def test_record_path_hash():
+    args = use_extractor.argparse.Namespace(output_dir="out", prefix=None)
+    path_hash = hashlib.sha1(b"in/caf\xe9.html").hexdigest()
+
+    assert use_extractor.record_path_hash(args, {"url": "in/caf\\xe9.html",
+                                                 "path_hash": path_hash}) == path_hash
+    # Records without it, from UTF-8 paths.
+    assert use_extractor.record_path_hash(args, {"url": "in/café.html"}) == \
+        hashlib.sha1("in/café.html".encode()).hexdigest()
+
+
+def test_failed_task_has_no_output(tmp_path):
+    inputs(tmp_path, HTML)
+
+    extract(tmp_path, "--timeout", "0.001")
+
+    [(_, status, output)] = manifest_rows(str(tmp_path / "out"))
+    assert (status, output) == ("timeout", None)
+
+
+def test_duplicates(tmp_path):
+    inputs(tmp_path, HTML)
+    shutil.copy(tmp_path / "in" / HTML, tmp_path / "in" / "copy.html")
+
+    extract(tmp_path, "--digest_index", "digests.sqlite")
+
+    records = {}
+    for name in os.listdir(tmp_path / "out" / "in"):
+        with open(tmp_path / "out" / "in" / name, encoding="utf-8") as f:
+            records[name] = json.load(f)
+    [original] = [r for r in records.values() if "duplicate_of" not in r]
+    [duplicate] = [r for r in records.values() if "duplicate_of" in r]
+    assert original["raw_content"]
+    assert duplicate["drop_reason"] == "duplicate"
+    assert duplicate["digest"] == original["digest"]
+    assert records[duplicate["duplicate_of"]] is original
+    assert sorted(status for _, status, _ in manifest_rows(str(tmp_path / "out"))) == \
+        ["duplicate", "ok"]
+
+    # The next run references the original too.
+    shutil.copy(tmp_path / "in" / HTML, tmp_path / "in" / "another.html")
+    process = extract(tmp_path, "--digest_index", "digests.sqlite", "--copy_duplicates")
+    assert "duplicate: 1" in process.stdout
+    with open(tmp_path / "out" / "in" / (hashlib.sha1(b"in/another.html").hexdigest() + ".json"),
+              encoding="utf-8") as f:
+        copied = json.load(f)
+    assert copied["raw_content"] == original["raw_content"]
+    assert copied["url"] == "in/another.html"
+
+
+def test_resume_and_reprocess(tmp_path):
+    inputs(tmp_path, HTML)
+    extract(tmp_path, "--raw_cache", "raw.sqlite")
+    [(path_hash, status, output)] = manifest_rows(str(tmp_path / "out"))
+    assert status == "ok"
+    with open(tmp_path / output, encoding="utf-8") as f:
+        record = json.load(f)
+
+    # Done already.
+    assert "Run summary: no new tasks" in extract(tmp_path, "--raw_cache", "raw.sqlite").stdout
+
+    # Rerun from the raw cache, without the inputs.
+    shutil.rmtree(tmp_path / "in")
+    os.remove(tmp_path / output)
+    process = extract(tmp_path, "--raw_cache", "raw.sqlite", "--reprocess")
+
+    assert "ok: 1" in process.stdout
+    assert manifest_rows(str(tmp_path / "out")) == [(path_hash, "ok", output)]
+    with open(tmp_path / output, encoding="utf-8") as f:
+        assert json.load(f)["raw_content"] == record["raw_content"]
+
+
+def test_tasks_are_streamed(monkeypatch):
+    listed = []
+
+    def files(path):
+        for i in range(100):
+            listed.append(i)
+            yield f"{path}/{i}.html", i
+
+    monkeypatch.setattr(use_extractor, "iter_files", files)
+    monkeypatch.setattr(use_extractor, "logger", use_extractor.getLogger(), raising=False)
+    args = use_extractor.argparse.Namespace(input_dir="in", output_dir="out", prefix=None,
+                                            shard=None)
+    counts = use_extractor.Counter()
+    done = {use_extractor.get_path_hash("in/1.html")}
+
+    tasks = use_extractor.enumerate_tasks(args, done, counts)
+    first = os.path.join("out", "in", use_extractor.get_path_hash("in/0.html") + ".json")
+    assert next(tasks) == (0, ("in/0.html", first))
+    assert listed == [0] and not counts["finished"]
+    # The finished one is skipped.
+    assert next(tasks)[0] == 2
+    assert list(tasks)[-1][0] == 99
+    assert counts == {"found": 100, "queued": 99, "finished": 1}
+
+
+def test_instrument(tmp_path):
+    inputs(tmp_path, HTML)
+
+    process = extract(tmp_path, "--metrics_file", "textit.prom")
+
+    assert "HTML: 1 documents" in process.stdout
+    [(_, _, output)] = manifest_rows(str(tmp_path / "out"))
+    with open(tmp_path / output, encoding="utf-8") as f:
+        assert "handler.HTML" in json.load(f)["timings"]
+    with open(tmp_path / "textit.prom") as f:
+        assert 'textit_tasks_total{status="ok"} 1' in f.read().splitlines()
+
+
+def test_profile_slow(tmp_path):
+    inputs(tmp_path, HTML)
+
+    extract(tmp_path, "--profile_slow", "0")
+
+    [(path_hash, _, _)] = manifest_rows(str(tmp_path / "out"))
+    profiles = os.listdir(tmp_path / "logs" / "profiles")
+    assert sorted(os.path.splitext(name)[1] for name in profiles) == \
+        [".collapsed", ".json", ".pstats"]
+    assert all(name.startswith(path_hash) for name in profiles)
+
+
+def test_preview(tmp_path):
+    pdf = "Friedrich Nietzsche - The Use and Abuse of History.mobi"
+    inputs(tmp_path, HTML, pdf)
+
+    process = extract(tmp_path, "--preview", "--preview_pages", "4")
+
+    assert "Preview: 2 documents" in process.stdout
+    with open(tmp_path / "out" / "preview.json") as f:
+        report = json.load(f)
+    assert report["statuses"] == {"ok": 2}
+    assert report["by_type"]["PDF"]["documents"] == 1
+    assert report["sampled_mb"] < report["mb"]
+    records = {}
+    for _, _, output in manifest_rows(str(tmp_path / "out")):
+        with open(tmp_path / output, encoding="utf-8") as f:
+            record = json.load(f)
+        records[record["file_type"]] = record
+    assert records["PDF"]["preview_fraction"] == pytest.approx(4 / 54)
+    # The first --preview_kb of the page.
+    assert 0 < records["HTML"]["preview_fraction"] < 1
+
+
+def test_archive_members(tmp_path):
+    os.makedirs(tmp_path / "in")
+    with zipfile.ZipFile(tmp_path / "in" / "pages.zip", "w") as zf:
+        zf.write(os.path.join(FIXTURES, HTML), "news/" + HTML)
+        zf.writestr("empty/", b"")
+
+    extract(tmp_path, "--output_format", "jsonl.gz")
+
+    [record] = shard_records(str(tmp_path / "out"))
+    url = "in/pages.zip!/news/" + HTML
+    assert record["url"] == url
+    assert record["path_hash"] == hashlib.sha1(url.encode()).hexdigest()
+    assert record["raw_content"]
+    assert [status for _, status, _ in manifest_rows(str(tmp_path / "out"))] == ["ok"]
@@ -0,0 +1,218 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from textit.prefetch import Prefetcher
+from textit.work_queue import PLAN, WorkQueue, in_shard, parse_shard
+
+FILES = [(f"corpus/{i}.pdf", 1000 * i) for i in range(5)]
+
+
+@pytest.fixture
+def queues(tmp_path):
+    opened = []
+
+    def open_queue(node, lease_seconds=600):
+        queue = WorkQueue(str(tmp_path), node, lease_seconds=lease_seconds, poll_seconds=0.05)
+        opened.append(queue)
+        return queue
+
+    yield open_queue
+    for queue in opened:
+        queue.close()
+
+
+def expire(queue, name):
+    lease = queue._file("leases", name)
+    past = time.time() - 3600
+    os.utime(lease, (past, past))
+
+
+def owner(queue, name):
+    with open(queue._file("leases", name)) as f:
+        return json.loads(f.read())["node"]
+
+
+def test_parse_shard():
+    assert parse_shard("3/8") == (3, 8)
+    for bad in ("3", "8/8", "-1/8"):
+        with pytest.raises(ValueError):
+            parse_shard(bad)
+
+
+def test_in_shard():
+    hashes = [f"{i:040x}" for i in range(100)]
+    shards = [[h for h in hashes if in_shard(h, (i, 4))] for i in range(4)]
+
+    assert sorted(sum(shards, [])) == hashes
+    assert all(len(shard) == 25 for shard in shards)
+
+
+def test_plan_and_claim(queues):
+    queue = queues("a")
+    assert queue.plan(FILES, 2)
+    # Planned once.
+    assert not queues("b").plan(FILES, 2)
+
+    batches = []
+    while (batch := queue.claim()) is not None:
+        batches.append(batch)
+        queue._mark_done(batch)
+
+    assert batches == [0, 1, 2]
+    assert [entry for batch in batches for entry in queue.read_batch(batch)] == FILES
+    assert os.listdir(queue._file("leases", "")) == []
+
+
+def test_leased_batches_are_skipped(queues):
+    a, b = queues("a"), queues("b")
+    a.plan(FILES, 2)
+
+    assert a.claim() == 0
+    assert b.claim() == 1
+    assert owner(a, 0) == "a" and owner(b, 1) == "b"
+
+
+def test_own_batches_not_waited_for(queues):
+    queue = queues("a")
+    queue.plan(FILES, 2)
+
+    assert [queue.claim() for _ in range(3)] == [0, 1, 2]
+    # Still being worked on, by this node.
+    claimed = []
+    thread = threading.Thread(target=lambda: claimed.append(queue.claim()), daemon=True)
+    thread.start()
+    thread.join(timeout=5)
+    assert claimed == [None]
+
+
+def test_expired_lease_taken_over(queues):
+    a, b = queues("a"), queues("b", lease_seconds=1)
+    a.plan(FILES, 2)
+    assert a.claim() == 0
+    # Node a dies: its lease isn't renewed any more.
+    a.close()
+    expire(a, 0)
+
+    assert b.claim() == 0
+    assert owner(b, 0) == "b"
+    assert os.listdir(b._file("leases", "")) == ["0"]
+
+
+def test_one_node_takes_over(queues):
+    a, b, c = queues("a"), queues("b", lease_seconds=0.5), queues("c", lease_seconds=0.5)
+    a.plan(FILES[:2], 2)
+    assert a.claim() == 0
+    a.close()
+    lease = a._file("leases", 0)
+    past = time.time() - 0.6
+    os.utime(lease, (past, past))
+    # c saw it expire too, and is taking it over.
+    open(c._takeover_marker(lease, os.stat(lease), 0.1), "w").close()
+
+    assert not b._take_over(0)
+    assert owner(a, 0) == "a"
+
+    # c died while at it, the lease is up for grabs again a lease later.
+    time.sleep(0.5)
+    assert b._take_over(0)
+    assert owner(b, 0) == "b"
+    assert os.listdir(b._file("leases", "")) == ["0"]
+    # Now it's fresh.
+    assert not c._take_over(0)
+
+
+def test_release_checks_the_owner(queues):
+    a = queues("a")
+    a.plan(FILES, 2)
+    assert a.claim() == 0
+    # Taken over by b meanwhile.
+    with open(a._file("leases", 0), "w") as f:
+        f.write(json.dumps({"node": "b"}))
+
+    a._release(0)
+
+    assert owner(a, 0) == "b"
+    assert 0 not in a._leases
+
+
+def test_lost_lease_noticed(queues):
+    a = queues("a", lease_seconds=0.2)
+    a.plan(FILES, 2)
+    assert a.claim() == 0
+    # Taken over by a node that thought a was dead.
+    with open(a._file("leases", 0), "w") as f:
+        f.write(json.dumps({"node": "b"}))
+
+    deadline = time.time() + 5
+    while 0 in a._leases and time.time() < deadline:
+        time.sleep(0.05)
+    assert 0 not in a._leases
+    assert owner(a, 0) == "b"
+
+
+def test_dead_planner_replaced(queues):
+    a, b = queues("a"), queues("b", lease_seconds=1)
+    # a took the plan lease and died before writing the plan.
+    assert a._try_lease(PLAN)
+    a.close()
+    assert not b.plan(FILES, 2)
+    expire(a, PLAN)
+
+    assert b.plan(FILES, 2)
+    assert b._planned() == 3
+
+
+def test_batch_completion(queues):
+    queue = queues("a")
+    queue.plan(FILES, 2)
+    batch = queue.claim()
+    for path, _ in queue.read_batch(batch):
+        queue.add_task(batch, path)
+    queue.batch_enumerated(batch)
+
+    assert queue.task_done("corpus/0.pdf") is None
+    assert queue.task_done("corpus/1.pdf") == batch
+    queue.complete(batch)
+
+    assert queue._is_done(batch)
+    assert not os.path.exists(queue._file("leases", batch))
+    assert queue.completed == 1
+
+
+def test_prefetched_batches(queues, tmp_path):
+    # The prefetcher reads ahead of the batches; claiming the next one must
+    # not wait for those of this node that are still being read.
+    files = []
+    for i in range(8):
+        path = tmp_path / f"{i}.txt"
+        path.write_bytes(b"x" * i)
+        files.append((str(path), i))
+    queue = queues("a")
+    queue.plan(files, 3)
+
+    def tasks():
+        while (batch := queue.claim()) is not None:
+            for path, _ in queue.read_batch(batch):
+                queue.add_task(batch, path)
+                yield path, None, None
+            queue.batch_enumerated(batch)
+
+    done = []
+
+    def run():
+        for path, _, _, prefetched in Prefetcher(threads=2, depth=8).run(tasks()):
+            done.append((path, prefetched.data))
+            if (batch := queue.task_done(path)) is not None:
+                queue.complete(batch)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    thread.join(timeout=20)
+
+    assert not thread.is_alive()
+    assert done == [(path, b"x" * size) for path, size in files]
+    assert queue.completed == 3
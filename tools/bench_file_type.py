@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+"""Compares in-process file type sniffing with `file -b`, for speed and agreement."""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from textit.helpers import get_all_files
+from textit.sniff import get_file_type, file_type_from_libmagic
+
+
+def timed(func, files):
+    start = time.perf_counter()
+    results = [func(path) for path in files]
+    return results, time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark file type detection")
+    parser.add_argument("input_dir", help="Directory with sample files")
+    parser.add_argument("--limit", type=int, default=None, help="Use at most this many files")
+
+    args = parser.parse_args()
+    files = get_all_files(args.input_dir)[:args.limit]
+    if not files:
+        sys.exit(f"No files in '{args.input_dir}'")
+
+    # Warm up the page cache, so that both sides read from memory.
+    for path in files:
+        with open(path, "rb") as f:
+            f.read(1 << 16)
+
+    sniffed, sniff_time = timed(get_file_type, files)
+    magic, magic_time = timed(file_type_from_libmagic, files)
+
+    n = len(files)
+    print(f"files:      {n}")
+    print(f"sniff:      {sniff_time:.3f}s ({n / sniff_time:.1f} files/s)")
+    print(f"file -b:    {magic_time:.3f}s ({n / magic_time:.1f} files/s)")
+    print(f"speedup:    {magic_time / sniff_time:.1f}x")
+
+    disagreements = [(path, s, m) for path, s, m in zip(files, sniffed, magic) if s != m]
+    print(f"disagree:   {len(disagreements)}")
+    for path, s, m in disagreements:
+        print(f"\t{path}: sniff={s}, file={m}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+#!/usr/bin/env python3
+"""Fits the task cost model to the actual durations recorded in run manifests."""
+import argparse
+import os
+import sys
+
+import numpy as np
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from textit.manifest import RunManifest
+from textit.scheduler import CostModel, features_from_json
+
+
+def mean_abs_error(model, samples):
+    return float(np.mean([abs(model.predict(f) - d) for f, d in samples]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Calibrate the task cost model")
+    parser.add_argument("manifests", nargs="+", help="Run manifests (manifest.sqlite)")
+    parser.add_argument("--model", type=str, default=None,
+                        help="Model to start from (default: the built-in coefficients)")
+    parser.add_argument("--out", required=True, help="Where to write the calibrated model")
+    parser.add_argument("--min_samples", type=int, default=20,
+                        help="Least samples needed to refit a file type (default: %(default)s)")
+
+    args = parser.parse_args()
+    samples = []
+    predicted = []
+    for path in args.manifests:
+        manifest = RunManifest(path)
+        for features, predicted_cost, duration in manifest.cost_samples():
+            samples.append((features_from_json(features), duration))
+            predicted.append(predicted_cost)
+        manifest.close()
+
+    if not samples:
+        sys.exit("No finished tasks with cost features in the manifests")
+
+    actual = np.array([d for _, d in samples])
+    print(f"samples:               {len(samples)}")
+    print(f"as run (predicted):    mean abs error {np.mean(np.abs(np.array(predicted) - actual)):.3f}s")
+
+    model = CostModel.load(args.model) if args.model else CostModel()
+    model.fit(samples, args.min_samples)
+    print(f"calibrated:            mean abs error {mean_abs_error(model, samples):.3f}s")
+    for file_type, coefficients in model.coefficients.items():
+        print(f"\t{file_type}: " + ", ".join(f"{c:.4g}" for c in coefficients))
+
+    model.save(args.out)
+
+
+if __name__ == "__main__":
+    main()
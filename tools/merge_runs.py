@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+"""Merges the manifests and summaries of the nodes of a multi-node run."""
+import argparse
+import glob
+import json
+import os
+import sys
+from collections import Counter
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from textit.manifest import RunManifest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge the manifests and summaries of the nodes of a run")
+    parser.add_argument("output_dir", help="Output directory of the run, with the manifest-<node>.sqlite "
+                                           "and summary-<node>.json files of the nodes")
+    parser.add_argument("--out", type=str, default=None,
+                        help="Merged manifest (default: manifest.sqlite in the output directory, "
+                             "used by later single-node runs to resume)")
+
+    args = parser.parse_args()
+    manifests = sorted(glob.glob(os.path.join(glob.escape(args.output_dir), "manifest-*.sqlite")))
+    summaries = sorted(glob.glob(os.path.join(glob.escape(args.output_dir), "summary-*.json")))
+    if not manifests:
+        sys.exit(f"No node manifests in '{args.output_dir}'")
+
+    merged = RunManifest(args.out or os.path.join(args.output_dir, "manifest.sqlite"))
+    for path in manifests:
+        print(f"{os.path.basename(path)}: {merged.merge(path)} tasks merged")
+
+    statuses = Counter()
+    started, finished = [], []
+    for path in summaries:
+        with open(path) as f:
+            summary = json.load(f)
+        statuses.update(summary["statuses"])
+        started.append(summary["started"])
+        finished.append(summary["finished"])
+        elapsed = summary["finished"] - summary["started"]
+        counts = ", ".join(f"{s}: {n}" for s, n in sorted(summary["statuses"].items())) or "no tasks"
+        batches = f", {summary['batches']} batches" if summary.get("batches") is not None else ""
+        print(f"Node {summary['node']} ({summary['host']}): {counts}{batches}, {elapsed:.0f}s")
+
+    if summaries:
+        counts = ", ".join(f"{s}: {n}" for s, n in sorted(statuses.items()))
+        print(f"All nodes: {counts}, {max(finished) - min(started):.0f}s from the first start "
+              f"to the last finish")
+    # Tasks run by several nodes (after a lease expired) count once here.
+    counts = ", ".join(f"{s}: {n}" for s, n in sorted(merged.status_counts().items()))
+    print(f"Merged manifest: {counts}")
+    merged.close()
+
+
+if __name__ == "__main__":
+    main()
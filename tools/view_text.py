@@ -1,25 +1,170 @@
 #!/usr/bin/env python3
 import json
+import os
 import sys
 import argparse
+import itertools
+import sqlite3
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', 'src')))
+from textit.shards import compression_of, iter_members
+from textit.record_index import (DIRECTORY_INDEX, RecordLookup, index_entry, find_indexes,
+                                 read_index, read_record, build_index, stale_records)
+from textit.records import CONTENT_KEY
+
+
+def parse_value(value):
+    try:
+        return json.loads(value)
+    except json.JSONDecodeError:
+        return value
+
+
+def parse_where(conditions):
+    """KEY=VALUE pairs; VALUE is JSON if it parses as such (null matches a missing key)."""
+    parsed = []
+    for condition in conditions:
+        key, sep, value = condition.partition("=")
+        if not sep:
+            sys.exit(f"Malformed condition '{condition}', expected KEY=VALUE")
+        parsed.append((key, parse_value(value)))
+
+    return parsed
+
+
+def parse_lines(lines):
+    start, sep, end = lines.partition(":")
+    if not sep:
+        sys.exit(f"Malformed line range '{lines}', expected START:END")
+    return slice(int(start) if start else None, int(end) if end else None)
+
+
+def scan_shard(path):
+    """Entries of a shard without an index, read from the shard itself."""
+    for offset, length, data in iter_members(path):
+        record = json.loads(data.decode("utf-8", "surrogateescape"))
+        entry = index_entry(record, path, offset, length)
+        entry["record"] = record
+        yield entry
+
+
+def json_entry(path):
+    with open(path, "r", encoding="utf-8", errors="surrogateescape") as fin:
+        js = json.load(fin)
+    entry = index_entry(js, path, 0, os.path.getsize(path),
+                        os.path.splitext(os.path.basename(path))[0])
+    entry["record"] = js
+    return entry
+
+
+def directory_entries(src, args):
+    """Entries of the records of an output directory: looked up by key if
+    possible, with the per-file JSON records written after records.idx read
+    directly."""
+    stale = {os.path.abspath(path) for path in stale_records(src)}
+    if stale and os.path.exists(os.path.join(src, DIRECTORY_INDEX)):
+        print(f"{len(stale)} records were written after {DIRECTORY_INDEX}, reading them directly "
+              f"(update it with --build_index)", file=sys.stderr)
+
+    indexes = find_indexes(src)
+    if not indexes and not stale:
+        sys.exit(f"No indexes in '{src}' (use --build_index for per-file JSON outputs)")
+
+    entries = None
+    if indexes and (args.path_hash, args.digest, args.url) != (None, None, None):
+        try:
+            lookup = RecordLookup(src)
+            entries = list(lookup.find(args.path_hash, args.digest, args.url))
+            lookup.close()
+        except sqlite3.Error as e:
+            print(f"Can't use the lookup database of '{src}' ({e}), reading the indexes",
+                  file=sys.stderr)
+    if entries is None:
+        entries = itertools.chain.from_iterable(read_index(index) for index in indexes)
+
+    for entry in entries:
+        if entry["file"] not in stale:
+            yield entry
+    for path in sorted(stale):
+        try:
+            entry = json_entry(path)
+        except (OSError, json.JSONDecodeError):
+            continue
+        # Not a record (e.g. a node summary).
+        if CONTENT_KEY in entry["record"]:
+            yield entry
+
+
+def get_entries(src, args):
+    if os.path.isdir(src):
+        return directory_entries(src, args)
+
+    if compression_of(src) is not None:
+        indexes = find_indexes(src)
+        return read_index(indexes[0]) if indexes else scan_shard(src)
+
+    return [json_entry(src)]
+
+
+def matches(entry, args, where):
+    metadata = entry["metadata"]
+    if args.url is not None and metadata.get("url") != args.url:
+        return False
+    if args.digest is not None and metadata.get("digest") not in (args.digest, "sha1:" + args.digest):
+        return False
+    if args.path_hash is not None and entry.get("path_hash") != args.path_hash:
+        return False
+
+    return all(metadata.get(key) == value for key, value in where)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Get quality statistics")
-    parser.add_argument("src", help="File to read")
+    parser.add_argument("src", help="File to read: a JSON record, a .jsonl.gz/.jsonl.zst shard "
+                                    "or an output directory (through its indexes)")
     parser.add_argument("--out", help="Path where to write human-readable text (if absent, will write to stdout).")
+    parser.add_argument("--url", help="Only records with this URL")
+    parser.add_argument("--digest", help="Only records with this digest")
+    parser.add_argument("--path_hash", help="Only the record of the input with this path hash")
+    parser.add_argument("--where", action="append", default=[], metavar="KEY=VALUE",
+                        help="Only records with this metadata value, e.g. drop_reason=duplicate, "
+                             "ocr=true or drop_reason=null (can be repeated)")
+    parser.add_argument("--lines", help="Only print these lines (START:END, as a Python slice)")
+    parser.add_argument("--list", action="store_true",
+                        help="List the matching records instead of printing their text")
+    parser.add_argument("--build_index", action="store_true",
+                        help="Index the per-file JSON records of the src directory and exit")
 
     args = parser.parse_args()
-    with open(args.src, "r") as fin:
-        js = json.load(fin)
+    if args.build_index:
+        if not os.path.isdir(args.src):
+            sys.exit("--build_index needs an output directory")
+        print(f"Indexed {build_index(args.src)} records")
+        return
+
+    where = parse_where(args.where)
+    lines = parse_lines(args.lines) if args.lines else None
+    entries = (e for e in get_entries(args.src, args) if matches(e, args, where))
 
-    assert "raw_content" in js, "Malformed json, missing 'raw_content'!"
+    fout = open(args.out, "w") if args.out else sys.stdout
+    try:
+        for entry in entries:
+            if args.list:
+                metadata = entry["metadata"]
+                fout.write(f"{entry.get('path_hash')}\t{metadata.get('digest')}\t"
+                           f"{metadata.get('url')}\t{entry['file']}:{entry['offset']}\n")
+                continue
 
-    if args.out:
-        with open(args.out, "w") as fout:
-            fout.write(js["raw_content"])
-    else:
-        print(js["raw_content"])
+            js = entry["record"] if "record" in entry else read_record(entry)
+            assert "raw_content" in js, "Malformed json, missing 'raw_content'!"
+            text = js["raw_content"]
+            if lines is not None:
+                text = "\n".join(text.split("\n")[lines])
+            fout.write(text)
+            fout.write("\n")
+    finally:
+        if args.out:
+            fout.close()
 
 
 if __name__ == "__main__":
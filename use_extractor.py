@@ -1,104 +1,444 @@
-from re import L
 import sys
 import os
 import argparse
 import json
-import gzip
 from tqdm import tqdm
-from typing import Dict, Any
+from typing import Dict, Any, Optional
 import multiprocessing as mp
 import hashlib
-import traceback
 import tempfile
 import shutil
-import bisect
+import time
+from collections import Counter
+import ctypes
+import functools
+import socket
+from contextlib import contextmanager
 
 
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), 'src')))
 from textit.text_extractor import TextExtractor, Metadata, FileType, DocumentClass
 from textit.processors import text_repair, quality_filter, language_identification
-from textit.helpers import handle_result, setup_logging, format_exception
-from textit.helpers import getLogger, get_path_hash, get_all_files
+from textit.processors import BoilerplateFilter, CountMinSketch
+from textit.processors import NearDuplicateFilter, LSHIndex, Segmenter, LanguageMix
+from textit.helpers import Result, setup_logging, format_exception
+from textit.helpers import getLogger, get_path_hash, get_all_files, map_file
+from textit.helpers import iter_files, windowed_sort
+from textit.digest_index import DigestIndex
+from textit.raw_cache import RawCache, CachedTask
+from textit.page_checkpoints import PageCheckpoints
+from textit.manifest import RunManifest, TaskRecord
+from textit.scheduler import CostModel, schedule, features_to_json, predict_memory
+from textit.shards import ShardWriter, recover_shards, shard_runs, run_entries, zstandard
+from textit.records import iter_record_json
+from textit import instrumentation
+from textit.instrumentation import RunStats
+from textit.profiling import SlowDocumentProfiler, rename_profile
+from textit.preview import PreviewReport, document_sample
+from textit.supervisor import Supervisor, defer
+from textit.events import report
+from textit.prefetch import Prefetcher
+from textit.work_queue import WorkQueue, parse_shard, in_shard
+from textit.archives import ArchiveReader, iter_inputs, sort_size, split_member
+from textit.sniff import get_file_type
 import textit.version
 
-import subprocess
 
+# Per-worker extractor and document processors, shared state set up by main().
+extractor = None
+boilerplate_filter = None
+near_duplicate_filter = None
+digest_index = None
+copy_duplicates = False
+raw_cache = None
+page_checkpoints = None
+shard_writer = None
+profiler = None
+# Only a sample of every document is extracted, see textit.preview.
+preview_mode = False
+# Directory of the run for the UTF-8 aliases of non-UTF-8 paths.
+scratch_dir = None
+archive_reader = None
 
-# For sha1 calculation
-CHUNK_SIZE = 2 ** 16
+SHARD_COMPRESSION = {"jsonl.gz": "gzip", "jsonl.zst": "zstd"}
 
+# The main process has threads (task probing, tqdm) and pdfium loaded, which
+# don't survive a fork well. The fork server imports this module once, so
+# replacement workers start quickly.
+MP_CONTEXT = "forkserver"
 
-def init_proc(args):
+
+def init_proc(args, sketch_array=None):
     setup_logging(args.logdir, stderr=args.logstderr, level=args.loglevel)
+    global logger
+    logger = getLogger()
+    if args.instrument:
+        instrumentation.enable()
+    if args.profile_slow is not None:
+        global profiler
+        profiler = SlowDocumentProfiler(args.profile_slow, args.profile_dir,
+                                        mode=args.profile_mode)
+    if args.raw_cache:
+        global raw_cache
+        raw_cache = RawCache(args.raw_cache)
+    if args.page_checkpoints:
+        global page_checkpoints
+        page_checkpoints = PageCheckpoints(args.page_checkpoints)
+    if args.output_format in SHARD_COMPRESSION:
+        global shard_writer
+        shard_writer = ShardWriter(args.output_dir, args.run,
+                                   compression=SHARD_COMPRESSION[args.output_format],
+                                   max_bytes=args.shard_size * 2 ** 20,
+                                   max_records=args.shard_records)
+        # Run when the pool shuts the worker down (not when it's terminated).
+        mp.util.Finalize(shard_writer, shard_writer.close, exitpriority=10)
+    if args.digest_index:
+        global digest_index, copy_duplicates
+        digest_index = DigestIndex(args.digest_index, args.output_dir)
+        copy_duplicates = args.copy_duplicates
+    if args.near_dedup:
+        global near_duplicate_filter
+        near_duplicate_filter = NearDuplicateFilter(LSHIndex(args.near_dedup),
+                                                    threshold=args.near_dedup_threshold,
+                                                    drop=args.near_dedup_drop)
+    if sketch_array is not None:
+        global boilerplate_filter
+        sketch = CountMinSketch(args.boilerplate_width, args.boilerplate_depth,
+                                sketch_array.get_obj())
+        boilerplate_filter = BoilerplateFilter(sketch,
+                                               max_docs=args.boilerplate_max_docs,
+                                               window=args.boilerplate_window,
+                                               lock=sketch_array.get_lock())
 
+    global extractor, scratch_dir, preview_mode, archive_reader
+    extractor = build_extractor(args)
+    preview_mode = args.preview
+    archive_reader = ArchiveReader()
+    scratch_dir = args.scratch_dir
+    # Temporary files of the handlers (decrypted and OCR-ed PDFs, ...) too,
+    # so that those of killed workers are removed with it.
+    tempfile.tempdir = scratch_dir
+
+
+def build_extractor(args) -> TextExtractor:
+    extractor = TextExtractor()
+    if args.unit_size > 0:
+        extractor.set_segmenter(Segmenter(args.unit_size))
+        # The segmenter cuts the book up, keeping its paragraphs.
+        extractor.set_handler_options(
+            FileType.MOBI, version=f"{extractor.get_handler_version(FileType.MOBI)}-whole",
+            chunk_words=None)
+    if page_checkpoints is not None:
+        extractor.set_handler_options(FileType.PDF, checkpoints=page_checkpoints)
+    if args.preview:
+        limits = {FileType.PDF: {"max_pages": args.preview_pages},
+                  FileType.EPUB: {"max_chapters": args.preview_chapters},
+                  FileType.MOBI: {"max_chapters": args.preview_chapters},
+                  FileType.HTML: {"max_bytes": args.preview_kb * 1024},
+                  FileType.RTF: {"max_bytes": args.preview_kb * 1024}}
+        for file_type, options in limits.items():
+            extractor.set_handler_options(
+                file_type, version=f"{extractor.get_handler_version(file_type)}-preview", **options)
+        # Before anything drops text.
+        extractor.add_document_processor(LanguageMix())
+    # Near-duplicates go first, so that dropped ones don't count as
+    # boilerplate.
+    if near_duplicate_filter is not None:
+        extractor.add_document_processor(near_duplicate_filter)
+    if boilerplate_filter is not None:
+        extractor.add_document_processor(boilerplate_filter)
+    extractor.add_processor(text_repair)
+    extractor.add_processor(quality_filter)
+    extractor.add_processor(language_identification)
+    return extractor
 
-def get_file_type(file_path):
-    try:
-        result = subprocess.run(['file', '-b', file_path], capture_output=True, text=True, check=True)
-        file_info = result.stdout.strip().upper()
-        if "HTML" in file_info:
-            return FileType.HTML
-        if "EPUB" in file_info:
-            return FileType.EPUB
-        if "MOBIPOCKET" in file_info:
-            return FileType.MOBI
-        elif "PDF" in file_info:
-            return FileType.PDF
-        elif "MICROSOFT WORD" in file_info or "MICROSOFT OFFICE WORD" in file_info:
-            return FileType.DOC
-        else:
-            return None
-    except subprocess.CalledProcessError as e:
-        estr = "".join(traceback.format_exception(e))
-        logger.error(f"Couldn't get file type for '{file_path}':\n```\n{e}```\n\n")
-        return None
-    # XXX Dubious
-    # except FileNotFoundError:
-        # logger.error("Error: 'file' command not found")
-        # return None
+
+def create_sketch_array(args):
+    """Count-min sketch counters shared by all the workers of the run."""
+    size = CountMinSketch.buffer_size(args.boilerplate_width, args.boilerplate_depth)
+    sketch_array = mp.get_context(MP_CONTEXT).Array(ctypes.c_uint32, size)
+    if args.boilerplate_sketch and os.path.exists(args.boilerplate_sketch):
+        sketch = CountMinSketch.load(args.boilerplate_sketch)
+        if (sketch.width, sketch.depth) != (args.boilerplate_width, args.boilerplate_depth):
+            raise ValueError(f"Sketch '{args.boilerplate_sketch}' has shape "
+                             f"{sketch.depth}x{sketch.width}, expected "
+                             f"{args.boilerplate_depth}x{args.boilerplate_width}")
+        CountMinSketch(sketch.width, sketch.depth, sketch_array.get_obj()).merge(sketch)
+
+    return sketch_array
 
 
 def json_default_serializer(obj):
     return obj.name
 
 
-def compute_sha1(file_path):
-    sha1 = hashlib.sha1()
-    with open(file_path, 'rb') as file:
-        while chunk := file.read(CHUNK_SIZE):
-            sha1.update(chunk)
+def write_record(result: Dict[str, Any], output_path: str, lines=None) -> str:
+    """Returns where the record was written: ``output_path`` or a shard.
 
-    return sha1.hexdigest()
+    If given, ``lines`` are streamed as the "raw_content" of the record,
+    without joining them in memory.
 
+    """
+    if shard_writer is not None:
+        # What the name of the per-file output says, which can't be worked
+        # out from the url of a non-UTF-8 path.
+        path_hash = get_basename_noext(output_path)
+        result["path_hash"] = path_hash
+        return shard_writer.write(result, default=json_default_serializer, lines=lines,
+                                  path_hash=path_hash)
+
+    os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    output_file_tmp = output_path + ".tmp"
+    with open(output_file_tmp, "w", encoding="utf-8", errors="surrogateescape") as f:
+        if lines is None:
+            json.dump(result, f, ensure_ascii=False, indent=2, default=json_default_serializer)
+        else:
+            for chunk in iter_record_json(result, lines, indent=2, default=json_default_serializer):
+                f.write(chunk)
+
+    os.rename(output_file_tmp, output_path)
+    return output_path
+
+
+def finish_task(record: TaskRecord, output: tuple[Dict[str, Any], Any]) -> TaskRecord:
+    """Writes the (result, lines) record of a task, then marks its digest as
+    extracted. Runs on the writer thread of the worker, if it has one."""
+    result, lines = output
+    version = textit.version.__version__
+    start = time.perf_counter()
+    try:
+        record.output_path = write_record(result, record.output_path, lines)
+    except Exception as e:
+        estr = format_exception(e)
+        logger.error(f"Exception raised when writing the record of '{record.input_path}':{estr}")
+        if digest_index is not None and record.status == "ok":
+            digest_index.release(record.digest, version, record.output_path)
+        record.status = "error"
+        return record
+    finally:
+        # Not instrumentation.timer(), the worker is already on another document.
+        if record.stats is not None:
+            timings = record.stats["timings"]
+            timings["write"] = timings.get("write", 0.0) + time.perf_counter() - start
+
+    if digest_index is not None and record.status == "ok":
+        digest_index.complete(record.digest, version)
+    if page_checkpoints is not None and record.digest is not None:
+        page_checkpoints.remove(record.digest)
+    return record
+
+
+def duplicate_record(url, digest: str, original: tuple[str, str], output_path: str):
+    """Output for a file whose contents were already extracted, as the
+    (result, lines) to write."""
+    original_path, status = original
+    if shard_writer is not None:
+        # The per-file output of the original is never written; its record
+        # is found in the shards by path hash (view_text.py --path_hash).
+        duplicate_of = get_basename_noext(original_path)
+    else:
+        duplicate_of = os.path.relpath(original_path, os.path.dirname(output_path))
+    result = None
+    if copy_duplicates and status == DigestIndex.DONE:
+        try:
+            with open(original_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+                result = json.load(f)
+            result["url"] = url
+        except FileNotFoundError:
+            # Being written again (e.g. the original output was removed).
+            logger.debug(f"Original output '{original_path}' is missing, writing a reference")
+
+    if result is None:
+        metadata = Metadata(document_class=DocumentClass.CRAWLED, digest=digest,
+                            version=textit.version.__version__, drop_reason="duplicate",
+                            duplicate_of=duplicate_of)
+        result = {k: v for k, v in metadata.__dict__.items() if v is not None}
+        result["url"] = url
+        return result, []
+
+    return result, None
+
+
+def process_file(input_path: str, output_path: str, prefetched=None) -> tuple[str, str, tuple]:
+    """Returns the status of the file ("ok" or "duplicate"), its digest and
+    its record, as the (result, lines) to write.
+
+    ``prefetched`` has the digest and file type of the file (and the contents
+    of a small one), if the I/O front end already read it, or is a CachedTask
+    when reprocessing.
+
+    """
+    if isinstance(prefetched, CachedTask):
+        return reprocess_file(input_path, output_path, prefetched.digest)
+    if prefetched is not None and prefetched.data is not None:
+        return process_buffer(input_path, output_path, prefetched.data, prefetched)
+
+    member = split_member(input_path)
+    if member is not None:
+        with instrumentation.timer("archive"):
+            buffer = archive_reader.read(*member)
+        return process_buffer(input_path, output_path, buffer)
+
+    # The file is read only once: hashing, sniffing and (for the handlers that
+    # support it) extraction all use the same mapping.
+    with map_file(input_path) as buffer:
+        if prefetched is not None and not prefetched.matches(os.stat(input_path)):
+            logger.debug(f"'{input_path}' changed since it was prefetched")
+            prefetched = None
+        return process_buffer(input_path, output_path, buffer, prefetched)
+
+
+def reprocess_file(input_path: str, output_path: str, digest: str) -> tuple[str, str, tuple]:
+    """Reruns the processors on the raw cache entry of a file, without
+    reading the file (unless the entry is missing or stale)."""
+    with instrumentation.timer("raw_cache"):
+        cached = raw_cache.version(digest)
+    if cached is None or cached[1] != extractor.get_handler_version(cached[0]):
+        logger.info(f"No usable raw cache entry for '{input_path}', extracting it again")
+        return process_file(input_path, output_path)
+
+    report("digest", digest)
+    url = os.fsencode(input_path).decode("utf-8", "backslashreplace")
+    return "ok", digest, extract_file(input_path, output_path, url, digest.split(":", 1)[1], None)
+
+
+def process_buffer(input_path: str, output_path: str, buffer,
+                   prefetched=None) -> tuple[str, str, tuple]:
+    instrumentation.count("bytes", len(buffer))
+    if prefetched is not None:
+        file_digest = prefetched.digest.split(":", 1)[1]
+    else:
+        with instrumentation.timer("sha1"):
+            file_digest = hashlib.sha1(buffer).hexdigest()
+    digest = "sha1:" + file_digest
+    version = textit.version.__version__
+    report("digest", digest)
+
+    # Undecodable bytes of non-UTF-8 filenames are kept as \xNN escapes, so
+    # that the records stay valid UTF-8.
+    url = os.fsencode(input_path).decode("utf-8", "backslashreplace")
+
+    if digest_index is not None:
+        with instrumentation.timer("digest_index"):
+            original = digest_index.claim(digest, version, output_path)
+        if original is not None:
+            instrumentation.annotate(drop_reason="duplicate")
+            logger.info(f"Skipping '{input_path}' (digest: {file_digest}), same "
+                        f"contents as '{original[0]}'")
+            return "duplicate", digest, duplicate_record(url, digest, original, output_path)
+
+    try:
+        output = extract_file(input_path, output_path, url, file_digest, buffer,
+                              prefetched.file_type if prefetched is not None else _UNSNIFFED)
+    except BaseException:
+        if digest_index is not None:
+            digest_index.release(digest, version, output_path)
+        raise
+
+    # finish_task() completes the digest claim, once the record is written.
+    return "ok", digest, output
+
+
+# extract_file() has to sniff the file type itself.
+_UNSNIFFED = object()
+
+
+# Suffixes for the aliases of files without a usable one.
+FILE_TYPE_SUFFIXES = {FileType.PDF: ".pdf", FileType.DOC: ".doc", FileType.DOCX: ".docx",
+                      FileType.HTML: ".html", FileType.RTF: ".rtf", FileType.DVI: ".dvi",
+                      FileType.MOBI: ".mobi", FileType.EPUB: ".epub"}
+
+
+def scratch_path(input_path: str, output_path: str, file_type: Optional[FileType]) -> str:
+    """Path in the scratch directory for a stand-in of the input file, with
+    its suffix (the handlers may go by it)."""
+    suffix = os.path.splitext(input_path)[1]
+    if not suffix.isascii():
+        suffix = FILE_TYPE_SUFFIXES.get(file_type, "")
+    path = os.path.join(scratch_dir, get_basename_noext(output_path) + suffix)
+    try:
+        # Left behind by a worker that was killed.
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return path
+
+
+@contextmanager
+def utf8_alias(input_path: str, output_path: str, file_type: Optional[FileType]):
+    """A UTF-8 path to the input file, for the tools that can't deal with
+    non-UTF-8 ones (a symlink in the scratch directory, removed afterwards)."""
+    alias = scratch_path(input_path, output_path, file_type)
+    try:
+        os.symlink(os.path.abspath(input_path), alias)
+    except OSError:
+        # No symlinks on this filesystem.
+        shutil.copyfile(input_path, alias)
+    try:
+        yield alias
+    finally:
+        os.remove(alias)
 
-def process_file(input_path: str, output_path: str) -> None:
-    extractor = TextExtractor()
-    extractor.add_processor(text_repair)
-    extractor.add_processor(quality_filter)
-    extractor.add_processor(language_identification)
 
-    file_type = get_file_type(input_path)
-    file_digest = compute_sha1(input_path)
-    logger.info(f"Processing '{input_path}' (type: {file_type}, digest: "
-                f"{file_digest})")
-    metadata = Metadata(file_type=file_type, document_class=DocumentClass.CRAWLED)
-    _, basename = os.path.split(input_path)
-    title = os.path.splitext(basename)[0]
-
-    # While we can deal with non-UTF-8 filenames, other tools down the line,
-    # may not be able to, so here we do first copy a file to temporary, UTF-8
-    # path.
-    url = input_path
+@contextmanager
+def member_path(input_path: str, output_path: str, file_type: Optional[FileType], buffer):
+    """The path given to the handler of an archive member: its URL if the
+    handler reads the buffer, else a copy of the member in the scratch
+    directory (removed afterwards)."""
+    if extractor.has_buffer_handler(file_type):
+        yield input_path
+        return
+
+    path = scratch_path(input_path, output_path, file_type)
+    with instrumentation.timer("spill"):
+        with open(path, "wb") as f:
+            f.write(buffer)
     try:
-        input_path.encode("utf-8")
-        logger.debug(f"UTF-8 filename: '{input_path}'")
-        result, metadata = extractor.extract_text(input_path, metadata)
-    except UnicodeEncodeError:
-        url = input_path.encode("utf-8", "surrogateescape")
-        logger.debug(f"Non-UTF-8 filename: '{input_path}'")
-        with tempfile.NamedTemporaryFile(suffix=".pdf", delete=False) as temp_output:
-            shutil.copy2(input_path, temp_output.name)
-            result, metadata = extractor.extract_text(temp_output.name, metadata)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def extract_file(input_path: str, output_path: str, url, file_digest: str, buffer,
+                 file_type=_UNSNIFFED) -> tuple[Dict[str, Any], Any]:
+    digest = "sha1:" + file_digest
+    cached = None
+    if raw_cache is not None:
+        with instrumentation.timer("raw_cache"):
+            cached = raw_cache.get(digest)
+    if cached is not None and cached[1] == extractor.get_handler_version(cached[0]):
+        file_type, _, raw, metadata = cached
+        logger.info(f"Reprocessing '{input_path}' from the raw cache (type: "
+                    f"{file_type}, digest: {file_digest})")
+        raw = Result.ok(raw)
+    else:
+        if file_type is _UNSNIFFED:
+            with instrumentation.timer("file_type"):
+                file_type = get_file_type(input_path, buffer)
+        report("file_type", file_type.name if file_type else None)
+        logger.info(f"Processing '{input_path}' (type: {file_type}, digest: "
+                    f"{file_digest})")
+        metadata = Metadata(file_type=file_type, document_class=DocumentClass.CRAWLED,
+                            digest=digest)
+
+        if split_member(input_path) is not None:
+            with member_path(input_path, output_path, file_type, buffer) as path:
+                raw, metadata = extractor.extract_raw(path, metadata, buffer)
+        # They only differ for non-UTF-8 paths.
+        elif url == input_path:
+            raw, metadata = extractor.extract_raw(input_path, metadata, buffer)
+        else:
+            logger.debug(f"Non-UTF-8 filename: '{url}'")
+            # The buffer handlers still read the mapping, the alias is for
+            # the others (and OCR).
+            with utf8_alias(input_path, output_path, file_type) as alias:
+                raw, metadata = extractor.extract_raw(alias, metadata, buffer)
+
+        if raw_cache is not None and raw.is_ok() and file_type is not None:
+            raw_cache.put(digest, file_type, extractor.get_handler_version(file_type),
+                          raw.unwrap(), metadata)
+
+    result, metadata = extractor.process_raw(raw, metadata)
 
     assert(metadata is not None)
 
@@ -110,29 +450,67 @@ def process_file(input_path: str, output_path: str) -> None:
         text = ""
 
     metadata.version = textit.version.__version__
+    if instrumentation.enabled:
+        instrumentation.annotate(file_type=file_type.name if file_type else None,
+                                 ocr=getattr(metadata, "ocr", False),
+                                 drop_reason=metadata.drop_reason)
+        metadata.timings = instrumentation.document_timings()
     result = {k: v for k, v in metadata.__dict__.items() if v is not None}
     result["url"] = url
     result["digest"] = "sha1:" + file_digest
-    result["raw_content"] = "\n".join(text)
-
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    output_file_tmp = output_path + ".tmp"
-    with open(output_file_tmp, "w", encoding="utf-8", errors="surrogateescape") as f:
-        json.dump(result, f, ensure_ascii=False, indent=2, default=json_default_serializer)
 
-    os.rename(output_file_tmp, output_path)
+    return result, text
 
 
 def process_file_wrapper(arg):
     # For some reason we can't make this anonymous or local because someone
     # wants to pickle it.
-    input_path, output_path = arg
+    input_path, output_path, estimate, prefetched = arg
+    record = TaskRecord(get_basename_noext(output_path), input_path, output_path, "error")
+    if estimate is not None:
+        record.predicted_cost = estimate.cost
+        record.features = features_to_json(estimate.features)
+    instrumentation.start_document()
+    start = time.monotonic()
+    output = None
     try:
-        result = process_file(input_path, output_path)
+        if profiler is not None:
+            result = profiler.run(record.path_hash, {"input": input_path}, process_file,
+                                  input_path, output_path, prefetched)
+        else:
+            result = process_file(input_path, output_path, prefetched)
+        record.status, record.digest, output = result
     except Exception as e:
         estr = format_exception(e)
         logger.error(f"Exception raised when processing '{input_path}':{estr}")
 
+    record.duration = time.monotonic() - start
+    if profiler is not None:
+        name = record.path_hash
+        if record.digest is not None:
+            name += "-" + record.digest.split(":")[-1]
+        saved = profiler.save_if_slow(name, {"input": input_path, "digest": record.digest,
+                                             "status": record.status})
+        if saved is not None:
+            logger.info(f"Slow document '{input_path}' ({profiler.duration:.1f}s), "
+                        f"profile saved to '{saved}.*'")
+    if instrumentation.enabled:
+        record.stats = instrumentation.document_stats()
+    if preview_mode and output is not None:
+        try:
+            if prefetched is not None:
+                size = prefetched.size
+            elif estimate is not None:
+                size = estimate.features.size
+            else:
+                size = os.path.getsize(input_path)
+        except OSError:
+            size = 0
+        record.preview = document_sample(*output, size)
+    if output is not None and not defer(lambda r: finish_task(r, output)):
+        record = finish_task(record, output)
+    return record
+
 
 def get_basename_noext(path: str) -> str:
     return os.path.splitext(os.path.basename(path))[0]
@@ -152,10 +530,184 @@ def create_task(path: str, output_dir: str, prefix: str) -> tuple[str, str]:
     return path, output_file_path
 
 
+def enumerate_tasks(args, existing_hashes: set[str], counts: Counter):
+    """Yields (size, task) for the input files that weren't processed yet."""
+    for path, size in iter_inputs(args.input_dir, iter_files):
+        task = create_task(path, args.output_dir, args.prefix)
+        path_hash = get_basename_noext(task[1])
+        if args.shard is not None and not in_shard(path_hash, args.shard):
+            continue
+        counts["found"] += 1
+        if path_hash in existing_hashes:
+            continue
+
+        counts["queued"] += 1
+        yield size, task
+
+    counts["finished"] = 1
+    logger.info(f"Found {counts['found']} input files, {counts['queued']} to process")
+
+
+def reprocess_tasks(args, manifest: RunManifest, counts: Counter):
+    """Yields the tasks that ended "ok" in the manifest, to rerun from their
+    raw cache entries."""
+    for path_hash, input_path, digest in manifest.finished_tasks():
+        if args.shard is not None and not in_shard(path_hash, args.shard):
+            continue
+        counts["found"] += 1
+        counts["queued"] += 1
+        _, output_path = create_task(input_path, args.output_dir, args.prefix)
+        yield input_path, output_path, None, CachedTask(digest)
+
+    counts["finished"] = 1
+    logger.info(f"Reprocessing {counts['queued']} files of the manifest from the raw cache")
+
+
+def queue_tasks(args, work_queue: WorkQueue, existing_hashes: set[str], counts: Counter, order):
+    """Yields the tasks of the batches claimed from the work queue, each
+    batch ordered by ``order`` on its own (so that the next batch is only
+    claimed once this one is handed to the workers)."""
+    def batch_tasks(batch):
+        for path, size in work_queue.read_batch(batch):
+            counts["found"] += 1
+            task = create_task(path, args.output_dir, args.prefix)
+            path_hash = get_basename_noext(task[1])
+            if path_hash in existing_hashes:
+                continue
+
+            counts["queued"] += 1
+            work_queue.add_task(batch, path_hash)
+            yield size, task
+
+    work_queue.start_planning(lambda: iter_inputs(args.input_dir, iter_files), args.batch_size)
+    while (batch := work_queue.claim()) is not None:
+        logger.info(f"Claimed batch {batch}")
+        yield from order(batch_tasks(batch))
+        work_queue.batch_enumerated(batch)
+
+    counts["finished"] = 1
+    logger.info(f"No batches left, {counts['queued']} files to process from "
+                f"{work_queue.completed} batches done by this node")
+
+
+def write_node_summary(args, summary: Counter, started: float, supervisor: Supervisor,
+                       work_queue: Optional[WorkQueue]) -> None:
+    """summary-<node>.json in the output directory, for tools/merge_runs.py."""
+    path = os.path.join(args.output_dir, f"summary-{args.node}.json")
+    node_summary = {"node": args.node, "host": socket.gethostname(), "run": args.run,
+                    "shard": args.shard and "/".join(map(str, args.shard)),
+                    "started": started, "finished": time.time(), "statuses": dict(summary),
+                    "batches": work_queue.completed if work_queue is not None else None,
+                    "replaced_workers": supervisor.replaced,
+                    "recycled_workers": dict(supervisor.recycled)}
+    with open(path + ".tmp", "w") as f:
+        json.dump(node_summary, f, indent=2)
+    os.rename(path + ".tmp", path)
+
+
+def parse_timeouts(s: str) -> dict[str, float]:
+    """"PDF=900,DOC=60" -> {"PDF": 900.0, "DOC": 60.0}"""
+    timeouts = {}
+    for item in filter(None, s.split(",")):
+        file_type, _, seconds = item.partition("=")
+        if file_type.upper() not in FileType.__members__:
+            raise ValueError(f"Unknown file type '{file_type}'")
+        timeouts[file_type.upper()] = float(seconds)
+    return timeouts
+
+
+def task_budget(args, task, events) -> Optional[float]:
+    """Wall-clock seconds that a task may take, given what its worker
+    reported so far (see Supervisor)."""
+    if args.timeout <= 0:
+        return None
+
+    _, _, estimate, prefetched = task
+    file_type = estimate.features.file_type if estimate is not None else None
+    if prefetched is not None and prefetched.file_type is not None:
+        file_type = prefetched.file_type.name
+    if "file_type" in events:
+        file_type = events["file_type"][0]
+    budget = args.type_timeouts.get(file_type, args.timeout)
+    if "ocr" in events:
+        # OCR gets its own budget, from the moment it starts.
+        budget = max(budget, events["ocr"][1] + args.ocr_timeout)
+    return budget
+
+
+def task_memory(task) -> int:
+    _, _, estimate, _ = task
+    return predict_memory(estimate.features) if estimate is not None else 0
+
+
+def task_failed(args, task, reason: str, events, elapsed: float, pid: int) -> TaskRecord:
+    """Record of a task whose worker (process ``pid``) was killed (reason
+    "timeout") or died ("crash")."""
+    input_path, output_path, estimate, _ = task
+    logger.error(f"Worker {'timed out' if reason == 'timeout' else 'died'} after "
+                 f"{elapsed:.1f}s processing '{input_path}' (reported: {events})")
+    # Nothing was written for it.
+    record = TaskRecord(get_basename_noext(output_path), input_path, None,
+                        "timeout" if reason == "timeout" else "error", duration=elapsed,
+                        drop_reason=reason)
+    if estimate is not None:
+        record.predicted_cost = estimate.cost
+        record.features = features_to_json(estimate.features)
+    if "digest" in events:
+        record.digest = events["digest"][0]
+    if args.profile_slow is not None:
+        # Left behind by the worker as it ran.
+        name = record.path_hash
+        if record.digest is not None:
+            name += "-" + record.digest.split(":")[-1]
+        saved = rename_profile(args.profile_dir, record.path_hash, name)
+        if saved is not None:
+            logger.info(f"Profile of the first part of '{input_path}' saved to '{saved}.*'")
+    if record.digest is not None and args.digest_index:
+        # Let duplicates of this file be extracted on their own.
+        index = DigestIndex(args.digest_index, args.output_dir)
+        index.release(record.digest, textit.version.__version__, output_path)
+        index.close()
+    if args.output_format in SHARD_COMPRESSION:
+        recover_shards(args.output_dir, functools.partial(record_path_hash, args), pid)
+
+    return record
+
+
+def record_path_hash(args, record: Dict[str, Any]) -> str:
+    """Path hash of the task that wrote ``record``."""
+    if "path_hash" in record:
+        return record["path_hash"]
+    # Written by an older version; only right for UTF-8 paths.
+    return get_basename_noext(create_task(record["url"], args.output_dir, args.prefix)[1])
+
+
+def recover_manifest(args, manifest: RunManifest) -> int:
+    """Records the tasks whose records made it to a shard but not to the
+    manifest (committed in batches), so that they don't run again. Runs are
+    only looked at until they are finished. Returns the number of tasks
+    recorded."""
+    finished = manifest.finished_runs()
+    added = 0
+    for run, complete in shard_runs(args.output_dir).items():
+        if run in finished:
+            continue
+        tasks = (TaskRecord(entry["path_hash"], entry["metadata"].get("url", ""),
+                            os.path.join(args.output_dir, os.path.basename(entry["file"])),
+                            "duplicate" if entry["metadata"].get("drop_reason") == "duplicate"
+                            else "ok", digest=entry["metadata"].get("digest"))
+                 for entry in run_entries(args.output_dir, run) if entry["path_hash"])
+        added += manifest.add_written(tasks)
+        if complete:
+            manifest.finish_run(run)
+
+    return added
+
+
 def main():
     parser = argparse.ArgumentParser(description="Extract text from files in a directory")
     parser.add_argument("input_dir", help="Path to the input directory")
-    parser.add_argument("output_dir", help="Path to the output .json.gz file")
+    parser.add_argument("output_dir", help="Path to the output directory")
     parser.add_argument("--num_processes", type=int, default=mp.cpu_count(),
                         help="Number of processes to use (default: number of CPU cores)")
     parser.add_argument("--prefix", type=str, default=None, help="Directory prefix to ignore.")
@@ -165,8 +717,175 @@ def main():
                         help="Lowest log level for which to record messages (default: %(default)s)")
     parser.add_argument("--logstderr", action="store_true",
                         help="Also print the logs to stderr")
+    parser.add_argument("--unit_size", type=int, default=0,
+                        help="Re-cut the text into units of at most this many characters before "
+                             "the processors (lines are packed together, longer ones cut after "
+                             "a sentence); 0 keeps the units of the handlers "
+                             "(default: %(default)s)")
+    parser.add_argument("--boilerplate", action="store_true",
+                        help="Drop lines that are repeated across many documents of the corpus")
+    parser.add_argument("--boilerplate_max_docs", type=int, default=20,
+                        help="Drop a line once it was seen in this many other documents (default: %(default)s)")
+    parser.add_argument("--boilerplate_window", type=int, default=None,
+                        help="Halve the line counts every this many documents (default: never)")
+    parser.add_argument("--boilerplate_width", type=int, default=2 ** 20,
+                        help="Counters per row of the line sketch (default: %(default)s)")
+    parser.add_argument("--boilerplate_depth", type=int, default=4,
+                        help="Rows of the line sketch; memory is 4 * width * depth bytes (default: %(default)s)")
+    parser.add_argument("--boilerplate_sketch", type=str, default=None,
+                        help="Sketch file to start from and to save to at the end of the run")
+    parser.add_argument("--near_dedup", type=str, default=None,
+                        help="MinHash-LSH index (SQLite file, kept across runs) used to find near-duplicate documents")
+    parser.add_argument("--near_dedup_threshold", type=float, default=0.8,
+                        help="Estimated Jaccard similarity above which a document is a near-duplicate (default: %(default)s)")
+    parser.add_argument("--near_dedup_drop", action="store_true",
+                        help="Drop near-duplicates instead of only marking them")
+    parser.add_argument("--digest_index", type=str, default=None,
+                        help="Content digest index (SQLite file, kept across runs); files whose "
+                             "contents were already extracted by this version are not extracted again")
+    parser.add_argument("--copy_duplicates", action="store_true",
+                        help="Write a copy of the original output for duplicates, instead of a "
+                             "reference record")
+    parser.add_argument("--raw_cache", type=str, default=None,
+                        help="Cache of the raw handler output (SQLite file); files found in it "
+                             "with the same handler version are only run through the processors")
+    parser.add_argument("--page_checkpoints", type=str, default=None,
+                        help="Store of the pages done (SQLite file, kept across runs), so that "
+                             "the extraction and OCR of long PDFs resume where a killed or crashed "
+                             "worker left them")
+    parser.add_argument("--manifest", type=str, default=None,
+                        help="Run manifest used to resume (default: manifest.sqlite in the output directory)")
+    parser.add_argument("--shard", type=str, default=None, metavar="i/N",
+                        help="Only process the input files whose path hash is i modulo N, e.g. "
+                             "0/4 to 3/4 on four nodes")
+    parser.add_argument("--work_queue", type=str, default=None,
+                        help="Directory (on a filesystem shared by the nodes) from which the nodes "
+                             "of a run claim batches of input files")
+    parser.add_argument("--batch_size", type=int, default=1000,
+                        help="Input files per batch of the work queue (default: %(default)s)")
+    parser.add_argument("--lease_seconds", type=float, default=600,
+                        help="Seconds after which the batch of a node that stopped renewing its "
+                             "lease goes to another node (default: %(default)s)")
+    parser.add_argument("--node", type=str, default=None,
+                        help="Name of this node in multi-node runs, for its manifest and summary "
+                             "(default: the shard, or the host name)")
+    parser.add_argument("--retry", type=str, default="error",
+                        help="Comma-separated statuses of earlier tasks to run again (default: %(default)s)")
+    parser.add_argument("--lookahead", type=int, default=10000,
+                        help="Order this many discovered files at a time (default: %(default)s)")
+    parser.add_argument("--schedule", choices=["cost", "size"], default="cost",
+                        help="Start the most expensive tasks first (cost) or the smallest files first "
+                             "(size) (default: %(default)s)")
+    parser.add_argument("--cost_model", type=str, default=None,
+                        help="Cost model calibrated with tools/calibrate_cost_model.py")
+    parser.add_argument("--probe_threads", type=int, default=8,
+                        help="Threads used to probe files for cost estimation (default: %(default)s)")
+    parser.add_argument("--probe_processes", type=int, default=2,
+                        help="Processes opening the PDFs to probe for cost estimation; 0 to do it "
+                             "on the probe threads (default: %(default)s)")
+    parser.add_argument("--probe_timeout", type=float, default=10.0,
+                        help="Seconds that probing a PDF may take before its cost is estimated "
+                             "from its size; 0 for no limit (default: %(default)s)")
+    parser.add_argument("--max_pending", type=int, default=None,
+                        help="Most tasks queued ahead of the workers (default: 4 * num_processes)")
+    parser.add_argument("--prefetch_threads", type=int, default=4,
+                        help="Threads reading, hashing and sniffing the next files ahead of the "
+                             "workers; 0 to leave that to the workers (default: %(default)s)")
+    parser.add_argument("--prefetch_depth", type=int, default=None,
+                        help="Most files read ahead (default: 2 * num_processes)")
+    parser.add_argument("--writer_queue", type=int, default=2,
+                        help="Records that each worker can hand to its writer thread before it "
+                             "waits for it; 0 to write on the worker's main thread (default: %(default)s)")
+    parser.add_argument("--timeout", type=float, default=900,
+                        help="Seconds after which a worker is killed (with its subprocesses) and "
+                             "its document recorded as timed out; 0 for none (default: %(default)s)")
+    parser.add_argument("--type_timeouts", type=str, default="",
+                        help="Per file type timeouts, e.g. PDF=1800,DOC=120 (default: --timeout)")
+    parser.add_argument("--max_worker_rss", type=int, default=4096,
+                        help="Replace a worker after a task once its RSS is over this many MB; "
+                             "0 for no limit (default: %(default)s)")
+    parser.add_argument("--max_worker_tasks", type=int, default=1000,
+                        help="Replace a worker after this many tasks; 0 for no limit (default: %(default)s)")
+    parser.add_argument("--memory_reserve", type=int, default=1024,
+                        help="MB of memory to leave free when starting a task that is expected to "
+                             "need a lot of it (with --schedule cost) (default: %(default)s)")
+    parser.add_argument("--ocr_timeout", type=float, default=3600,
+                        help="Seconds that OCR gets, from the moment it starts (default: %(default)s)")
+    parser.add_argument("--output_format", choices=["json", "jsonl.gz", "jsonl.zst"], default="json",
+                        help="One JSON file per input, or compressed JSONL shards written by each "
+                             "worker (default: %(default)s)")
+    parser.add_argument("--shard_size", type=int, default=256,
+                        help="Start a new shard once the current one has this many MB (default: %(default)s)")
+    parser.add_argument("--shard_records", type=int, default=100000,
+                        help="Start a new shard once the current one has this many records (default: %(default)s)")
+    parser.add_argument("--instrument", action="store_true",
+                        help="Time the stages of every document (stored in its record) and print "
+                             "a summary of the run")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="Write the run metrics to this Prometheus textfile (.prom); implies --instrument")
+    parser.add_argument("--profile_slow", type=float, default=None, metavar="SECONDS",
+                        help="Profile every document and keep the profiles of those that take "
+                             "longer than this")
+    parser.add_argument("--profile_mode", choices=["sample", "cprofile"], default="sample",
+                        help="Stack sampling (cheap, pstats of the samples) or also cProfile "
+                             "(slower, exact call counts) (default: %(default)s)")
+    parser.add_argument("--profile_dir", type=str, default=None,
+                        help="Where to save the profiles (default: profiles/ in the log directory)")
+    parser.add_argument("--preview", action="store_true",
+                        help="Only extract a sample of every document and write the projected "
+                             "yield, languages, OCR and cost of the corpus to preview.json in the "
+                             "output directory (use a separate one); with --shard i/N, only 1/N "
+                             "of the files")
+    parser.add_argument("--preview_pages", type=int, default=10,
+                        help="PDF pages extracted per document in a preview, spread over it "
+                             "(default: %(default)s)")
+    parser.add_argument("--preview_chapters", type=int, default=3,
+                        help="EPUB and MOBI chapters extracted per book in a preview (default: %(default)s)")
+    parser.add_argument("--preview_kb", type=int, default=64,
+                        help="KB of HTML and RTF extracted per document in a preview (default: %(default)s)")
+    parser.add_argument("--reprocess", action="store_true",
+                        help="Process files again even if their output exists (with "
+                             "--raw_cache, only rerun the processors on the files of the "
+                             "manifest, without reading them)")
 
     args = parser.parse_args()
+    if args.max_pending is None:
+        args.max_pending = 4 * args.num_processes
+    try:
+        args.type_timeouts = parse_timeouts(args.type_timeouts)
+    except ValueError as e:
+        parser.error(f"--type_timeouts: {e}")
+    if args.output_format in SHARD_COMPRESSION:
+        if args.copy_duplicates:
+            parser.error("--copy_duplicates needs --output_format json")
+        if args.output_format == "jsonl.zst" and zstandard is None:
+            parser.error("--output_format jsonl.zst needs the 'zstandard' package")
+    if args.metrics_file:
+        args.instrument = True
+    if args.profile_dir is None:
+        args.profile_dir = os.path.join(args.logdir, "profiles")
+    if args.preview and (args.raw_cache or args.digest_index or args.page_checkpoints or
+                         args.near_dedup or args.boilerplate_sketch):
+        parser.error("--preview can't share --raw_cache, --digest_index, --page_checkpoints, "
+                     "--near_dedup or --boilerplate_sketch with full runs")
+    if args.reprocess and args.raw_cache and args.work_queue:
+        parser.error("--reprocess with --raw_cache reruns the tasks of the node's manifest, "
+                     "not those of --work_queue")
+    if args.shard is not None:
+        if args.work_queue:
+            parser.error("--shard and --work_queue are exclusive")
+        try:
+            args.shard = parse_shard(args.shard)
+        except ValueError as e:
+            parser.error(f"--shard: {e}")
+    if args.node is None and args.shard is not None:
+        args.node = "shard-{}-of-{}".format(*args.shard)
+    elif args.node is None and args.work_queue:
+        args.node = socket.gethostname()
+    # Part of the shard names, so that runs don't overwrite each other's.
+    args.run = time.strftime("%Y%m%d%H%M%S")
+    # Removed at the end of the run, with whatever killed workers left in it.
+    args.scratch_dir = tempfile.mkdtemp(prefix=f"textit-{args.run}-")
 
     setup_logging(args.logdir, stderr=args.logstderr, level=args.loglevel)
     global logger
@@ -174,21 +893,177 @@ def main():
 
     os.makedirs(args.output_dir, exist_ok=True)
 
-    existing_files = get_all_files(args.output_dir)
-    existing_hashes = {get_basename_noext(file) for file in existing_files}
+    started = time.time()
+    # Every node of a multi-node run has its own manifest, merged at the end
+    # by tools/merge_runs.py.
+    manifest_name = f"manifest-{args.node}.sqlite" if args.node else "manifest.sqlite"
+    manifest = RunManifest(args.manifest or os.path.join(args.output_dir, manifest_name))
+    if manifest.is_empty() and not args.node:
+        # Output directory from before the manifest existed, walk it once.
+        existing_files = (f for f in get_all_files(args.output_dir) if f.endswith(".json"))
+        manifest.record_all(TaskRecord(get_basename_noext(f), "", f, "ok") for f in existing_files)
+
+    if args.output_format in SHARD_COMPRESSION:
+        recovered = recover_shards(args.output_dir, functools.partial(record_path_hash, args))
+        if recovered:
+            logger.info(f"Finalized {recovered} shards left behind by a previous run")
+        added = recover_manifest(args, manifest)
+        if added:
+            logger.info(f"Recorded {added} tasks whose records were written by a previous "
+                        f"run that didn't record them")
+
+    if args.reprocess:
+        existing_hashes = set()
+    else:
+        existing_hashes = manifest.done_hashes(retry=args.retry.split(","))
 
-    input_files = get_all_files(args.input_dir)
-    tasks = (create_task(file, args.output_dir, args.prefix) for file in input_files)
-    tasks = filter(lambda e: get_basename_noext(e[1]) not in existing_hashes, tasks)
-    tasks = sorted(tasks, key=lambda e: os.path.getsize(e[0]))
-    tasks_str = "\n\t".join(task[0] for task in tasks)
-    logger.info(f"Processing files:\n\t{tasks_str}")
+    # Tasks are discovered while the first ones already run; only windows of
+    # --lookahead of them are ordered (by predicted cost or by size), and at
+    # most --max_pending are queued ahead of the workers.
+    enumeration = Counter()
+    if args.schedule == "cost":
+        model = CostModel.load(args.cost_model) if args.cost_model else CostModel()
+        order = lambda tasks: schedule(tasks, args.lookahead, model, args.probe_threads,
+                                       args.probe_processes, args.probe_timeout or None,
+                                       context=MP_CONTEXT)
+    else:
+        order = lambda tasks: ((*task, None) for _, task in
+                               windowed_sort(tasks, args.lookahead,
+                                             key=lambda e: sort_size(e[1][0], e[0])))
 
-    with mp.Pool(initializer=init_proc, initargs=[args], processes=args.num_processes) as pool:
-        with tqdm(total=len(tasks), desc="Extracting text", unit="file") as pbar:
-            for _ in pool.imap_unordered(process_file_wrapper, tasks):
+    work_queue = None
+    prefetcher = None
+    if args.reprocess and args.raw_cache:
+        # Straight from the manifest and the raw cache: the input files are
+        # neither listed nor read.
+        tasks = reprocess_tasks(args, manifest, enumeration)
+    else:
+        if args.work_queue:
+            work_queue = WorkQueue(args.work_queue, args.node, lease_seconds=args.lease_seconds)
+            tasks = queue_tasks(args, work_queue, existing_hashes, enumeration, order)
+        else:
+            tasks = order(enumerate_tasks(args, existing_hashes, enumeration))
+        if args.prefetch_threads > 0:
+            prefetcher = Prefetcher(args.prefetch_threads,
+                                    args.prefetch_depth or 2 * args.num_processes)
+            tasks = prefetcher.run(tasks)
+        else:
+            tasks = ((*task, None) for task in tasks)
+
+    sketch_array = create_sketch_array(args) if args.boilerplate else None
+    if args.near_dedup:
+        # Create the index before the workers race to do it.
+        LSHIndex(args.near_dedup).close()
+    if args.raw_cache:
+        RawCache(args.raw_cache).close()
+    if args.page_checkpoints:
+        PageCheckpoints(args.page_checkpoints).close()
+    if args.digest_index:
+        index = DigestIndex(args.digest_index, args.output_dir)
+        released = index.release_pending()
+        index.close()
+        if released:
+            logger.info(f"Released {released} unfinished digest claims from a previous run")
+
+    summary = Counter()
+    run_stats = RunStats() if args.instrument else None
+    preview_report = None
+    if args.preview:
+        preview_report = PreviewReport(1 / args.shard[1] if args.shard is not None else 1.0)
+
+    mp.get_context(MP_CONTEXT).set_forkserver_preload(["__main__"])
+    supervisor = Supervisor(args.num_processes, process_file_wrapper,
+                            initializer=init_proc, initargs=[args, sketch_array],
+                            budget=functools.partial(task_budget, args),
+                            on_failure=functools.partial(task_failed, args),
+                            context=MP_CONTEXT,
+                            max_tasks=args.max_worker_tasks or None,
+                            max_rss=args.max_worker_rss * 2 ** 20 or None,
+                            memory_needed=task_memory,
+                            memory_reserve=args.memory_reserve * 2 ** 20,
+                            writer_queue=args.writer_queue)
+    # Workers exit on their own at the end, finalizing their shards.
+    with supervisor:
+        with tqdm(total=None, desc="Extracting text", unit="file") as pbar:
+            for record in supervisor.imap_unordered(tasks, prefetch=args.max_pending):
+                manifest.record(record)
+                summary[record.status] += 1
+                if work_queue is not None:
+                    batch = work_queue.task_done(record.path_hash)
+                    if batch is not None:
+                        manifest.commit()
+                        work_queue.complete(batch)
+                if run_stats is not None:
+                    run_stats.add(record.status, record.duration, record.stats)
+                if preview_report is not None:
+                    preview_report.add(record.status, record.duration, record.preview)
+                if pbar.total is None and enumeration["finished"]:
+                    pbar.total = enumeration["queued"]
                 pbar.update()
 
+    if supervisor.replaced:
+        logger.info(f"Replaced {supervisor.replaced} workers that timed out or died")
+    worker_stats = [w for w in supervisor.rss_stats() if w["tasks"]]
+    for w in worker_stats:
+        logger.info(f"Worker {w['pid']}: {w['tasks']} tasks, RSS peak "
+                    f"{w['rss_peak'] / 2 ** 20:.0f} MB, mean {w['rss_mean'] / 2 ** 20:.0f} MB")
+
+    if args.output_format in SHARD_COMPRESSION and not supervisor.replaced:
+        # All the records of the run are in the manifest; with workers that
+        # died, the next run checks their shards.
+        manifest.finish_run(args.run)
+    manifest.close()
+    shutil.rmtree(args.scratch_dir, ignore_errors=True)
+    if work_queue is not None:
+        work_queue.close()
+    if args.node:
+        write_node_summary(args, summary, started, supervisor, work_queue)
+
+    if sketch_array is not None and args.boilerplate_sketch:
+        sketch = CountMinSketch(args.boilerplate_width, args.boilerplate_depth,
+                                sketch_array.get_obj())
+        sketch.save(args.boilerplate_sketch)
+        logger.info(f"Saved the boilerplate sketch ({sketch.documents} documents) "
+                    f"to '{args.boilerplate_sketch}'")
+
+    summary_str = ", ".join(f"{status}: {count}" for status, count in sorted(summary.items()))
+    summary_str = summary_str or "no new tasks"
+    logger.info(f"Run summary: {summary_str}")
+    print(f"Run summary: {summary_str}")
+    if worker_stats:
+        peak = max(worker_stats, key=lambda w: w["rss_peak"])
+        mean = sum(w["rss_mean"] for w in worker_stats) / len(worker_stats)
+        recycled = ", ".join(f"{reason}: {n}" for reason, n in sorted(supervisor.recycled.items()))
+        memory_str = (f"Worker RSS: peak {peak['rss_peak'] / 2 ** 20:.0f} MB (worker {peak['pid']}), "
+                      f"mean {mean / 2 ** 20:.0f} MB over {len(worker_stats)} workers; "
+                      f"recycled: {recycled or 'none'}; "
+                      f"tasks that waited for memory: {supervisor.waited_for_memory}")
+        logger.info(memory_str)
+        print(memory_str)
+    if summary:
+        utilisation = supervisor.utilisation()
+        pipeline_str = f"Pipeline: workers {100 * utilisation['workers']:.0f}% busy"
+        if prefetcher is not None:
+            pipeline_str = (f"Pipeline: prefetch {100 * prefetcher.utilisation():.0f}% busy "
+                            f"({prefetcher.files} files, {prefetcher.bytes / 2 ** 20:.1f} MB), "
+                            f"workers {100 * utilisation['workers']:.0f}% busy")
+        if args.writer_queue:
+            pipeline_str += f", writers {100 * utilisation['writers']:.0f}% busy"
+        logger.info(pipeline_str)
+        print(pipeline_str)
+    if run_stats is not None and summary:
+        stats_str = run_stats.summary()
+        logger.info(f"Run statistics:\n{stats_str}")
+        print(stats_str)
+        if args.metrics_file:
+            run_stats.write_prometheus(args.metrics_file)
+    if preview_report is not None and summary:
+        name = f"preview-{args.node}.json" if args.node else "preview.json"
+        preview_report.write(os.path.join(args.output_dir, name))
+        preview_str = preview_report.summary()
+        logger.info(f"Preview:\n{preview_str}")
+        print(preview_str)
+
 
 if __name__ == "__main__":
     main()